@@ -0,0 +1,331 @@
+import hashlib
+import os
+import re
+import sqlite3
+import time
+import uuid
+import zlib
+from typing import Callable, Optional
+
+import numpy as np
+import torch
+
+INDEX_FILE_NAME = "index.sqlite"
+# Names of the released ESM2 checkpoints, e.g. "esm2_t33_650M_UR50D"
+ESM2_CHECKPOINT_NAME = r"esm2_t\d+_\d+[MB]_UR50D"
+
+
+def canonical_model_id(name_or_path: str) -> str:
+    """
+    Canonical id of a pLM checkpoint for cache keys. A released ESM2 checkpoint gets
+    the same id whether it's given as a hub id ("facebook/esm2_t33_650M_UR50D") or as
+    an ESM weights file ("/weights/esm2_t33_650M_UR50D.pt"): "esm2_t33_650M_UR50D".
+    Any other local file or directory is identified by its resolved absolute path, so
+    same-named checkpoints in different places don't share entries. Other names are
+    used as-is.
+    """
+    if os.path.exists(name_or_path):
+        name = os.path.basename(os.path.normpath(name_or_path))
+        if os.path.isfile(name_or_path) and re.fullmatch(rf"{ESM2_CHECKPOINT_NAME}\.pt", name):
+            return name[: -len(".pt")]
+        return os.path.realpath(name_or_path)
+    match = re.fullmatch(rf"facebook/({ESM2_CHECKPOINT_NAME})", name_or_path)
+    return match.group(1) if match else name_or_path
+
+
+class ActivationCache:
+    def __init__(
+        self,
+        cache_dir: str,
+        max_size_gb: float = 100.0,
+        shard_size_mb: float = 1024.0,
+        dtype: str = "float32",
+        min_shard_idle_seconds: float = 600.0,
+    ):
+        """
+        Persistent on-disk store of per-sequence pLM layer activations, keyed by
+        (canonical model id, layer, sequence hash). It's shared across tools so that the
+        expensive pLM forward pass only needs to run once per sequence.
+
+        Activations are appended to memory-mapped shard files and a SQLite index maps
+        each key to a (shard, offset, num_tokens, d_model) record. When the total size
+        exceeds `max_size_gb`, whole shards are evicted in least-recently-used order.
+        Lookups only read the index; their access times are written in a batch by
+        `commit`, so readers don't hold the write lock. Each record also stores a CRC32
+        of its bytes, so an entry whose shard was evicted and recreated is a miss
+        rather than the wrong activations.
+
+        Args:
+            cache_dir: Directory containing the shards and the index.
+            max_size_gb: Size cap of the cache.
+            shard_size_mb: Size at which a new shard file is started. This is also
+                the granularity of eviction.
+            dtype: numpy dtype new activations are stored in. "float16" halves the disk
+                usage at the cost of exactness.
+            min_shard_idle_seconds: Shards modified more recently than this are not
+                evicted, since another process may still be appending to them.
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_size_bytes = int(max_size_gb * 1024**3)
+        self.shard_size_bytes = int(shard_size_mb * 1024**2)
+        self.dtype = np.dtype(dtype)
+        self.min_shard_idle_seconds = min_shard_idle_seconds
+        self.hits = 0
+        self.misses = 0
+
+        self._db = sqlite3.connect(os.path.join(cache_dir, INDEX_FILE_NAME), timeout=600)
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                shard TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                num_tokens INTEGER NOT NULL,
+                d_model INTEGER NOT NULL,
+                dtype TEXT NOT NULL,
+                last_access REAL NOT NULL,
+                checksum INTEGER
+            )
+            """
+        )
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(entries)")]
+        if "checksum" not in columns:
+            # Entries of an index from before checksums were added are treated as misses
+            self._db.execute("ALTER TABLE entries ADD COLUMN checksum INTEGER")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_shard ON entries (shard)")
+        self._db.commit()
+
+        # Each process appends to its own shard so concurrent writers never collide.
+        self._write_shard: Optional[str] = None
+        self._write_shard_size = 0
+        self._mmaps: dict[str, np.memmap] = {}
+        # Access times of cache hits not yet written to the index
+        self._pending_accesses: dict[str, float] = {}
+
+    @staticmethod
+    def make_key(model_name: str, layer: int, seq: str) -> str:
+        seq_hash = hashlib.sha256(seq.encode()).hexdigest()
+        return f"{canonical_model_id(model_name)}:{layer}:{seq_hash}"
+
+    def _shard_path(self, shard: str) -> str:
+        return os.path.join(self.cache_dir, shard)
+
+    def _read(self, shard: str, offset: int, nbytes: int) -> Optional[np.ndarray]:
+        mm = self._mmaps.get(shard)
+        if mm is None or mm.size < offset + nbytes:
+            path = self._shard_path(shard)
+            if not os.path.exists(path):
+                return None
+            # Shards are append-only, so remap if the entry lies past the mapped end.
+            mm = np.memmap(path, dtype=np.uint8, mode="r")
+            self._mmaps[shard] = mm
+        if mm.size < offset + nbytes:
+            return None
+        return np.array(mm[offset : offset + nbytes])
+
+    def get(self, model_name: str, layer: int, seq: str) -> Optional[np.ndarray]:
+        """
+        Look up the cached activations of a sequence.
+
+        Returns:
+            The (num_tokens, d_model) activations, or None on a cache miss.
+        """
+        key = self.make_key(model_name, layer, seq)
+        row = self._db.execute(
+            "SELECT shard, offset, num_tokens, d_model, dtype, checksum FROM entries WHERE key = ?",
+            (key,),
+        ).fetchone()
+        if row is not None:
+            shard, offset, num_tokens, d_model, dtype, checksum = row
+            dtype = np.dtype(dtype)
+            buf = self._read(shard, offset, num_tokens * d_model * dtype.itemsize)
+            if buf is not None and zlib.crc32(buf) == checksum:
+                self._pending_accesses[key] = time.time()
+                self.hits += 1
+                return buf.view(dtype).reshape(num_tokens, d_model)
+            # The shard was evicted, and possibly recreated, by another process.
+            self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self._db.commit()
+        self.misses += 1
+        return None
+
+    def put(self, model_name: str, layer: int, seq: str, acts: torch.Tensor) -> None:
+        """
+        Store the (num_tokens, d_model) activations of a sequence.
+        """
+        arr = np.ascontiguousarray(acts.detach().float().cpu().numpy().astype(self.dtype))
+        if (
+            self._write_shard is None
+            or self._write_shard_size >= self.shard_size_bytes
+            # Evicted by another process after being idle
+            or (
+                self._write_shard_size > 0
+                and not os.path.exists(self._shard_path(self._write_shard))
+            )
+        ):
+            self._write_shard = f"{uuid.uuid4().hex}.bin"
+            self._write_shard_size = 0
+            self.evict()
+
+        with open(self._shard_path(self._write_shard), "ab") as f:
+            offset = f.tell()
+            f.write(arr.tobytes())
+        self._write_shard_size = offset + arr.nbytes
+
+        self._db.execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                self.make_key(model_name, layer, seq),
+                self._write_shard,
+                offset,
+                arr.shape[0],
+                arr.shape[1],
+                self.dtype.name,
+                time.time(),
+                zlib.crc32(arr),
+            ),
+        )
+
+    def commit(self) -> None:
+        """
+        Write the access times of the cache hits since the last commit and commit the
+        index.
+        """
+        if self._pending_accesses:
+            self._db.executemany(
+                "UPDATE entries SET last_access = ? WHERE key = ?",
+                [(t, key) for key, t in self._pending_accesses.items()],
+            )
+            self._pending_accesses.clear()
+        self._db.commit()
+
+    def size_bytes(self) -> int:
+        return sum(
+            os.path.getsize(self._shard_path(f))
+            for f in os.listdir(self.cache_dir)
+            if f.endswith(".bin")
+        )
+
+    def evict(self) -> None:
+        """
+        Delete least-recently-used shards until the cache fits under its size cap.
+        Shard files without any index entries, e.g. from a writer that crashed before
+        committing, are deleted first. Shards modified in the last
+        `min_shard_idle_seconds` are kept, since their writer may still be appending to
+        them or have yet to commit their entries.
+        """
+        total = self.size_bytes()
+        if total <= self.max_size_bytes:
+            return
+
+        # Order the shards by up-to-date access times
+        self.commit()
+        shards = self._db.execute(
+            "SELECT shard FROM entries GROUP BY shard ORDER BY MAX(last_access)"
+        ).fetchall()
+
+        indexed_shards = {shard for (shard,) in shards}
+        for f in os.listdir(self.cache_dir):
+            if not f.endswith(".bin") or f in indexed_shards or f == self._write_shard:
+                continue
+            path = self._shard_path(f)
+            try:
+                if time.time() - os.path.getmtime(path) < self.min_shard_idle_seconds:
+                    continue
+                size = os.path.getsize(path)
+                os.remove(path)
+            except FileNotFoundError:
+                # Deleted by another process in the meantime
+                continue
+            total -= size
+            self._mmaps.pop(f, None)
+
+        evicted = []
+        for (shard,) in shards:
+            if total <= self.max_size_bytes:
+                break
+            if shard == self._write_shard:
+                continue
+            path = self._shard_path(shard)
+            if os.path.exists(path):
+                if time.time() - os.path.getmtime(path) < self.min_shard_idle_seconds:
+                    continue
+                total -= os.path.getsize(path)
+            evicted.append(shard)
+
+        # Drop the index entries before the files, so no committed entry ever points
+        # into a deleted shard
+        self._db.executemany("DELETE FROM entries WHERE shard = ?", [(s,) for s in evicted])
+        self.commit()
+        for shard in evicted:
+            path = self._shard_path(shard)
+            if os.path.exists(path):
+                os.remove(path)
+            self._mmaps.pop(shard, None)
+
+    def get_or_compute(
+        self,
+        model_name: str,
+        layer: int,
+        seqs: list[str],
+        compute_fn: Callable[[list[str]], list[torch.Tensor]],
+    ) -> list[torch.Tensor]:
+        """
+        Get the activations of each sequence, running `compute_fn` only on the
+        sequences that are not cached yet and caching its results.
+
+        Args:
+            model_name: Name or path of the pLM, e.g. "facebook/esm2_t33_650M_UR50D".
+                Entries are keyed by its `canonical_model_id`.
+            layer: The layer the activations are taken from.
+            seqs: The sequences to get the activations for.
+            compute_fn: Takes a list of sequences and returns a list of their
+                unpadded (num_tokens, d_model) activations.
+
+        Returns:
+            A list of (num_tokens, d_model) activations in the order of `seqs`. Cached
+            activations are returned as CPU tensors.
+        """
+        return self.get_or_compute_layers(
+            model_name, [layer], seqs, lambda missing_seqs: {layer: compute_fn(missing_seqs)}
+        )[layer]
+
+    def get_or_compute_layers(
+        self,
+        model_name: str,
+        layers: list[int],
+        seqs: list[str],
+        compute_fn: Callable[[list[str]], dict[int, list[torch.Tensor]]],
+    ) -> dict[int, list[torch.Tensor]]:
+        """
+        Multi-layer version of `get_or_compute`. `compute_fn` runs once on the
+        sequences that are missing from the cache for any of the layers and returns
+        the activations of all layers, so a single pLM pass fills every layer.
+
+        Returns:
+            A dict mapping each layer to a list of (num_tokens, d_model) activations
+            in the order of `seqs`.
+        """
+        results: dict[int, list[Optional[torch.Tensor]]] = {
+            layer: [None] * len(seqs) for layer in layers
+        }
+        missing = []
+        for i, seq in enumerate(seqs):
+            for layer in layers:
+                arr = self.get(model_name, layer, seq)
+                if arr is not None:
+                    results[layer][i] = torch.from_numpy(arr)
+            if any(results[layer][i] is None for layer in layers):
+                missing.append(i)
+
+        if missing:
+            computed = compute_fn([seqs[i] for i in missing])
+            for layer in layers:
+                for i, acts in zip(missing, computed[layer]):
+                    if results[layer][i] is None:
+                        self.put(model_name, layer, seqs[i], acts)
+                    results[layer][i] = acts
+
+        self.commit()
+        return results
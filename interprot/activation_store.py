@@ -0,0 +1,352 @@
+import itertools
+import json
+import os
+from typing import Iterator, Optional
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+METADATA_FILE_NAME = "metadata.json"
+# Sequence splits saved next to the store by `extract_activations.py`
+SPLIT_NAMES = ("train", "val", "test")
+
+
+def split_path(store_dir: str, split: str) -> str:
+    """
+    Returns the path of the parquet file of the sequences of a split of a store.
+    """
+    return os.path.join(store_dir, f"{split}.parquet")
+
+
+class ActivationStoreWriter:
+    def __init__(
+        self,
+        output_dir: str,
+        d_model: int,
+        shard_tokens: int = 262144,
+        dtype: str = "float16",
+    ):
+        """
+        Writes pLM layer activations into a sharded activation store that can be
+        read with `ActivationStore`. The store looks like this:
+
+        ```
+        output_dir/
+            metadata.json          # d_model, dtype and the list of shards
+            shard_00000.bin        # (num_tokens, d_model) token vectors
+            shard_00000_offsets.npy  # (num_seqs + 1,) sequence boundaries
+            ...
+        ```
+
+        Sequences are never split across shards, so a shard can exceed
+        `shard_tokens` by up to one sequence.
+
+        Args:
+            output_dir: Directory to write the store to.
+            d_model: Dimension of the pLM activations.
+            shard_tokens: Number of tokens per shard.
+            dtype: numpy dtype the activations are stored in.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.d_model = d_model
+        self.shard_tokens = shard_tokens
+        self.dtype = np.dtype(dtype)
+        self.shards: list[dict] = []
+        self._file = None
+        self._offsets: list[int] = []
+
+    def _start_shard(self) -> None:
+        name = f"shard_{len(self.shards):05d}"
+        self._file = open(os.path.join(self.output_dir, f"{name}.bin"), "wb")
+        self._offsets = [0]
+        self.shards.append({"name": name, "num_tokens": 0, "num_seqs": 0})
+
+    def _finish_shard(self) -> None:
+        self._file.close()
+        self._file = None
+        np.save(
+            os.path.join(self.output_dir, f"{self.shards[-1]['name']}_offsets.npy"),
+            np.array(self._offsets, dtype=np.int64),
+        )
+
+    def add(self, acts: torch.Tensor) -> None:
+        """
+        Append the (num_tokens, d_model) activations of one sequence.
+        """
+        if self._file is None:
+            self._start_shard()
+        arr = np.ascontiguousarray(acts.detach().float().cpu().numpy().astype(self.dtype))
+        self._file.write(arr.tobytes())
+        self._offsets.append(self._offsets[-1] + arr.shape[0])
+        self.shards[-1]["num_tokens"] += arr.shape[0]
+        self.shards[-1]["num_seqs"] += 1
+        if self.shards[-1]["num_tokens"] >= self.shard_tokens:
+            self._finish_shard()
+
+    def close(self) -> None:
+        """
+        Flush the last shard and write the metadata. The store is only readable
+        after this is called.
+        """
+        if self._file is not None:
+            self._finish_shard()
+        with open(os.path.join(self.output_dir, METADATA_FILE_NAME), "w") as f:
+            json.dump({"d_model": self.d_model, "dtype": self.dtype.name, "shards": self.shards}, f)
+
+
+class ActivationStore:
+    def __init__(self, store_dir: str):
+        """
+        Read-only view of an activation store written by `ActivationStoreWriter`.
+        Shards are memory-mapped, so opening a store is cheap regardless of its size.
+        """
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, METADATA_FILE_NAME)) as f:
+            metadata = json.load(f)
+        self.d_model = metadata["d_model"]
+        self.dtype = np.dtype(metadata["dtype"])
+        self.shards = metadata["shards"]
+
+    def __len__(self) -> int:
+        return len(self.shards)
+
+    @property
+    def num_tokens(self) -> int:
+        return sum(shard["num_tokens"] for shard in self.shards)
+
+    @property
+    def num_seqs(self) -> int:
+        return sum(shard["num_seqs"] for shard in self.shards)
+
+    def shard(self, idx: int) -> np.memmap:
+        """
+        Returns the (num_tokens, d_model) memory-mapped activations of a shard.
+        """
+        shard = self.shards[idx]
+        return np.memmap(
+            os.path.join(self.store_dir, f"{shard['name']}.bin"),
+            dtype=self.dtype,
+            mode="r",
+            shape=(shard["num_tokens"], self.d_model),
+        )
+
+    def offsets(self, idx: int) -> np.ndarray:
+        """
+        Returns the (num_seqs + 1,) sequence boundaries of a shard: sequence i spans
+        tokens `offsets[i]:offsets[i + 1]`.
+        """
+        return np.load(os.path.join(self.store_dir, f"{self.shards[idx]['name']}_offsets.npy"))
+
+
+class TokenShuffleBuffer:
+    def __init__(
+        self,
+        d_model: int,
+        capacity_tokens: int,
+        batch_tokens: int,
+        rng: np.random.Generator,
+        dtype: str = "float16",
+    ):
+        """
+        Fixed-capacity buffer of token vectors that decorrelates tokens from the same
+        sequence. Token vectors are added in sequence order; once the buffer is full,
+        it is shuffled at token granularity and half of it is emitted as fixed-size
+        batches, leaving the other half to be mixed with newly added tokens.
+
+        Args:
+            d_model: Dimension of the token vectors.
+            capacity_tokens: Number of token vectors the buffer holds.
+            batch_tokens: Number of token vectors per emitted batch.
+            rng: Random number generator used for shuffling.
+            dtype: numpy dtype the buffer is held in.
+        """
+        if capacity_tokens < 2 * batch_tokens:
+            raise ValueError("capacity_tokens must be at least 2 * batch_tokens")
+        self.buffer = np.empty((capacity_tokens, d_model), dtype=dtype)
+        self.capacity_tokens = capacity_tokens
+        self.batch_tokens = batch_tokens
+        self.rng = rng
+        self.size = 0
+
+    def _emit(self, num_batches: int) -> Iterator[torch.Tensor]:
+        perm = self.rng.permutation(self.size)
+        num_out = num_batches * self.batch_tokens
+        for start in range(0, num_out, self.batch_tokens):
+            batch = self.buffer[perm[start : start + self.batch_tokens]]
+            yield torch.from_numpy(batch.astype(np.float32))
+        # Compact the tokens that weren't emitted to the front of the buffer
+        remaining = np.sort(perm[num_out:])
+        self.buffer[: len(remaining)] = self.buffer[remaining]
+        self.size = len(remaining)
+
+    def add(self, acts: np.ndarray) -> Iterator[torch.Tensor]:
+        """
+        Add (num_tokens, d_model) token vectors, yielding (batch_tokens, d_model)
+        float32 batches whenever the buffer fills up.
+        """
+        start = 0
+        while start < len(acts):
+            n = min(len(acts) - start, self.capacity_tokens - self.size)
+            self.buffer[self.size : self.size + n] = acts[start : start + n]
+            self.size += n
+            start += n
+            if self.size == self.capacity_tokens:
+                yield from self._emit(self.capacity_tokens // 2 // self.batch_tokens)
+
+    def flush(self, drop_last: bool = True) -> Iterator[torch.Tensor]:
+        """
+        Emit everything left in the buffer. The final partial batch is dropped unless
+        `drop_last` is False so that every batch has exactly `batch_tokens` tokens.
+        """
+        yield from self._emit(self.size // self.batch_tokens)
+        if not drop_last and self.size > 0:
+            yield torch.from_numpy(self.buffer[: self.size].astype(np.float32))
+        self.size = 0
+
+
+def get_split_id() -> tuple[int, int]:
+    """
+    Returns the id of the split of the current DDP rank and DataLoader worker and the
+    number of splits.
+    """
+    rank, world_size = 0, 1
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+    worker_info = get_worker_info()
+    worker_id, num_workers = (
+        (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+    )
+    return rank * num_workers + worker_id, world_size * num_workers
+
+
+def get_worker_split(num_items: int) -> list[int]:
+    """
+    Split item indices, e.g. shards or sequences, across DDP ranks and DataLoader
+    workers so that each item is read by exactly one worker.
+    """
+    split_id, num_splits = get_split_id()
+    return [i for i in range(num_items) if i % num_splits == split_id]
+
+
+def get_num_batches_per_split(item_num_tokens: list[int], batch_tokens: int) -> int:
+    """
+    Returns the number of full batches that every split of `get_worker_split` can
+    yield, given the number of tokens of each item, i.e. that of the split with the
+    fewest tokens. Under DDP, every rank must run the same number of steps; a rank
+    that runs out of batches first stops while the others block in the gradient
+    all-reduce.
+    """
+    _, num_splits = get_split_id()
+    return min(
+        sum(item_num_tokens[split_id::num_splits]) // batch_tokens for split_id in range(num_splits)
+    )
+
+
+class ActivationStoreDataset(IterableDataset):
+    def __init__(
+        self,
+        store_dir: str,
+        batch_tokens: int,
+        shuffle_buffer_tokens: int,
+        read_chunk_seqs: int = 64,
+        exclude_special_tokens: bool = True,
+        seed: Optional[int] = None,
+    ):
+        """
+        Iterable dataset of fixed-size, token-level shuffled batches of pre-extracted
+        activations. Each epoch visits the shards in a random order, reads them in
+        randomly ordered chunks of whole sequences and passes the tokens through a
+        `TokenShuffleBuffer`.
+
+        Args:
+            store_dir: Directory of the activation store.
+            batch_tokens: Number of token vectors per batch.
+            shuffle_buffer_tokens: Capacity of the shuffle buffer in tokens.
+            read_chunk_seqs: Number of consecutive sequences read from a shard at once.
+            exclude_special_tokens: Whether to skip the BOS and EOS token of each
+                sequence so that only real residue tokens are used.
+            seed: Seed for the shuffling. Defaults to torch's seed so that each epoch
+                and each DataLoader worker is shuffled differently.
+
+        Every DDP rank and DataLoader worker yields the same number of batches, that
+        of the one with the fewest tokens, and drops the rest of its tokens. Shards are
+        split across them whole, or by read chunk if there are fewer shards than ranks
+        times workers.
+        """
+        self.store_dir = store_dir
+        self.batch_tokens = batch_tokens
+        self.shuffle_buffer_tokens = shuffle_buffer_tokens
+        self.read_chunk_seqs = read_chunk_seqs
+        self.exclude_special_tokens = exclude_special_tokens
+        self.seed = seed
+        self._num_iters = 0
+
+    def _read_chunks(self, num_seqs: int) -> list[tuple[int, int]]:
+        return [
+            (start, min(start + self.read_chunk_seqs, num_seqs))
+            for start in range(0, num_seqs, self.read_chunk_seqs)
+        ]
+
+    def _num_tokens(self, offsets: np.ndarray, start: int, end: int) -> int:
+        num_tokens = int(offsets[end] - offsets[start])
+        return num_tokens - (2 * (end - start) if self.exclude_special_tokens else 0)
+
+    def __iter__(self) -> Iterator[torch.Tensor]:
+        store = ActivationStore(self.store_dir)
+        _, num_splits = get_split_id()
+        # Each item is a shard and the read chunks of it to visit
+        if len(store) >= num_splits:
+            items = [
+                (shard_idx, self._read_chunks(shard["num_seqs"]))
+                for shard_idx, shard in enumerate(store.shards)
+            ]
+            item_num_tokens = [
+                shard["num_tokens"] - (2 * shard["num_seqs"] if self.exclude_special_tokens else 0)
+                for shard in store.shards
+            ]
+        else:
+            # Too few shards for every worker to get one, so split the read chunks instead
+            items, item_num_tokens = [], []
+            for shard_idx, shard in enumerate(store.shards):
+                offsets = store.offsets(shard_idx)
+                for start, end in self._read_chunks(shard["num_seqs"]):
+                    items.append((shard_idx, [(start, end)]))
+                    item_num_tokens.append(self._num_tokens(offsets, start, end))
+            if len(items) < num_splits:
+                raise ValueError(
+                    f"The store has {len(items)} read chunks of {self.read_chunk_seqs} "
+                    f"sequences, fewer than the {num_splits} DDP ranks times DataLoader "
+                    "workers reading it; lower num_workers or read_chunk_seqs"
+                )
+
+        num_batches = get_num_batches_per_split(item_num_tokens, self.batch_tokens)
+        items = [items[i] for i in get_worker_split(len(items))]
+        yield from itertools.islice(self._iter_batches(store, items), num_batches)
+
+    def _iter_batches(
+        self, store: ActivationStore, items: list[tuple[int, list[tuple[int, int]]]]
+    ) -> Iterator[torch.Tensor]:
+        seed = torch.initial_seed() if self.seed is None else self.seed
+        rng = np.random.default_rng([seed % 2**32, self._num_iters])
+        self._num_iters += 1
+
+        buffer = TokenShuffleBuffer(
+            store.d_model, self.shuffle_buffer_tokens, self.batch_tokens, rng, store.dtype.name
+        )
+        for item_idx in rng.permutation(len(items)):
+            shard_idx, chunks = items[item_idx]
+            acts = store.shard(shard_idx)
+            offsets = store.offsets(shard_idx)
+            for chunk_idx in rng.permutation(len(chunks)):
+                chunk_start, chunk_end = chunks[chunk_idx]
+                chunk = acts[offsets[chunk_start] : offsets[chunk_end]]
+                if self.exclude_special_tokens:
+                    chunk_offsets = offsets[chunk_start : chunk_end + 1] - offsets[chunk_start]
+                    is_residue = np.ones(len(chunk), dtype=bool)
+                    is_residue[chunk_offsets[:-1]] = False  # BOS
+                    is_residue[chunk_offsets[1:] - 1] = False  # EOS
+                    chunk = chunk[is_residue]
+                yield from buffer.add(chunk)
+        yield from buffer.flush()
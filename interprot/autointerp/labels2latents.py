@@ -1,6 +1,6 @@
 import csv
 import math
-from typing import Callable, TextIO
+from typing import Callable, Iterable, Optional, TextIO
 
 import click
 import numpy as np
@@ -8,19 +8,20 @@ import torch
 from tqdm import tqdm
 from transformers import AutoTokenizer, EsmModel
 
+from interprot.activation_cache import ActivationCache
 from interprot.sae_model import SparseAutoencoder
-from interprot.utils import get_layer_activations
+from interprot.utils import iter_layer_activations, truncate_plm
 
 
 def compute_scores_matrix(
     sequence_target: list[tuple[str, np.ndarray]],
-    sequence2latents: Callable[[str], torch.Tensor],
+    sequences2latents: Callable[[list[str]], Iterable[torch.Tensor]],
     sae_dim: int,
 ) -> np.ndarray:
     """
     Given a list of tuples like [(MVLSEGEWQL, 0001111110), ...] and a function
-    that can convert a protein sequence to SAE latents, returns a matrix of
-    scores like this:
+    that can convert a list of protein sequences to their SAE latents, returns a
+    matrix of scores like this:
 
     +----------------+----------------+----------------+----------------+
     | Sequence       | SAE Dim 1      | SAE Dim 2      | ...            |
@@ -50,12 +51,12 @@ def compute_scores_matrix(
     """
     scores = np.zeros((len(sequence_target), sae_dim))
 
-    for seq_idx, (sequence, target) in tqdm(
-        enumerate(sequence_target),
+    all_sae_acts = sequences2latents([sequence for sequence, _ in sequence_target])
+    for seq_idx, ((_, target), sae_acts) in tqdm(
+        enumerate(zip(sequence_target, all_sae_acts)),
         total=len(sequence_target),
         desc="Processing sequences",
     ):
-        sae_acts = sequence2latents(sequence)
         for dim_idx in range(sae_dim):
             hidden_dim_acts = sae_acts[:, dim_idx]
 
@@ -108,6 +109,18 @@ def compute_scores_matrix(
     help="Path to save the output CSV file",
 )
 @click.option("--max-seqs", type=int, default=100, help="Maximum number of sequences to process")
+@click.option(
+    "--activation-cache-dir",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Directory of a persistent pLM activation cache shared across runs",
+)
+@click.option(
+    "--activation-cache-max-gb",
+    type=float,
+    default=100.0,
+    help="Size cap of the activation cache in GB",
+)
 def labels2latents(
     labels_csv: TextIO,
     sae_checkpoint: str,
@@ -116,6 +129,8 @@ def labels2latents(
     sae_dim: int,
     out_path: str,
     max_seqs: int,
+    activation_cache_dir: Optional[str],
+    activation_cache_max_gb: float,
 ):
     """
     Takes in a labels CSV file like this
@@ -147,23 +162,29 @@ def labels2latents(
 
     tokenizer = AutoTokenizer.from_pretrained("facebook/esm2_t33_650M_UR50D")
     plm = EsmModel.from_pretrained("facebook/esm2_t33_650M_UR50D").to(device)
-
-    def sequence2latents(sequence: str) -> torch.Tensor:
+    truncate_plm(plm, plm_layer)
+    activation_cache = (
+        ActivationCache(activation_cache_dir, max_size_gb=activation_cache_max_gb)
+        if activation_cache_dir
+        else None
+    )
+
+    def sequences2latents(sequences: list[str]) -> Iterable[torch.Tensor]:
         """
-        Get the SAE latents for a given sequence.
+        Get the SAE latents for each of the given sequences.
         """
-        esm_acts = get_layer_activations(
+        for esm_acts in iter_layer_activations(
             tokenizer=tokenizer,
             plm=plm,
-            seqs=[sequence],
+            seqs=sequences,
             layer=plm_layer,
             device=device,
-        )[0]
-        sae_acts = sae_model.get_acts(esm_acts)
-        sae_acts = sae_acts[1:-1]  # Trim BoS & EoS tokens
-        return sae_acts
+            cache=activation_cache,
+        ):
+            # BoS & EoS tokens are already trimmed
+            yield sae_model.get_acts(esm_acts)
 
-    scores = compute_scores_matrix(sequence_target, sequence2latents, sae_dim)
+    scores = compute_scores_matrix(sequence_target, sequences2latents, sae_dim)
 
     # Get the mean score for each SAE dimension, sort in descending order.
     mean_scores = scores.mean(axis=0)
@@ -1,7 +1,18 @@
+import itertools
+
+import numpy as np
 import polars as pr
 import pytorch_lightning as pl
 import torch
-from torch.utils.data import Dataset
+from activation_store import (
+    SPLIT_NAMES,
+    ActivationStoreDataset,
+    TokenShuffleBuffer,
+    get_num_batches_per_split,
+    get_worker_split,
+    split_path,
+)
+from torch.utils.data import Dataset, IterableDataset
 from utils import train_val_test_split
 import multiprocessing
 
@@ -18,13 +29,75 @@ class PolarsDataset(Dataset):
         return {"Sequence": row["sequence"], "Entry": row["id"]}
 
 
+class BufferedActivationDataset(IterableDataset):
+    """
+    Iterable dataset that runs shuffled batches of sequences through the pLM and
+    passes their token activations through a `TokenShuffleBuffer`, yielding fixed-size
+    (batch_tokens, D_MODEL) batches of token-level shuffled activations.
+
+    `get_activations` takes a list of sequences and returns a list of their unpadded
+    (num_tokens, D_MODEL) activations. It runs the pLM, so this dataset must be
+    loaded in the main process. Every DDP rank yields the same number of batches.
+    The shuffle buffer holds the activations in `dtype`, float32 by default so that
+    the SAE trains on the same precision as it does on sequences.
+    """
+
+    def __init__(
+        self,
+        df,
+        get_activations,
+        seq_batch_size,
+        batch_tokens,
+        shuffle_buffer_tokens,
+        dtype="float32",
+    ):
+        self.df = df
+        self.get_activations = get_activations
+        self.seq_batch_size = seq_batch_size
+        self.batch_tokens = batch_tokens
+        self.shuffle_buffer_tokens = shuffle_buffer_tokens
+        self.dtype = dtype
+        self._num_iters = 0
+
+    def __iter__(self):
+        # get_activations returns the residue tokens of each sequence
+        seq_num_tokens = self.df["sequence"].str.len_chars().to_list()
+        num_batches = get_num_batches_per_split(seq_num_tokens, self.batch_tokens)
+        yield from itertools.islice(self._iter_batches(), num_batches)
+
+    def _iter_batches(self):
+        rng = np.random.default_rng([torch.initial_seed() % 2**32, self._num_iters])
+        self._num_iters += 1
+
+        seqs = self.df["sequence"]
+        seq_ids = rng.permutation(get_worker_split(len(seqs)))
+        buffer = None
+        for start in range(0, len(seq_ids), self.seq_batch_size):
+            batch_seqs = seqs[seq_ids[start : start + self.seq_batch_size]].to_list()
+            for acts in self.get_activations(batch_seqs):
+                acts = acts.float().cpu().numpy()
+                if buffer is None:
+                    buffer = TokenShuffleBuffer(
+                        acts.shape[-1],
+                        self.shuffle_buffer_tokens,
+                        self.batch_tokens,
+                        rng,
+                        self.dtype,
+                    )
+                yield from buffer.add(acts)
+        if buffer is not None:
+            yield from buffer.flush()
+
+
 # Data Module
 class SequenceDataModule(pl.LightningDataModule):
     def __init__(self, data_path, batch_size, num_workers=None):
         super().__init__()
         self.data_path = data_path
         self.batch_size = batch_size
-        self.num_workers = num_workers if num_workers is not None else multiprocessing.cpu_count() - 1
+        self.num_workers = (
+            num_workers if num_workers is not None else multiprocessing.cpu_count() - 1
+        )
 
     def setup(self, stage=None):
         df = pr.read_parquet(self.data_path)
@@ -35,19 +108,93 @@ class SequenceDataModule(pl.LightningDataModule):
             PolarsDataset(self.train_data),
             batch_size=self.batch_size,
             shuffle=True,
-            num_workers=self.num_workers
+            num_workers=self.num_workers,
         )
 
     def val_dataloader(self):
         return torch.utils.data.DataLoader(
-            PolarsDataset(self.val_data),
-            batch_size=self.batch_size,
-            num_workers=self.num_workers
+            PolarsDataset(self.val_data), batch_size=self.batch_size, num_workers=self.num_workers
         )
 
     def test_dataloader(self):
         return torch.utils.data.DataLoader(
-            PolarsDataset(self.test_data),
-            batch_size=self.batch_size,
-            num_workers=self.num_workers
+            PolarsDataset(self.test_data), batch_size=self.batch_size, num_workers=self.num_workers
+        )
+
+
+class ActivationDataModule(SequenceDataModule):
+    """
+    Trains on pre-extracted activations from an activation store (see
+    `extract_activations.py`) instead of running the pLM in every training step.
+    Each training batch is a (token_batch_size, D_MODEL) tensor of token-level
+    shuffled activations. Validation and test still run on sequences because they need
+    the full pLM to compute cross-entropy metrics. They use the validation and test
+    split saved with the store, whose training split is the one that was extracted.
+    """
+
+    def __init__(
+        self,
+        activations_dir,
+        batch_size,
+        token_batch_size,
+        shuffle_buffer_tokens,
+        num_workers=None,
+    ):
+        super().__init__(split_path(activations_dir, "train"), batch_size, num_workers)
+        self.activations_dir = activations_dir
+        self.token_batch_size = token_batch_size
+        self.shuffle_buffer_tokens = shuffle_buffer_tokens
+
+    def setup(self, stage=None):
+        self.train_data, self.val_data, self.test_data = (
+            pr.read_parquet(split_path(self.activations_dir, split)) for split in SPLIT_NAMES
+        )
+
+    def train_dataloader(self):
+        return torch.utils.data.DataLoader(
+            ActivationStoreDataset(
+                self.activations_dir, self.token_batch_size, self.shuffle_buffer_tokens
+            ),
+            # The dataset already yields batches
+            batch_size=None,
+            num_workers=self.num_workers,
+            pin_memory=True,
+        )
+
+
+class BufferedSequenceDataModule(SequenceDataModule):
+    """
+    Same as `SequenceDataModule`, except that each training batch is a
+    (token_batch_size, D_MODEL) tensor of token-level shuffled activations computed
+    on the fly by `get_activations` (see `BufferedActivationDataset`). This
+    decorrelates the tokens within a batch and keeps the batch size in tokens fixed.
+    """
+
+    def __init__(
+        self,
+        data_path,
+        batch_size,
+        get_activations,
+        token_batch_size,
+        shuffle_buffer_tokens,
+        num_workers=None,
+    ):
+        super().__init__(data_path, batch_size, num_workers)
+        self.get_activations = get_activations
+        self.token_batch_size = token_batch_size
+        self.shuffle_buffer_tokens = shuffle_buffer_tokens
+
+    def train_dataloader(self):
+        return torch.utils.data.DataLoader(
+            BufferedActivationDataset(
+                self.train_data,
+                self.get_activations,
+                self.batch_size,
+                self.token_batch_size,
+                self.shuffle_buffer_tokens,
+            ),
+            # The dataset already yields batches, and it runs the pLM so it has to
+            # stay in the main process
+            batch_size=None,
+            num_workers=0,
         )
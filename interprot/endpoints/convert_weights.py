@@ -0,0 +1,65 @@
+"""
+Convert ESM2 and SAE checkpoints into weight files the endpoint handlers can
+memory-map at startup instead of unpickling and renaming them.
+
+Each input file is written next to itself as `<name>.mmap.pt`: a plain state dict,
+with keys already renamed to the handlers' `ESM2Model` / `SparseAutoencoder`
+parameter names, that `torch.load(..., mmap=True)` maps without copying.
+
+Usage:
+    python convert_weights.py /weights/esm2_t33_650M_UR50D.pt /weights/<sae>.ckpt ...
+"""
+
+import argparse
+import os
+
+import torch
+
+MMAP_SUFFIX = ".mmap.pt"
+
+
+def convert_esm_state_dict(model_data: dict) -> dict:
+    """
+    Same key renaming as `ESM2Model.load_esm_ckpt`.
+    """
+    state_dict = {}
+    for k in model_data:
+        if "lm_head" in k:
+            state_dict[k.replace("encoder.", "")] = model_data[k]
+        else:
+            state_dict[k.replace("encoder.sentence_encoder.", "")] = model_data[k]
+    return state_dict
+
+
+def convert_sae_state_dict(ckpt: dict) -> dict:
+    """
+    Accepts both plain SAE state dicts and Lightning checkpoints.
+    """
+    if "state_dict" in ckpt:
+        return {k.replace("sae_model.", ""): v for k, v in ckpt["state_dict"].items()}
+    return ckpt
+
+
+def convert(path: str) -> str:
+    # The checkpoints are our own, and Lightning checkpoints pickle more than tensors
+    ckpt = torch.load(path, map_location="cpu", weights_only=False)
+    if "model" in ckpt:
+        state_dict = convert_esm_state_dict(ckpt["model"])
+    else:
+        state_dict = convert_sae_state_dict(ckpt)
+    # Contiguous tensors are stored as-is, so they can be mapped without copying
+    state_dict = {k: v.contiguous() for k, v in state_dict.items()}
+
+    output_path = os.path.splitext(path)[0] + MMAP_SUFFIX
+    torch.save(state_dict, output_path)
+    return output_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("checkpoint_files", nargs="+")
+    args = parser.parse_args()
+    for path in args.checkpoint_files:
+        if path.endswith(MMAP_SUFFIX):
+            continue
+        print(f"Converted {path} to {convert(path)}")
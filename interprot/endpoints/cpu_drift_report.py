@@ -0,0 +1,119 @@
+"""
+Report how far the SAE activations of an endpoint's CPU inference profile drift from
+fp32, and how long each profile takes, before serving it from CPU nodes.
+
+Usage:
+    python cpu_drift_report.py --sae-name SAE4096-L24 --sequences seqs.txt --profile int8
+
+`--sequences` is a file with one protein sequence per line. The models are loaded
+from the handler's `WEIGHTS_DIR`, or `--weights-dir` if given.
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import time
+
+import torch
+
+
+def load_handler(handler_path: str):
+    """
+    Import a handler as a module. Its RunPod worker only starts when run as a script.
+    """
+    spec = importlib.util.spec_from_file_location("handler", handler_path)
+    handler = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(handler)
+    return handler
+
+
+def get_sae_acts(registry, sae_name: str, seqs: list[str]) -> tuple[list[torch.Tensor], float]:
+    """
+    Returns the (len(seq), D_HIDDEN) SAE activations of each sequence and the seconds
+    spent computing them, excluding model loading.
+    """
+    esm2_model, sae_model, plm_layer = registry.get(sae_name)
+    all_sae_acts = []
+    start = time.perf_counter()
+    for seq in seqs:
+        with registry.inference_context():
+            _, esm_layer_acts = esm2_model.get_layer_activations(seq, plm_layer)
+            sae_acts = sae_model.get_acts(esm_layer_acts.float()).float()
+        all_sae_acts.append(sae_acts[0, 1 : len(seq) + 1])
+    return all_sae_acts, time.perf_counter() - start
+
+
+def drift_report(
+    ref_sae_acts: list[torch.Tensor], sae_acts: list[torch.Tensor]
+) -> dict[str, float]:
+    """
+    Compare SAE activations against the fp32 reference:
+        max_abs_diff: Largest absolute difference of any activation.
+        rel_l2_error: L2 norm of the differences relative to that of the reference.
+        active_jaccard: Jaccard index of the (token, latent) pairs that are active.
+        max_act_abs_diff: Largest difference of a latent's max activation over a
+            sequence, the value the visualizer ranks and colors by.
+        rounded_mismatch_frac: Fraction of active activations whose value rounded to
+            1 decimal, as returned by the endpoint, differs.
+    """
+    ref = torch.cat(ref_sae_acts)
+    acts = torch.cat(sae_acts)
+    ref_active = ref > 0
+    active = acts > 0
+    either_active = ref_active | active
+    ref_rounded = torch.round(ref[either_active], decimals=1)
+    rounded = torch.round(acts[either_active], decimals=1)
+    max_act_diffs = [
+        (ref_seq_acts.max(dim=0).values - seq_acts.max(dim=0).values).abs().max().item()
+        for ref_seq_acts, seq_acts in zip(ref_sae_acts, sae_acts)
+    ]
+    return {
+        "max_abs_diff": (ref - acts).abs().max().item(),
+        "rel_l2_error": ((ref - acts).norm() / ref.norm()).item(),
+        "active_jaccard": ((ref_active & active).sum() / either_active.sum()).item(),
+        "max_act_abs_diff": max(max_act_diffs),
+        "rounded_mismatch_frac": (ref_rounded != rounded).float().mean().item(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--handler",
+        default=os.path.join(os.path.dirname(__file__), "sae_inference", "handler.py"),
+    )
+    parser.add_argument("--sae-name", required=True)
+    parser.add_argument("--sequences", required=True)
+    parser.add_argument("--profile", choices=["int8", "bf16"], required=True)
+    parser.add_argument("--weights-dir", default=None)
+    parser.add_argument("--num-threads", type=int, default=0)
+    args = parser.parse_args()
+
+    handler = load_handler(args.handler)
+    if args.weights_dir is not None:
+        handler.WEIGHTS_DIR = args.weights_dir
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    with open(args.sequences) as f:
+        seqs = [line.strip() for line in f if line.strip()]
+
+    device = torch.device("cpu")
+    ref_registry = handler.ModelRegistry(handler.SAE_NAME_TO_CHECKPOINT, device)
+    ref_sae_acts, ref_seconds = get_sae_acts(ref_registry, args.sae_name, seqs)
+    del ref_registry
+
+    registry = handler.ModelRegistry(
+        handler.SAE_NAME_TO_CHECKPOINT, device, cpu_profile=args.profile
+    )
+    sae_acts, seconds = get_sae_acts(registry, args.sae_name, seqs)
+
+    report = {
+        "profile": args.profile,
+        "num_seqs": len(seqs),
+        "num_threads": torch.get_num_threads(),
+        "fp32_seconds": ref_seconds,
+        f"{args.profile}_seconds": seconds,
+        **drift_report(ref_sae_acts, sae_acts),
+    }
+    print(json.dumps(report, indent=2))
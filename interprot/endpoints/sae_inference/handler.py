@@ -4,11 +4,14 @@ code like `SparseAutoencoder`. Ideally I think we publish all the SAE stuff as a
 package to pypi and add it as a dependency.
 """
 
+import contextlib
+import hashlib
 import logging
 import math
 import os
 import re
 import traceback
+from collections import OrderedDict
 
 import esm
 import pytorch_lightning as pl
@@ -26,6 +29,57 @@ SAE_NAME_TO_CHECKPOINT = {
     "SAE4096-L24": "esm2_plm1280_l24_sae4096_100Kseqs.pt",
     "SAE4096-L24-ab": "esm2_plm1280_l24_sae4096_k128_auxk512_antibody_seqs.ckpt",
 }
+# ESM2 architecture and weights file of each pLM dimension
+PLM_DIM_TO_ESM2 = {
+    1280: {"num_layers": 33, "attention_heads": 20, "weights": "esm2_t33_650M_UR50D.pt"},
+}
+# Token budget of each length-bucketed ESM batch, including padding and BOS/EOS tokens
+MAX_TOKENS_PER_BATCH = 16384
+# Size cap of the in-process result cache
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("SAE_ACTS_CACHE_MAX_MB", 2048)) * 1024**2
+# CPU inference profile, used when no GPU is available: "fp32", "int8" for dynamic
+# int8 quantization of the ESM2 and SAE encoder linears, or "bf16" for bfloat16 autocast
+CPU_PROFILES = ("fp32", "int8", "bf16")
+CPU_PROFILE = os.environ.get("CPU_PROFILE", "fp32")
+# Number of intra-op CPU threads; 0 keeps the PyTorch default
+CPU_NUM_THREADS = int(os.environ.get("CPU_NUM_THREADS", 0))
+
+
+class LRUCache:
+    def __init__(self, max_bytes: int):
+        """
+        In-process least-recently-used cache of handler results. Entries are evicted
+        once their total size exceeds `max_bytes`.
+        """
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, nbytes: int) -> None:
+        if nbytes > self.max_bytes:
+            return
+        if key in self._entries:
+            self.size_bytes -= self._entries.pop(key)[1]
+        self._entries[key] = (value, nbytes)
+        self.size_bytes += nbytes
+        while self.size_bytes > self.max_bytes:
+            _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+            self.size_bytes -= evicted_nbytes
+
+
+def seq_hash(seq: str) -> str:
+    return hashlib.sha256(seq.encode()).hexdigest()
 
 
 class SparseAutoencoder(nn.Module):
@@ -73,6 +127,9 @@ class SparseAutoencoder(nn.Module):
         self.w_dec.data = self.w_enc.data.T.clone()
         self.w_dec.data /= self.w_dec.data.norm(dim=0)
 
+        # Quantized encoder set by `quantize_encoder`
+        self.enc = None
+
         # Initialize dead neuron tracking. For each hidden dimension, save the
         # index of the example at which it was last activated.
         self.register_buffer("stats_last_nonzero", torch.zeros(d_hidden, dtype=torch.long))
@@ -240,7 +297,7 @@ class SparseAutoencoder(nn.Module):
         """
         x, _, _ = self.LN(x)
         x = x - self.b_pre
-        pre_acts = x @ self.w_enc + self.b_enc
+        pre_acts = self.encode_pre_acts(x)
         latents = self.topK_activation(pre_acts, self.k)
         return latents
 
@@ -248,9 +305,27 @@ class SparseAutoencoder(nn.Module):
     def encode(self, x: torch.Tensor) -> torch.Tensor:
         x, mu, std = self.LN(x)
         x = x - self.b_pre
-        acts = x @ self.w_enc + self.b_enc
+        acts = self.encode_pre_acts(x)
         return acts, mu, std
 
+    def encode_pre_acts(self, x: torch.Tensor) -> torch.Tensor:
+        if self.enc is not None:
+            return self.enc(x)
+        return x @ self.w_enc + self.b_enc
+
+    @torch.no_grad()
+    def quantize_encoder(self) -> None:
+        """
+        Use a dynamically int8-quantized copy of the encoder in `get_acts` and
+        `encode`, for CPU inference. The decoder stays in full precision.
+        """
+        enc = nn.Linear(self.d_model, self.d_hidden, device=self.w_enc.device)
+        enc.weight.copy_(self.w_enc.T)
+        enc.bias.copy_(self.b_enc)
+        self.enc = torch.ao.quantization.quantize_dynamic(
+            nn.Sequential(enc), {nn.Linear}, dtype=torch.qint8
+        )[0]
+
     @torch.no_grad()
     def decode(self, acts: torch.Tensor, mu: torch.Tensor, std: torch.Tensor) -> torch.Tensor:
         latents = self.topK_activation(acts, self.k)
@@ -331,16 +406,43 @@ class ESM2Model(pl.LightningModule):
         else:
             tokens = input
 
+        # Mask out padding so that batched sequences don't attend to each other's
+        # padding, same as the original ESM2 forward pass.
+        padding_mask = self.get_padding_mask(tokens)
         x = self.embed_scale * self.embed_tokens(tokens)
+        if padding_mask is not None:
+            x = x * (1 - padding_mask.unsqueeze(-1).type_as(x))
         x = x.transpose(0, 1)  # (B, T, E) => (T, B, E)
         for _, layer in enumerate(self.layers[:layer_idx]):
             x, attn = layer(
                 x,
-                self_attn_padding_mask=None,
+                self_attn_padding_mask=padding_mask,
                 need_head_weights=False,
             )
         return tokens, x.transpose(0, 1)
 
+    def truncate(self, layer_idx):
+        """
+        Free the memory of the layers after `layer_idx`, the final layer norm and the
+        LM head. `get_layer_activations` already stops at `layer_idx`, so use this
+        when only activations are needed; `get_sequence` can't be used afterwards.
+        """
+        self.layers = self.layers[:layer_idx]
+        self.num_layers = layer_idx
+        self.emb_layer_norm_after = None
+        self.lm_head = None
+        return self
+
+    def get_padding_mask(self, tokens):
+        """
+        Returns a (B, T) boolean tensor that is True at padding positions, or None if
+        there is no padding.
+        """
+        padding_mask = tokens.eq(self.padding_idx)
+        if not padding_mask.any():
+            return None
+        return padding_mask
+
     def get_sequence(self, x, layer_idx):
         x = x.transpose(0, 1)  # (B, T, E) => (T, B, E)
         for _, layer in enumerate(self.layers[layer_idx:]):
@@ -355,85 +457,254 @@ class ESM2Model(pl.LightningModule):
         return logits
 
 
-def load_models():
-    sae_name_to_model = {}
-    for sae_name, sae_checkpoint in SAE_NAME_TO_CHECKPOINT.items():
-        pattern = r"plm(\d+).*?l(\d+).*?sae(\d+)"
-        matches = re.search(pattern, sae_checkpoint)
-        if matches:
-            plm_dim, _, sae_dim = map(int, matches.groups())
-        else:
-            raise ValueError("Checkpoint file must be named in the format plm<n>_l<n>_sae<n>")
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-        # Load ESM2 model
-        logger.info(f"Loading ESM2 model with plm_dim={plm_dim}")
-        alphabet = esm.data.Alphabet.from_architecture("ESM-1b")
-        esm2_model = ESM2Model(
-            num_layers=33,
-            embed_dim=plm_dim,
-            attention_heads=20,
-            alphabet=alphabet,
-            token_dropout=False,
+def parse_checkpoint_file_name(checkpoint_file: str) -> tuple[int, int, int]:
+    """
+    Returns the (plm_dim, plm_layer, sae_dim) encoded in a checkpoint file name.
+    """
+    pattern = r"plm(\d+).*?l(\d+).*?sae(\d+)"
+    matches = re.search(pattern, checkpoint_file)
+    if not matches:
+        raise ValueError("Checkpoint file must be named in the format plm<n>_l<n>_sae<n>")
+    plm_dim, plm_layer, sae_dim = map(int, matches.groups())
+    return plm_dim, plm_layer, sae_dim
+
+
+def load_mmap_state_dict(weights_path: str) -> dict | None:
+    """
+    Returns the memory-mapped state dict written next to `weights_path` by
+    `convert_weights.py`, or None if the weights were not converted.
+    """
+    mmap_path = os.path.splitext(weights_path)[0] + ".mmap.pt"
+    if not os.path.exists(mmap_path):
+        return None
+    logger.info(f"Memory-mapping {mmap_path}")
+    return torch.load(mmap_path, map_location="cpu", mmap=True, weights_only=True)
+
+
+class ModelRegistry:
+    def __init__(
+        self,
+        sae_name_to_checkpoint: dict[str, str],
+        device: torch.device,
+        cpu_profile: str = "fp32",
+    ):
+        """
+        Loads the ESM2 backbone once per (plm_dim, layer), keeping only the layers up
+        to the one the SAEs read from, and each SAE lazily on the first request for
+        it. All SAEs on the same backbone share it, so it is only loaded once no
+        matter how many SAEs are served.
+
+        On CPU, `cpu_profile` selects one of `CPU_PROFILES`: "int8" quantizes the
+        linears of every transformer layer and the SAE encoder on load, and "bf16"
+        runs inference under bfloat16 autocast. It is ignored on GPU.
+        """
+        if cpu_profile not in CPU_PROFILES:
+            raise ValueError(f"CPU profile must be one of {CPU_PROFILES}, got {cpu_profile}")
+        self.sae_name_to_checkpoint = sae_name_to_checkpoint
+        self.device = device
+        self.cpu_profile = cpu_profile if device.type == "cpu" else "fp32"
+        self._backbones = {}
+        self._saes = {}
+
+    def get_backbone(self, plm_dim: int, plm_layer: int) -> ESM2Model:
+        key = (plm_dim, plm_layer)
+        if key not in self._backbones:
+            logger.info(f"Loading ESM2 model with plm_dim={plm_dim} up to layer {plm_layer}")
+            config = PLM_DIM_TO_ESM2[plm_dim]
+            esm2_weights = os.path.join(WEIGHTS_DIR, config["weights"])
+            state_dict = load_mmap_state_dict(esm2_weights)
+            # With converted weights, skip the random init by building the model on the
+            # meta device; the parameters are then replaced by the mapped weights
+            with torch.device("meta" if state_dict is not None else "cpu"):
+                esm2_model = ESM2Model(
+                    num_layers=config["num_layers"],
+                    embed_dim=plm_dim,
+                    attention_heads=config["attention_heads"],
+                    alphabet=esm.data.Alphabet.from_architecture("ESM-1b"),
+                    token_dropout=False,
+                )
+            if state_dict is not None:
+                esm2_model.load_state_dict(state_dict, assign=True)
+            else:
+                esm2_model.load_esm_ckpt(esm2_weights)
+            esm2_model = esm2_model.truncate(plm_layer).to(self.device).eval()
+            if self.cpu_profile == "int8":
+                for layer in esm2_model.layers:
+                    torch.ao.quantization.quantize_dynamic(
+                        layer, {nn.Linear}, dtype=torch.qint8, inplace=True
+                    )
+            self._backbones[key] = esm2_model
+        return self._backbones[key]
+
+    def get(self, sae_name: str) -> tuple[ESM2Model, SparseAutoencoder, int]:
+        """
+        Returns the backbone, the SAE and the pLM layer the SAE reads from, loading
+        them on first use.
+        """
+        if sae_name not in self._saes:
+            sae_checkpoint = self.sae_name_to_checkpoint[sae_name]
+            plm_dim, plm_layer, sae_dim = parse_checkpoint_file_name(sae_checkpoint)
+            esm2_model = self.get_backbone(plm_dim, plm_layer)
+
+            logger.info(f"Loading SAE model {sae_name}")
+            sae_weights = os.path.join(WEIGHTS_DIR, sae_checkpoint)
+            state_dict = load_mmap_state_dict(sae_weights)
+            with torch.device("meta" if state_dict is not None else "cpu"):
+                sae_model = SparseAutoencoder(plm_dim, sae_dim)
+            if state_dict is not None:
+                sae_model.load_state_dict(state_dict, assign=True)
+            else:
+                # Support different checkpoint formats
+                try:
+                    sae_model.load_state_dict(torch.load(sae_weights, map_location="cpu"))
+                except Exception:
+                    sae_model.load_state_dict(
+                        {
+                            k.replace("sae_model.", ""): v
+                            for k, v in torch.load(sae_weights, map_location="cpu")[
+                                "state_dict"
+                            ].items()
+                        }
+                    )
+            sae_model = sae_model.to(self.device)
+            if self.cpu_profile == "int8":
+                sae_model.quantize_encoder()
+            self._saes[sae_name] = (esm2_model, sae_model, plm_layer)
+        return self._saes[sae_name]
+
+    @contextlib.contextmanager
+    def inference_context(self):
+        """
+        Context to run the models in: no autograd and, under the "bf16" CPU profile,
+        bfloat16 autocast. Cast outputs back with `.float()`.
+        """
+        autocast = (
+            torch.autocast("cpu", dtype=torch.bfloat16)
+            if self.cpu_profile == "bf16"
+            else contextlib.nullcontext()
         )
-        esm2_weights = os.path.join(WEIGHTS_DIR, "esm2_t33_650M_UR50D.pt")
-        esm2_model.load_esm_ckpt(esm2_weights)
-        esm2_model = esm2_model.to(device)
-
-        # Load SAE models
-        logger.info(f"Loading SAE model {sae_name}")
-        sae_model = SparseAutoencoder(plm_dim, sae_dim).to(device)
-        sae_weights = os.path.join(WEIGHTS_DIR, sae_checkpoint)
-        # Support different checkpoint formats
-        try:
-            sae_model.load_state_dict(torch.load(sae_weights))
-        except Exception:
-            sae_model.load_state_dict(
-                {
-                    k.replace("sae_model.", ""): v
-                    for k, v in torch.load(sae_weights)["state_dict"].items()
-                }
+        with torch.no_grad(), autocast:
+            yield
+
+
+def make_length_batches(lengths: list[int], max_tokens_per_batch: int) -> list[list[int]]:
+    """
+    Group sequence indices into batches of similar length so that each padded batch,
+    i.e. `len(batch) * (max length in batch + 2)`, stays within `max_tokens_per_batch`.
+    A sequence that exceeds the budget on its own gets a batch of its own.
+    """
+    batches = []
+    batch: list[int] = []
+    for idx in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        # Sorted ascending, so the current sequence is the longest in the batch
+        if batch and (len(batch) + 1) * (lengths[idx] + 2) > max_tokens_per_batch:
+            batches.append(batch)
+            batch = []
+        batch.append(idx)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def get_sae_acts(seqs: list[str], sae_name: str) -> list[torch.Tensor]:
+    """
+    Look up the SAE activations of the sequences in the result cache and run the
+    missing ones through ESM and the SAE in padded, length-bucketed batches.
+
+    Returns:
+        A list of (len(seq), D_HIDDEN) SAE activations in the order of `seqs`, with
+        BOS, EOS and padding tokens removed.
+    """
+    all_sae_acts = [None] * len(seqs)
+    missing = []
+    for i, seq in enumerate(seqs):
+        cached = sae_acts_cache.get((sae_name, seq_hash(seq)))
+        if cached is None:
+            missing.append(i)
+        else:
+            all_sae_acts[i] = cached.to_dense()
+    logger.info(
+        f"sae_acts_cache: {len(seqs) - len(missing)}/{len(seqs)} hits in request, "
+        f"{sae_acts_cache.hits} hits, {sae_acts_cache.misses} misses, "
+        f"{sae_acts_cache.size_bytes / 1024**2:.1f}MB"
+    )
+
+    if missing:
+        esm2_model, sae_model, plm_layer = model_registry.get(sae_name)
+    lengths = [len(seqs[i]) for i in missing]
+    for batch in make_length_batches(lengths, MAX_TOKENS_PER_BATCH):
+        batch_seqs = [seqs[missing[j]] for j in batch]
+        with model_registry.inference_context():
+            _, esm_layer_acts = esm2_model.get_layer_activations(batch_seqs, plm_layer)
+            sae_acts = sae_model.get_acts(esm_layer_acts.float()).float()
+        logger.info(f"sae_acts: {sae_acts.shape}")
+        for j, seq, seq_sae_acts in zip(batch, batch_seqs, sae_acts):
+            seq_sae_acts = seq_sae_acts[1 : len(seq) + 1]
+            all_sae_acts[missing[j]] = seq_sae_acts
+            # Top-k activations are sparse, so cache them as a sparse tensor
+            sparse_acts = seq_sae_acts.cpu().to_sparse()
+            nbytes = (
+                sparse_acts.values().nelement() * sparse_acts.values().element_size()
+                + sparse_acts.indices().nelement() * sparse_acts.indices().element_size()
             )
-        sae_name_to_model[sae_name] = sae_model
-
-    logger.info("Models loaded successfully")
-    return esm2_model, sae_name_to_model
+            sae_acts_cache.put((sae_name, seq_hash(seq)), sparse_acts, nbytes)
+    return all_sae_acts
+
+
+def format_sae_acts(sae_acts: torch.Tensor, dim: int | None) -> dict:
+    """
+    Format the (len(seq), D_HIDDEN) SAE activations of a sequence for the response:
+    the activations of `dim` if given, otherwise those of all active dims ordered by
+    decreasing max activation.
+    """
+    data = {}
+    if dim is not None:
+        sae_dim_acts = sae_acts[:, dim].cpu().numpy()
+        data["tokens_acts_list"] = [round(float(act), 1) for act in sae_dim_acts]
+    else:
+        max_acts, _ = torch.max(sae_acts, dim=0)
+        sorted_dims = torch.argsort(max_acts, descending=True)
+        active_dims = sorted_dims[max_acts[sorted_dims] > 0]
+        sae_acts_by_active_dim = sae_acts[:, active_dims].cpu().numpy()
+
+        data["token_acts_list_by_active_dim"] = [
+            {
+                "dim": int(active_dims[dim_idx].item()),
+                "sae_acts": [round(float(act), 1) for act in sae_acts_by_active_dim[:, dim_idx]],
+            }
+            for dim_idx in range(sae_acts_by_active_dim.shape[1])
+        ]
+    return data
 
 
 def handler(event):
+    """
+    Takes either a single `sequence` and optional `dim`, or a list of `sequences`
+    and an optional list of `dims` (one per sequence, each of which may be null). A
+    list of sequences is run in length-bucketed batches and the per-sequence data is
+    returned in order under `results`.
+    """
     logger.info(f"starting handler with event: {event}")
     try:
         input_data = event["input"]
-        seq = input_data["sequence"]
         sae_name = input_data["sae_name"]
-        dim = input_data.get("dim")
-        _, esm_layer_acts = esm2_model.get_layer_activations(seq, 24)
-        esm_layer_acts = esm_layer_acts[0].float()
-        logger.info(f"esm_layer_acts: {esm_layer_acts.shape}")
-
-        sae_model = sae_name_to_model[sae_name]
-        sae_acts = sae_model.get_acts(esm_layer_acts)[1:-1]
-        logger.info(f"sae_acts: {sae_acts.shape}")
-
-        data = {}
-        if dim is not None:
-            sae_dim_acts = sae_acts[:, dim].cpu().numpy()
-            data["tokens_acts_list"] = [round(float(act), 1) for act in sae_dim_acts]
+        if sae_name not in SAE_NAME_TO_CHECKPOINT:
+            raise KeyError(sae_name)
+
+        if "sequences" in input_data:
+            seqs = input_data["sequences"]
+            dims = input_data.get("dims") or [None] * len(seqs)
+            if len(dims) != len(seqs):
+                raise ValueError("dims must have one entry per sequence")
+            all_sae_acts = get_sae_acts(seqs, sae_name)
+            data = {
+                "results": [
+                    format_sae_acts(sae_acts, dim) for sae_acts, dim in zip(all_sae_acts, dims)
+                ]
+            }
         else:
-            max_acts, _ = torch.max(sae_acts, dim=0)
-            sorted_dims = torch.argsort(max_acts, descending=True)
-            active_dims = sorted_dims[max_acts[sorted_dims] > 0]
-            sae_acts_by_active_dim = sae_acts[:, active_dims].cpu().numpy()
-
-            data["token_acts_list_by_active_dim"] = [
-                {
-                    "dim": int(active_dims[dim_idx].item()),
-                    "sae_acts": [
-                        round(float(act), 1) for act in sae_acts_by_active_dim[:, dim_idx]
-                    ],
-                }
-                for dim_idx in range(sae_acts_by_active_dim.shape[1])
-            ]
+            (sae_acts,) = get_sae_acts([input_data["sequence"]], sae_name)
+            data = format_sae_acts(sae_acts, input_data.get("dim"))
 
         return {
             "status": "success",
@@ -444,5 +715,15 @@ def handler(event):
         return {"status": "error", "error": str(e)}
 
 
-esm2_model, sae_name_to_model = load_models()
-runpod.serverless.start({"handler": handler})
+model_registry = ModelRegistry(
+    SAE_NAME_TO_CHECKPOINT,
+    torch.device("cuda" if torch.cuda.is_available() else "cpu"),
+    cpu_profile=CPU_PROFILE,
+)
+# Sparse SAE activations keyed by (sae_name, sequence hash)
+sae_acts_cache = LRUCache(RESULT_CACHE_MAX_BYTES)
+
+if __name__ == "__main__":
+    if CPU_NUM_THREADS > 0:
+        torch.set_num_threads(CPU_NUM_THREADS)
+    runpod.serverless.start({"handler": handler})
@@ -4,11 +4,14 @@ code like `SparseAutoencoder`. Ideally I think we publish all the SAE stuff as a
 package to pypi and add it as a dependency.
 """
 
+import contextlib
+import hashlib
 import logging
 import math
 import os
 import re
 import traceback
+from collections import OrderedDict
 
 import esm
 import pytorch_lightning as pl
@@ -26,6 +29,62 @@ SAE_NAME_TO_CHECKPOINT = {
     "SAE4096-L24": "esm2_plm1280_l24_sae4096_100Kseqs.pt",
     "SAE4096-L24-ab": "esm2_plm1280_l24_sae4096_k128_auxk512_antibody_seqs.ckpt",
 }
+# ESM2 architecture and weights file of each pLM dimension
+PLM_DIM_TO_ESM2 = {
+    1280: {"num_layers": 33, "attention_heads": 20, "weights": "esm2_t33_650M_UR50D.pt"},
+}
+# Size cap of the in-process result cache
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("STEER_CACHE_MAX_MB", 64)) * 1024**2
+# Size cap of the cache of per-sequence steering inputs, see `get_steering_inputs`
+STEERING_INPUTS_CACHE_MAX_BYTES = (
+    int(os.environ.get("STEERING_INPUTS_CACHE_MAX_MB", 1024)) * 1024**2
+)
+# Max number of tokens, summed over the steered variants, per batch of the layers after
+# the SAE's
+MAX_TOKENS_PER_BATCH = 16384
+# CPU inference profile, used when no GPU is available: "fp32", "int8" for dynamic
+# int8 quantization of the ESM2 and SAE encoder linears, or "bf16" for bfloat16 autocast
+CPU_PROFILES = ("fp32", "int8", "bf16")
+CPU_PROFILE = os.environ.get("CPU_PROFILE", "fp32")
+# Number of intra-op CPU threads; 0 keeps the PyTorch default
+CPU_NUM_THREADS = int(os.environ.get("CPU_NUM_THREADS", 0))
+
+
+class LRUCache:
+    def __init__(self, max_bytes: int):
+        """
+        In-process least-recently-used cache of handler results. Entries are evicted
+        once their total size exceeds `max_bytes`.
+        """
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, nbytes: int) -> None:
+        if nbytes > self.max_bytes:
+            return
+        if key in self._entries:
+            self.size_bytes -= self._entries.pop(key)[1]
+        self._entries[key] = (value, nbytes)
+        self.size_bytes += nbytes
+        while self.size_bytes > self.max_bytes:
+            _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+            self.size_bytes -= evicted_nbytes
+
+
+def seq_hash(seq: str) -> str:
+    return hashlib.sha256(seq.encode()).hexdigest()
 
 
 class SparseAutoencoder(nn.Module):
@@ -73,6 +132,9 @@ class SparseAutoencoder(nn.Module):
         self.w_dec.data = self.w_enc.data.T.clone()
         self.w_dec.data /= self.w_dec.data.norm(dim=0)
 
+        # Quantized encoder set by `quantize_encoder`
+        self.enc = None
+
         # Initialize dead neuron tracking. For each hidden dimension, save the
         # index of the example at which it was last activated.
         self.register_buffer("stats_last_nonzero", torch.zeros(d_hidden, dtype=torch.long))
@@ -240,7 +302,7 @@ class SparseAutoencoder(nn.Module):
         """
         x, _, _ = self.LN(x)
         x = x - self.b_pre
-        pre_acts = x @ self.w_enc + self.b_enc
+        pre_acts = self.encode_pre_acts(x)
         latents = self.topK_activation(pre_acts, self.k)
         return latents
 
@@ -248,9 +310,27 @@ class SparseAutoencoder(nn.Module):
     def encode(self, x: torch.Tensor) -> torch.Tensor:
         x, mu, std = self.LN(x)
         x = x - self.b_pre
-        acts = x @ self.w_enc + self.b_enc
+        acts = self.encode_pre_acts(x)
         return acts, mu, std
 
+    def encode_pre_acts(self, x: torch.Tensor) -> torch.Tensor:
+        if self.enc is not None:
+            return self.enc(x)
+        return x @ self.w_enc + self.b_enc
+
+    @torch.no_grad()
+    def quantize_encoder(self) -> None:
+        """
+        Use a dynamically int8-quantized copy of the encoder in `get_acts` and
+        `encode`, for CPU inference. The decoder stays in full precision.
+        """
+        enc = nn.Linear(self.d_model, self.d_hidden, device=self.w_enc.device)
+        enc.weight.copy_(self.w_enc.T)
+        enc.bias.copy_(self.b_enc)
+        self.enc = torch.ao.quantization.quantize_dynamic(
+            nn.Sequential(enc), {nn.Linear}, dtype=torch.qint8
+        )[0]
+
     @torch.no_grad()
     def decode(self, acts: torch.Tensor, mu: torch.Tensor, std: torch.Tensor) -> torch.Tensor:
         latents = self.topK_activation(acts, self.k)
@@ -259,6 +339,64 @@ class SparseAutoencoder(nn.Module):
         recons = recons * std + mu
         return recons
 
+    @torch.no_grad()
+    def get_steering_topk(self, acts: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Returns the (L, k + 1) largest pre-activations of each token in decreasing order
+        and their latent indices, i.e. the top k and the runner-up, for `steer`.
+        """
+        topk = torch.topk(acts, k=self.k + 1, dim=-1)
+        return topk.values, topk.indices
+
+    @torch.no_grad()
+    def steer(
+        self,
+        recons: torch.Tensor,
+        acts: torch.Tensor,
+        steering_topk: tuple[torch.Tensor, torch.Tensor],
+        std: torch.Tensor,
+        dim: int,
+        act: float | torch.Tensor,
+    ) -> torch.Tensor:
+        """
+        Returns `decode(acts, mu, std)` with the pre-activation of latent `dim` set to
+        `act` for every token, as an update of `recons = decode(acts, mu, std)` instead
+        of a full decode. Setting one pre-activation changes at most two latents of a
+        token: `dim` itself and, if `dim` enters the top k, the k-th latent it pushes
+        out or, if it leaves, the runner-up that takes its place. The update adds their
+        `w_dec` rows to `recons`, so it costs O(L * D_MODEL).
+
+        Args:
+            recons: (L, D_MODEL) reconstruction to update.
+            acts: (L, D_HIDDEN) pre-activations from `encode`.
+            steering_topk: `get_steering_topk(acts)`.
+            std: (L, 1) standard deviation from `encode`.
+            dim: Latent to steer.
+            act: Pre-activation to set `dim` to.
+
+        Returns:
+            torch.Tensor: (L, D_MODEL) steered reconstruction.
+        """
+        topk_values, topk_indices = steering_topk
+        k = self.k
+        act = torch.as_tensor(act, dtype=acts.dtype, device=acts.device)
+        kth_values, runner_up_values = topk_values[:, k - 1], topk_values[:, k]
+
+        in_topk = (topk_indices[:, :k] == dim).any(dim=-1)
+        in_steered_topk = torch.where(in_topk, act >= runner_up_values, act > kth_values)
+        dim_deltas = torch.where(in_steered_topk, F.relu(act), 0) - torch.where(
+            in_topk, F.relu(acts[:, dim]), 0
+        )
+        swap_dims = torch.where(in_topk, topk_indices[:, k], topk_indices[:, k - 1])
+        swap_deltas = torch.where(
+            in_topk != in_steered_topk,
+            torch.where(in_topk, F.relu(runner_up_values), -F.relu(kth_values)),
+            0,
+        )
+
+        delta = dim_deltas[:, None] * self.w_dec[dim] + swap_deltas[:, None] * self.w_dec[swap_dims]
+        return recons + delta * std
+
 
 class ESM2Model(pl.LightningModule):
     def __init__(self, num_layers, embed_dim, attention_heads, alphabet, token_dropout):
@@ -355,92 +493,283 @@ class ESM2Model(pl.LightningModule):
         return logits
 
 
-def load_models():
-    sae_name_to_model = {}
-    for sae_name, sae_checkpoint in SAE_NAME_TO_CHECKPOINT.items():
-        pattern = r"plm(\d+).*?l(\d+).*?sae(\d+)"
-        matches = re.search(pattern, sae_checkpoint)
-        if matches:
-            plm_dim, _, sae_dim = map(int, matches.groups())
-        else:
-            raise ValueError("Checkpoint file must be named in the format plm<n>_l<n>_sae<n>")
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-        # Load ESM2 model
-        logger.info(f"Loading ESM2 model with plm_dim={plm_dim}")
-        alphabet = esm.data.Alphabet.from_architecture("ESM-1b")
-        esm2_model = ESM2Model(
-            num_layers=33,
-            embed_dim=plm_dim,
-            attention_heads=20,
-            alphabet=alphabet,
-            token_dropout=False,
+def parse_checkpoint_file_name(checkpoint_file: str) -> tuple[int, int, int]:
+    """
+    Returns the (plm_dim, plm_layer, sae_dim) encoded in a checkpoint file name.
+    """
+    pattern = r"plm(\d+).*?l(\d+).*?sae(\d+)"
+    matches = re.search(pattern, checkpoint_file)
+    if not matches:
+        raise ValueError("Checkpoint file must be named in the format plm<n>_l<n>_sae<n>")
+    plm_dim, plm_layer, sae_dim = map(int, matches.groups())
+    return plm_dim, plm_layer, sae_dim
+
+
+def load_mmap_state_dict(weights_path: str) -> dict | None:
+    """
+    Returns the memory-mapped state dict written next to `weights_path` by
+    `convert_weights.py`, or None if the weights were not converted.
+    """
+    mmap_path = os.path.splitext(weights_path)[0] + ".mmap.pt"
+    if not os.path.exists(mmap_path):
+        return None
+    logger.info(f"Memory-mapping {mmap_path}")
+    return torch.load(mmap_path, map_location="cpu", mmap=True, weights_only=True)
+
+
+class ModelRegistry:
+    def __init__(
+        self,
+        sae_name_to_checkpoint: dict[str, str],
+        device: torch.device,
+        cpu_profile: str = "fp32",
+    ):
+        """
+        Loads the ESM2 backbone once per plm_dim and each SAE lazily on the first
+        request for it. All SAEs on the same backbone share it, so it is only loaded
+        once no matter how many SAEs are served.
+
+        On CPU, `cpu_profile` selects one of `CPU_PROFILES`: "int8" quantizes the
+        linears of every transformer layer and the SAE encoder on load, and "bf16"
+        runs inference under bfloat16 autocast. It is ignored on GPU.
+        """
+        if cpu_profile not in CPU_PROFILES:
+            raise ValueError(f"CPU profile must be one of {CPU_PROFILES}, got {cpu_profile}")
+        self.sae_name_to_checkpoint = sae_name_to_checkpoint
+        self.device = device
+        self.cpu_profile = cpu_profile if device.type == "cpu" else "fp32"
+        self._backbones = {}
+        self._saes = {}
+
+    def get_backbone(self, plm_dim: int) -> ESM2Model:
+        # Steering decodes through the final layers, so the whole backbone is kept and
+        # shared by the SAEs of every layer
+        key = plm_dim
+        if key not in self._backbones:
+            logger.info(f"Loading ESM2 model with plm_dim={plm_dim}")
+            config = PLM_DIM_TO_ESM2[plm_dim]
+            esm2_weights = os.path.join(WEIGHTS_DIR, config["weights"])
+            state_dict = load_mmap_state_dict(esm2_weights)
+            # With converted weights, skip the random init by building the model on the
+            # meta device; the parameters are then replaced by the mapped weights
+            with torch.device("meta" if state_dict is not None else "cpu"):
+                esm2_model = ESM2Model(
+                    num_layers=config["num_layers"],
+                    embed_dim=plm_dim,
+                    attention_heads=config["attention_heads"],
+                    alphabet=esm.data.Alphabet.from_architecture("ESM-1b"),
+                    token_dropout=False,
+                )
+            if state_dict is not None:
+                esm2_model.load_state_dict(state_dict, assign=True)
+                # Assigning replaces each parameter separately, which unties the LM head
+                # from the token embeddings
+                esm2_model.lm_head.weight = esm2_model.embed_tokens.weight
+            else:
+                esm2_model.load_esm_ckpt(esm2_weights)
+            esm2_model = esm2_model.to(self.device).eval()
+            if self.cpu_profile == "int8":
+                for layer in esm2_model.layers:
+                    torch.ao.quantization.quantize_dynamic(
+                        layer, {nn.Linear}, dtype=torch.qint8, inplace=True
+                    )
+            self._backbones[key] = esm2_model
+        return self._backbones[key]
+
+    def get(self, sae_name: str) -> tuple[ESM2Model, SparseAutoencoder, int]:
+        """
+        Returns the backbone, the SAE and the pLM layer the SAE reads from, loading
+        them on first use.
+        """
+        if sae_name not in self._saes:
+            sae_checkpoint = self.sae_name_to_checkpoint[sae_name]
+            plm_dim, plm_layer, sae_dim = parse_checkpoint_file_name(sae_checkpoint)
+            esm2_model = self.get_backbone(plm_dim)
+
+            logger.info(f"Loading SAE model {sae_name}")
+            sae_weights = os.path.join(WEIGHTS_DIR, sae_checkpoint)
+            state_dict = load_mmap_state_dict(sae_weights)
+            with torch.device("meta" if state_dict is not None else "cpu"):
+                sae_model = SparseAutoencoder(plm_dim, sae_dim)
+            if state_dict is not None:
+                sae_model.load_state_dict(state_dict, assign=True)
+            else:
+                # Support different checkpoint formats
+                try:
+                    sae_model.load_state_dict(torch.load(sae_weights, map_location="cpu"))
+                except Exception:
+                    sae_model.load_state_dict(
+                        {
+                            k.replace("sae_model.", ""): v
+                            for k, v in torch.load(sae_weights, map_location="cpu")[
+                                "state_dict"
+                            ].items()
+                        }
+                    )
+            sae_model = sae_model.to(self.device)
+            if self.cpu_profile == "int8":
+                sae_model.quantize_encoder()
+            self._saes[sae_name] = (esm2_model, sae_model, plm_layer)
+        return self._saes[sae_name]
+
+    @contextlib.contextmanager
+    def inference_context(self):
+        """
+        Context to run the models in: no autograd and, under the "bf16" CPU profile,
+        bfloat16 autocast. Cast outputs back with `.float()`.
+        """
+        autocast = (
+            torch.autocast("cpu", dtype=torch.bfloat16)
+            if self.cpu_profile == "bf16"
+            else contextlib.nullcontext()
         )
-        esm2_weights = os.path.join(WEIGHTS_DIR, "esm2_t33_650M_UR50D.pt")
-        esm2_model.load_esm_ckpt(esm2_weights)
-        esm2_model = esm2_model.to(device)
-
-        # Load SAE models
-        logger.info(f"Loading SAE model {sae_name}")
-        sae_model = SparseAutoencoder(plm_dim, sae_dim).to(device)
-        sae_weights = os.path.join(WEIGHTS_DIR, sae_checkpoint)
-        # Support different checkpoint formats
-        try:
-            sae_model.load_state_dict(torch.load(sae_weights))
-        except Exception:
-            sae_model.load_state_dict(
-                {
-                    k.replace("sae_model.", ""): v
-                    for k, v in torch.load(sae_weights)["state_dict"].items()
-                }
-            )
-        sae_name_to_model[sae_name] = sae_model
+        with torch.no_grad(), autocast:
+            yield
+
+
+def get_steering_inputs(seq: str, sae_name: str) -> tuple:
+    """
+    Returns what every steered variant of a sequence shares: the (1, L, D_MODEL) ESM
+    layer activations, the (L, D_HIDDEN) SAE pre-activations, the SAE's std, the
+    `get_steering_topk` of the pre-activations, and their max and min. These are
+    cached per (sae_name, sequence), so that a sweep over dims and multipliers only
+    reruns the ESM layers after the SAE's.
+    """
+    cache_key = (sae_name, seq_hash(seq))
+    steering_inputs = steering_inputs_cache.get(cache_key)
+    logger.info(
+        f"steering_inputs_cache: {steering_inputs_cache.hits} hits, "
+        f"{steering_inputs_cache.misses} misses, "
+        f"{steering_inputs_cache.size_bytes / 1024**2:.1f}MB"
+    )
+    if steering_inputs is not None:
+        return steering_inputs
+
+    esm2_model, sae_model, plm_layer = model_registry.get(sae_name)
+    with model_registry.inference_context():
+        # First, get ESM layer activations, encode it with SAE to get a (L, 4096) tensor
+        _, esm_layer_acts = esm2_model.get_layer_activations(seq, plm_layer)
+        sae_latents, _, std = sae_model.encode(esm_layer_acts[0])
+        steering_topk = sae_model.get_steering_topk(sae_latents)
+
+    steering_inputs = (
+        esm_layer_acts,
+        sae_latents,
+        std,
+        steering_topk,
+        sae_latents.max(),
+        sae_latents.min(),
+    )
+    nbytes = sum(
+        t.nelement() * t.element_size() for t in [esm_layer_acts, sae_latents, std, *steering_topk]
+    )
+    steering_inputs_cache.put(cache_key, steering_inputs, nbytes)
+    return steering_inputs
+
+
+def steer(seq: str, sae_name: str, dims: list[int], multipliers: list[float]) -> list[str]:
+    """
+    Returns the sequence steered by each (dim, multiplier) pair. The steered variants
+    all have the length of the sequence, so the ESM layers after the SAE's run on
+    batches of them.
+    """
+    esm2_model, sae_model, plm_layer = model_registry.get(sae_name)
+    esm_layer_acts, sae_latents, std, steering_topk, max_act, min_act = get_steering_inputs(
+        seq, sae_name
+    )
+
+    steered_sequences = []
+    batch_size = max(1, MAX_TOKENS_PER_BATCH // esm_layer_acts.shape[1])
+    for start in range(0, len(dims), batch_size):
+        steered_esm_layer_acts = []
+        with model_registry.inference_context():
+            for dim, multiplier in zip(
+                dims[start : start + batch_size], multipliers[start : start + batch_size]
+            ):
+                # Steer by setting the latent dim activation of it's max activation * multiplier
+                base_act = max_act if multiplier > 0 else min_act
+
+                # The ESM layer acts are the SAE reconstruction plus the reconstruction
+                # error, so updating them instead of the reconstruction adds the error back
+                steered_esm_layer_acts.append(
+                    sae_model.steer(
+                        esm_layer_acts[0],
+                        sae_latents,
+                        steering_topk,
+                        std,
+                        dim,
+                        base_act * multiplier,
+                    )
+                )
+            logits = esm2_model.get_sequence(torch.stack(steered_esm_layer_acts), plm_layer)
 
-    logger.info("Models loaded successfully")
-    return esm2_model, sae_name_to_model
+        # Take argmax over the logits to get the steered sequences
+        steered_tokens = torch.argmax(logits[:, 1:-1, 4:24], dim=-1)
+        for tokens in steered_tokens:
+            steered_sequences.append("".join([esm2_model.alphabet.all_toks[i + 4] for i in tokens]))
+    return steered_sequences
 
 
 def handler(event):
+    """
+    Takes a `sequence` and either a single `dim` and `multiplier`, or a list of `dims`
+    and a list of `multipliers` (one per dim). A list of dims is steered in batches and
+    the steered sequences are returned in order under `results`.
+    """
     try:
         input_data = event["input"]
         seq = input_data["sequence"]
         sae_name = input_data["sae_name"]
-        dim = input_data["dim"]
-        multiplier = input_data["multiplier"]
-
-        sae_model = sae_name_to_model[sae_name]
-
-        # First, get ESM layer 24 activations, encode it with SAE to get a (L, 4096) tensor
-        _, esm_layer_acts = esm2_model.get_layer_activations(seq, 24)
-        sae_latents, mu, std = sae_model.encode(esm_layer_acts[0])
-
-        # Decode the SAE latents yields a (L, 1280) tensor `decoded_esm_layer_acts`,
-        # i.e. the SAE's prediction of ESM layer 24 acts. Compute the error as `recons_error`.
-        esm_layer_acts_dec = sae_model.decode(sae_latents, mu, std)
-        recons_error = esm_layer_acts - esm_layer_acts_dec
-
-        # Steer by setting the latent dim activation of it's max activation * multiplier
-        base_act = sae_latents.max() if multiplier > 0 else sae_latents.min()
-        sae_latents[:, dim] = base_act * multiplier
-
-        # Decode with modified SAE latents and add back the reconstruction error
-        steered_esm_layer_acts_dec = sae_model.decode(sae_latents, mu, std)
-        logits = esm2_model.get_sequence((steered_esm_layer_acts_dec + recons_error), 24)
-
-        # Take argmax over the logits to get the steered sequence
-        steered_tokens = torch.argmax(logits[0, 1:-1, 4:24], dim=-1)
-        steered_sequence = "".join([esm2_model.alphabet.all_toks[i + 4] for i in steered_tokens])
+        if "dims" in input_data:
+            dims = input_data["dims"]
+            multipliers = input_data["multipliers"]
+            if len(multipliers) != len(dims):
+                raise ValueError("multipliers must have one entry per dim")
+        else:
+            dims = [input_data["dim"]]
+            multipliers = [input_data["multiplier"]]
+
+        steered_sequences = [
+            steer_cache.get((sae_name, seq_hash(seq), dim, multiplier))
+            for dim, multiplier in zip(dims, multipliers)
+        ]
+        missing = [
+            i for i, steered_sequence in enumerate(steered_sequences) if steered_sequence is None
+        ]
+        logger.info(
+            f"steer_cache: {len(dims) - len(missing)}/{len(dims)} hits in request, "
+            f"{steer_cache.hits} hits, {steer_cache.misses} misses"
+        )
+        if missing:
+            missing_steered_sequences = steer(
+                seq, sae_name, [dims[i] for i in missing], [multipliers[i] for i in missing]
+            )
+            for i, steered_sequence in zip(missing, missing_steered_sequences):
+                steered_sequences[i] = steered_sequence
+                cache_key = (sae_name, seq_hash(seq), dims[i], multipliers[i])
+                steer_cache.put(cache_key, steered_sequence, len(steered_sequence))
 
+        results = [{"steered_sequence": steered_sequence} for steered_sequence in steered_sequences]
         return {
             "status": "success",
-            "data": {
-                "steered_sequence": steered_sequence,
-            },
+            "data": {"results": results} if "dims" in input_data else results[0],
         }
     except Exception as e:
         logger.error(f"Traceback: {traceback.format_exc()}")
         return {"status": "error", "error": str(e)}
 
 
-esm2_model, sae_name_to_model = load_models()
-runpod.serverless.start({"handler": handler})
+model_registry = ModelRegistry(
+    SAE_NAME_TO_CHECKPOINT,
+    torch.device("cuda" if torch.cuda.is_available() else "cpu"),
+    cpu_profile=CPU_PROFILE,
+)
+# Steered sequences keyed by (sae_name, sequence hash, dim, multiplier)
+steer_cache = LRUCache(RESULT_CACHE_MAX_BYTES)
+# Steering inputs keyed by (sae_name, sequence hash)
+steering_inputs_cache = LRUCache(STEERING_INPUTS_CACHE_MAX_BYTES)
+
+if __name__ == "__main__":
+    if CPU_NUM_THREADS > 0:
+        torch.set_num_threads(CPU_NUM_THREADS)
+    runpod.serverless.start({"handler": handler})
@@ -2,6 +2,9 @@ import pytorch_lightning as pl
 import torch
 import torch.nn as nn
 from esm.modules import ESM1bLayerNorm, RobertaLMHead, TransformerLayer
+from torch.nn.utils.rnn import pad_sequence
+
+from interprot.activation_cache import canonical_model_id
 
 
 class ESM2Model(pl.LightningModule):
@@ -20,6 +23,8 @@ class ESM2Model(pl.LightningModule):
         self.prepend_bos = alphabet.prepend_bos
         self.append_eos = alphabet.append_eos
         self.token_dropout = token_dropout
+        # Identifies the loaded weights, e.g. in activation cache keys
+        self.name_or_path = None
         self._init_submodules()
 
     def _init_submodules(self):
@@ -61,13 +66,17 @@ class ESM2Model(pl.LightningModule):
             else:
                 ckpt[k.replace("encoder.sentence_encoder.", "")] = model_data[k]
         self.load_state_dict(ckpt)
+        self.name_or_path = canonical_model_id(esm_pretrained)
 
     def compose_input(self, list_tuple_seq):
         _, _, batch_tokens = self.batch_converter(list_tuple_seq)
         batch_tokens = batch_tokens.to(self.device)
         return batch_tokens
 
-    def get_layer_activations(self, input, layer_idx):
+    def get_layer_activations(self, input, layer_idx, cache=None):
+        if cache is not None and isinstance(input, (str, list)):
+            return self._get_cached_layer_activations(input, layer_idx, cache)
+
         if isinstance(input, str):
             tokens = self.compose_input([("protein", input)])
         elif isinstance(input, list):
@@ -75,22 +84,82 @@ class ESM2Model(pl.LightningModule):
         else:
             tokens = input
 
+        # Mask out padding so that batched sequences don't attend to each other's
+        # padding, same as the original ESM2 forward pass.
+        padding_mask = self.get_padding_mask(tokens)
         x = self.embed_scale * self.embed_tokens(tokens)
+        if padding_mask is not None:
+            x = x * (1 - padding_mask.unsqueeze(-1).type_as(x))
         x = x.transpose(0, 1)  # (B, T, E) => (T, B, E)
         for _, layer in enumerate(self.layers[:layer_idx]):
             x, attn = layer(
                 x,
-                self_attn_padding_mask=None,
+                self_attn_padding_mask=padding_mask,
                 need_head_weights=False,
             )
         return tokens, x.transpose(0, 1)
 
-    def get_sequence(self, x, layer_idx):
+    def truncate(self, layer_idx):
+        """
+        Free the memory of the layers after `layer_idx`, the final layer norm and the
+        LM head. `get_layer_activations` already stops at `layer_idx`, so use this
+        when only activations are needed; `get_sequence` can't be used afterwards.
+        """
+        self.layers = self.layers[:layer_idx]
+        self.num_layers = layer_idx
+        self.emb_layer_norm_after = None
+        self.lm_head = None
+        return self
+
+    def get_residue_mask(self, tokens):
+        """
+        Returns a (B, T) boolean tensor that is True at real residue positions, i.e.
+        everywhere except padding, BOS and EOS tokens.
+        """
+        return tokens.ne(self.padding_idx) & tokens.ne(self.cls_idx) & tokens.ne(self.eos_idx)
+
+    def get_padding_mask(self, tokens):
+        """
+        Returns a (B, T) boolean tensor that is True at padding positions, or None if
+        there is no padding.
+        """
+        padding_mask = tokens.eq(self.padding_idx)
+        if not padding_mask.any():
+            return None
+        return padding_mask
+
+    def _get_cached_layer_activations(self, input, layer_idx, cache):
+        """
+        Same as `get_layer_activations`, but reads from and writes to an
+        `ActivationCache` so only uncached sequences are run through the model.
+        Padding positions of the returned activations are zero-filled.
+        """
+        if self.name_or_path is None:
+            raise ValueError("Load the ESM weights before using an activation cache")
+        seqs = [input] if isinstance(input, str) else input
+        tokens = self.compose_input([("protein", seq) for seq in seqs])
+        num_special_tokens = int(self.prepend_bos) + int(self.append_eos)
+
+        def compute_fn(missing_seqs):
+            _, acts = self.get_layer_activations(missing_seqs, layer_idx)
+            return [a[: len(seq) + num_special_tokens] for a, seq in zip(acts, missing_seqs)]
+
+        # Unlike the HF ESM models, the embeddings aren't rescaled for token dropout, so
+        # the activations are cached apart from theirs
+        model_name = f"{self.name_or_path}-no-token-dropout"
+        per_seq_acts = cache.get_or_compute(model_name, layer_idx, seqs, compute_fn)
+        acts = pad_sequence(
+            [a.to(device=self.device, dtype=self.dtype) for a in per_seq_acts],
+            batch_first=True,
+        )
+        return tokens, acts
+
+    def get_sequence(self, x, layer_idx, padding_mask=None):
         x = x.transpose(0, 1)  # (B, T, E) => (T, B, E)
         for _, layer in enumerate(self.layers[layer_idx:]):
             x, attn = layer(
                 x,
-                self_attn_padding_mask=None,
+                self_attn_padding_mask=padding_mask,
                 need_head_weights=False,
             )
         x = self.emb_layer_norm_after(x)
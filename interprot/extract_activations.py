@@ -0,0 +1,67 @@
+"""
+Run ESM once over a sequence dataset and write the layer activations to an activation
+store, so that many SAEs can be trained against the same extraction with
+`training.py --activations-dir`.
+
+The dataset is split into training, validation and test sequences once, with a fixed
+seed, and the split is saved next to the store. Only the training sequences are
+extracted; `training.py` validates and tests on the saved validation and test
+sequences, so they never leak into the training activations.
+"""
+
+import argparse
+import os
+
+import esm
+import polars as pr
+import torch
+from activation_store import SPLIT_NAMES, ActivationStoreWriter, split_path
+from sae_module import get_esm_model
+from tqdm import tqdm
+from utils import iter_shuffled_length_batches, train_val_test_split
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument("--data-dir", type=str, default="data/uniref50_1M_1022.parquet")
+parser.add_argument("--esm2-weight", type=str, default="weights/esm2_t33_650M_UR50D.pt")
+parser.add_argument("-l", "--layer-to_use", type=int, default=24)
+parser.add_argument("--d-model", type=int, default=1280)
+parser.add_argument("-o", "--output-dir", type=str, required=True)
+parser.add_argument("--max-tokens-per-batch", type=int, default=16384)
+parser.add_argument("--shard-tokens", type=int, default=262144)
+parser.add_argument("--sort-window", type=int, default=1024)
+parser.add_argument("--split-seed", type=int, default=0)
+
+args = parser.parse_args()
+
+alphabet = esm.data.Alphabet.from_architecture("ESM-1b")
+# Only the activations are needed, so drop the layers after the one we extract
+esm2_model = get_esm_model(args.d_model, alphabet, args.esm2_weight).truncate(args.layer_to_use)
+splits = train_val_test_split(pr.read_parquet(args.data_dir), seed=args.split_seed)
+os.makedirs(args.output_dir, exist_ok=True)
+for split, split_df in zip(SPLIT_NAMES, splits):
+    split_df.write_parquet(split_path(args.output_dir, split))
+seqs = splits[0]["sequence"].to_list()
+writer = ActivationStoreWriter(args.output_dir, args.d_model, shard_tokens=args.shard_tokens)
+
+# Batches are length-bucketed to minimize padding, but sequences are written in a
+# random order: the training DataLoader only shuffles within about a shard's worth of
+# tokens, so every shard has to cover the whole length distribution. Each window of
+# sequences is held in memory until all of its batches are done.
+windows = iter_shuffled_length_batches(
+    [len(seq) for seq in seqs], args.max_tokens_per_batch, args.sort_window, args.split_seed
+)
+with tqdm(total=len(seqs), desc="Extracting activations") as pbar:
+    for window, batches in windows:
+        window_acts = {}
+        for batch in batches:
+            batch_seqs = [seqs[i] for i in batch]
+            with torch.no_grad():
+                _, esm_layer_acts = esm2_model.get_layer_activations(batch_seqs, args.layer_to_use)
+            for i, seq, acts in zip(batch, batch_seqs, esm_layer_acts):
+                # Keep BOS and EOS, drop padding
+                window_acts[i] = acts[: len(seq) + 2].half().cpu()
+            pbar.update(len(batch))
+        for i in window:
+            writer.add(window_acts.pop(i))
+writer.close()
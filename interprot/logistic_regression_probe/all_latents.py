@@ -1,5 +1,6 @@
 import gc
 import warnings
+from typing import Optional
 
 import click
 import pandas as pd
@@ -8,15 +9,17 @@ from sklearn.linear_model import LogisticRegression
 from sklearn.metrics import f1_score, precision_score, recall_score
 from transformers import AutoTokenizer, EsmModel
 
+from interprot.activation_cache import ActivationCache
 from interprot.logistic_regression_probe.annotations import (
     RESIDUE_ANNOTATION_NAMES,
     RESIDUE_ANNOTATIONS,
 )
 from interprot.logistic_regression_probe.logging import logger
 from interprot.logistic_regression_probe.utils import (
-    prepare_arrays_for_logistic_regression,
+    prepare_multi_sae_arrays_for_logistic_regression,
 )
 from interprot.sae_model import SparseAutoencoder
+from interprot.utils import truncate_plm
 
 
 @click.command()
@@ -24,15 +27,24 @@ from interprot.sae_model import SparseAutoencoder
     "--sae-checkpoint",
     type=click.Path(exists=True),
     required=True,
-    help="Path to the SAE checkpoint file",
+    multiple=True,
+    help="Path to the SAE checkpoint file. Can be given multiple times to probe several "
+    "SAEs, at the same or different pLM layers, with a single pLM pass.",
+)
+@click.option(
+    "--sae-dim",
+    type=int,
+    required=True,
+    multiple=True,
+    help="Dimension of the sparse autoencoder, one per --sae-checkpoint",
 )
-@click.option("--sae-dim", type=int, required=True, help="Dimension of the sparse autoencoder")
 @click.option("--plm-dim", type=int, required=True, help="Dimension of the protein language model")
 @click.option(
     "--plm-layer",
     type=int,
     required=True,
-    help="Layer of the protein language model to use",
+    multiple=True,
+    help="Layer of the protein language model to use, one per --sae-checkpoint",
 )
 @click.option(
     "--swissprot-tsv",
@@ -44,7 +56,8 @@ from interprot.sae_model import SparseAutoencoder
     "--output-file",
     type=click.Path(),
     required=True,
-    help="Path to the output file",
+    multiple=True,
+    help="Path to the output file, one per --sae-checkpoint",
 )
 @click.option(
     "--annotation-names",
@@ -58,32 +71,59 @@ from interprot.sae_model import SparseAutoencoder
     default=1000,
     help="Maximum number of sequences to use for a given logistic regression task",
 )
+@click.option(
+    "--activation-cache-dir",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Directory of a persistent pLM activation cache shared across runs",
+)
+@click.option(
+    "--activation-cache-max-gb",
+    type=float,
+    default=100.0,
+    help="Size cap of the activation cache in GB",
+)
 def all_latents(
-    sae_checkpoint: str,
-    sae_dim: int,
+    sae_checkpoint: list[str],
+    sae_dim: list[int],
     plm_dim: int,
-    plm_layer: int,
+    plm_layer: list[int],
     swissprot_tsv: str,
-    output_file: str,
+    output_file: list[str],
     annotation_names: list[str],
     max_seqs_per_task: int,
+    activation_cache_dir: Optional[str],
+    activation_cache_max_gb: float,
 ):
     for name in annotation_names:
         if name not in RESIDUE_ANNOTATION_NAMES:
             raise ValueError(f"Invalid annotation name: {name}")
+    if not len(sae_checkpoint) == len(sae_dim) == len(plm_layer) == len(output_file):
+        raise ValueError(
+            "Pass one --sae-dim, one --plm-layer and one --output-file per --sae-checkpoint"
+        )
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     logger.debug(f"Using device: {device}")
 
-    # Load pLM and SAE
+    # Load pLM and SAEs
     tokenizer = AutoTokenizer.from_pretrained("facebook/esm2_t33_650M_UR50D")
     plm_model = EsmModel.from_pretrained("facebook/esm2_t33_650M_UR50D").to(device).eval()
-    sae_model = SparseAutoencoder(plm_dim, sae_dim).to(device)
-    sae_model.load_state_dict(torch.load(sae_checkpoint, map_location=device))
+    truncate_plm(plm_model, max(plm_layer))
+    sae_models = []
+    for checkpoint, checkpoint_sae_dim in zip(sae_checkpoint, sae_dim):
+        sae_model = SparseAutoencoder(plm_dim, checkpoint_sae_dim).to(device)
+        sae_model.load_state_dict(torch.load(checkpoint, map_location=device))
+        sae_models.append(sae_model)
+    activation_cache = (
+        ActivationCache(activation_cache_dir, max_size_gb=activation_cache_max_gb)
+        if activation_cache_dir
+        else None
+    )
 
     df = pd.read_csv(swissprot_tsv, sep="\t")
 
-    res_rows = []
+    res_rows = [[] for _ in sae_models]
     for annotation in RESIDUE_ANNOTATIONS:
         if annotation_names and annotation.name not in annotation_names:
             continue
@@ -91,43 +131,47 @@ def all_latents(
         logger.info(f"Processing annotation: {annotation.name}")
 
         for class_name in annotation.class_names:
-            X_train, y_train, X_test, y_test = prepare_arrays_for_logistic_regression(
+            all_arrays = prepare_multi_sae_arrays_for_logistic_regression(
                 df=df,
                 annotation=annotation,
                 class_name=class_name,
                 max_seqs_per_task=max_seqs_per_task,
                 tokenizer=tokenizer,
                 plm_model=plm_model,
-                sae_model=sae_model,
-                plm_layer=plm_layer,
+                sae_models=sae_models,
+                plm_layers=list(plm_layer),
                 pool_over_annotation=False,
+                activation_cache=activation_cache,
             )
-            with warnings.catch_warnings():
-                # LogisticRegression throws warnings when it can't converge.
-                # This is expected for most dimensions.
-                warnings.simplefilter("ignore")
+            for i, (X_train, y_train, X_test, y_test) in enumerate(all_arrays):
+                with warnings.catch_warnings():
+                    # LogisticRegression throws warnings when it can't converge.
+                    # This is expected for most dimensions.
+                    warnings.simplefilter("ignore")
 
-                model = LogisticRegression(class_weight="balanced")
-                model.fit(X_train, y_train)
-                y_pred = model.predict(X_test)
-                precision = precision_score(y_test, y_pred)
-                recall = recall_score(y_test, y_pred)
-                f1 = f1_score(y_test, y_pred)
+                    model = LogisticRegression(class_weight="balanced")
+                    model.fit(X_train, y_train)
+                    y_pred = model.predict(X_test)
+                    precision = precision_score(y_test, y_pred)
+                    recall = recall_score(y_test, y_pred)
+                    f1 = f1_score(y_test, y_pred)
 
-                logger.info(f"Precision: {precision}, Recall: {recall}, F1: {f1}")
+                    logger.info(
+                        f"{sae_checkpoint[i]}: Precision: {precision}, Recall: {recall}, F1: {f1}"
+                    )
 
-                weights = model.coef_[0]
-                res_rows.append(
-                    [annotation.name, class_name, precision, recall, f1] + weights.tolist()
-                )
+                    weights = model.coef_[0]
+                    res_rows[i].append(
+                        [annotation.name, class_name, precision, recall, f1] + weights.tolist()
+                    )
 
-            res_df = pd.DataFrame(
-                res_rows,
-                columns=["annotation", "class", "precision", "recall", "f1"]
-                + [f"weight_{i}" for i in range(sae_dim)],
-            )
-            res_df.to_csv(output_file, index=False)
-            logger.info(f"Results saved to {output_file}")
+                res_df = pd.DataFrame(
+                    res_rows[i],
+                    columns=["annotation", "class", "precision", "recall", "f1"]
+                    + [f"weight_{dim}" for dim in range(sae_dim[i])],
+                )
+                res_df.to_csv(output_file[i], index=False)
+                logger.info(f"Results saved to {output_file[i]}")
 
-            del X_train, y_train, X_test, y_test
+            del all_arrays, X_train, y_train, X_test, y_test
             gc.collect()
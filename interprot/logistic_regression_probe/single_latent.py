@@ -4,6 +4,7 @@ import os
 import tempfile
 import warnings
 from multiprocessing import Pool
+from typing import Optional
 
 import click
 import numpy as np
@@ -14,6 +15,7 @@ from sklearn.metrics import f1_score, precision_score, recall_score
 from tqdm import tqdm
 from transformers import AutoTokenizer, EsmModel
 
+from interprot.activation_cache import ActivationCache
 from interprot.logistic_regression_probe.annotations import (
     RESIDUE_ANNOTATION_NAMES,
     RESIDUE_ANNOTATIONS,
@@ -23,6 +25,7 @@ from interprot.logistic_regression_probe.utils import (
     prepare_arrays_for_logistic_regression,
 )
 from interprot.sae_model import SparseAutoencoder
+from interprot.utils import truncate_plm
 
 
 def augment_df_with_aa_identity(df: pd.DataFrame) -> pd.DataFrame:
@@ -31,7 +34,7 @@ def augment_df_with_aa_identity(df: pd.DataFrame) -> pd.DataFrame:
     """
 
     def make_aa_identity_annotation(seq: str) -> str:
-        return "; ".join(f'AA_IDENTITY {i+1}; /note="{aa}"' for i, aa in enumerate(seq))
+        return "; ".join(f'AA_IDENTITY {i + 1}; /note="{aa}"' for i, aa in enumerate(seq))
 
     df["Amino acid identity"] = df["Sequence"].apply(make_aa_identity_annotation)
     return df
@@ -111,6 +114,18 @@ def run_logistic_regression_on_latent(
     default=1000,
     help="Maximum number of sequences to use for a given logistic regression task",
 )
+@click.option(
+    "--activation-cache-dir",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Directory of a persistent pLM activation cache shared across runs",
+)
+@click.option(
+    "--activation-cache-max-gb",
+    type=float,
+    default=100.0,
+    help="Size cap of the activation cache in GB",
+)
 def single_latent(
     sae_checkpoint: str,
     sae_dim: int,
@@ -121,6 +136,8 @@ def single_latent(
     annotation_names: list[str],
     pool_over_annotation: bool,
     max_seqs_per_task: int,
+    activation_cache_dir: Optional[str],
+    activation_cache_max_gb: float,
 ):
     """
     Run 1D logistic regression probing for each latent dimension for SAE evaluation.
@@ -136,8 +153,14 @@ def single_latent(
     # Load pLM and SAE
     tokenizer = AutoTokenizer.from_pretrained("facebook/esm2_t33_650M_UR50D")
     plm_model = EsmModel.from_pretrained("facebook/esm2_t33_650M_UR50D").to(device).eval()
+    truncate_plm(plm_model, plm_layer)
     sae_model = SparseAutoencoder(plm_dim, sae_dim).to(device)
     sae_model.load_state_dict(torch.load(sae_checkpoint, map_location=device))
+    activation_cache = (
+        ActivationCache(activation_cache_dir, max_size_gb=activation_cache_max_gb)
+        if activation_cache_dir
+        else None
+    )
 
     df = pd.read_csv(swissprot_tsv, sep="\t")
 
@@ -169,6 +192,7 @@ def single_latent(
                 sae_model=sae_model,
                 plm_layer=plm_layer,
                 pool_over_annotation=pool_over_annotation,
+                activation_cache=activation_cache,
             )
             with warnings.catch_warnings():
                 # LogisticRegression throws warnings when it can't converge.
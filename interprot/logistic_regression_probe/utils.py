@@ -5,16 +5,18 @@ import subprocess
 import tempfile
 from collections import defaultdict
 from dataclasses import dataclass
+from typing import Iterable, Iterator, Optional
 
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
 from transformers import AutoTokenizer, EsmModel
 
+from interprot.activation_cache import ActivationCache
 from interprot.logistic_regression_probe.annotations import ResidueAnnotation
 from interprot.logistic_regression_probe.logging import logger
 from interprot.sae_model import SparseAutoencoder
-from interprot.utils import get_layer_activations, parse_swissprot_annotation
+from interprot.utils import iter_multi_layer_activations, parse_swissprot_annotation
 
 MAX_SEQ_LEN = 1000
 
@@ -129,15 +131,71 @@ def get_sae_acts(
     plm_model: EsmModel,
     sae_model: SparseAutoencoder,
     plm_layer: int,
+    activation_cache: Optional[ActivationCache] = None,
 ) -> np.ndarray[np.float32, np.float32]:
     """
     Returns a (len(seq), sae_dim) array of SAE activations.
     """
-    esm_layer_acts = get_layer_activations(
-        tokenizer=tokenizer, plm=plm_model, seqs=[seq], layer=plm_layer
-    )[0]
-    sae_acts = sae_model.get_acts(esm_layer_acts)[1:-1]  # Trim BOS and EOS tokens
-    return sae_acts.cpu().numpy()
+    return next(
+        iter_sae_acts(
+            seqs=[seq],
+            tokenizer=tokenizer,
+            plm_model=plm_model,
+            sae_model=sae_model,
+            plm_layer=plm_layer,
+            activation_cache=activation_cache,
+        )
+    )
+
+
+def iter_sae_acts(
+    seqs: list[str],
+    tokenizer: AutoTokenizer,
+    plm_model: EsmModel,
+    sae_model: SparseAutoencoder,
+    plm_layer: int,
+    activation_cache: Optional[ActivationCache] = None,
+) -> Iterator[np.ndarray[np.float32, np.float32]]:
+    """
+    Yields a (len(seq), sae_dim) array of SAE activations for each sequence, in order.
+    The pLM runs on length-bucketed batches of sequences.
+    """
+    for sae_acts in iter_multi_sae_acts(
+        seqs=seqs,
+        tokenizer=tokenizer,
+        plm_model=plm_model,
+        sae_models=[sae_model],
+        plm_layers=[plm_layer],
+        activation_cache=activation_cache,
+    ):
+        yield sae_acts[0]
+
+
+def iter_multi_sae_acts(
+    seqs: list[str],
+    tokenizer: AutoTokenizer,
+    plm_model: EsmModel,
+    sae_models: list[SparseAutoencoder],
+    plm_layers: list[int],
+    activation_cache: Optional[ActivationCache] = None,
+) -> Iterator[list[np.ndarray[np.float32, np.float32]]]:
+    """
+    Multi-SAE version of `iter_sae_acts` where `sae_models[i]` reads layer
+    `plm_layers[i]`. All layers are captured in a single pLM pass. Yields a list with
+    the (len(seq), sae_dim) array of each SAE for each sequence, in order.
+    """
+    for esm_layer_acts in iter_multi_layer_activations(
+        tokenizer=tokenizer,
+        plm=plm_model,
+        seqs=seqs,
+        layers=plm_layers,
+        cache=activation_cache,
+    ):
+        # BOS and EOS tokens are already trimmed
+        yield [
+            sae_model.get_acts(esm_layer_acts[plm_layer]).cpu().numpy()
+            for sae_model, plm_layer in zip(sae_models, plm_layers)
+        ]
 
 
 def get_annotation_entries_for_class(
@@ -185,6 +243,7 @@ def make_examples_from_annotation_entries(
     sae_model: SparseAutoencoder,
     plm_layer: int,
     pool_over_annotation: bool = False,
+    activation_cache: Optional[ActivationCache] = None,
 ) -> list[Example]:
     """
     Given a dict like this:
@@ -213,74 +272,121 @@ def make_examples_from_annotation_entries(
     ]
     ```
     """
+    all_sae_acts = iter_sae_acts(
+        seqs=list(seq_to_annotation_entries.keys()),
+        tokenizer=tokenizer,
+        plm_model=plm_model,
+        sae_model=sae_model,
+        plm_layer=plm_layer,
+        activation_cache=activation_cache,
+    )
+    return make_examples_from_sae_acts(
+        seq_to_annotation_entries, all_sae_acts, pool_over_annotation
+    )
+
+
+def make_examples_from_sae_acts(
+    seq_to_annotation_entries: dict[str, list[dict]],
+    all_sae_acts: Iterable[np.ndarray[np.float32, np.float32]],
+    pool_over_annotation: bool = False,
+) -> list[Example]:
+    """
+    Same as `make_examples_from_annotation_entries`, but takes the SAE activations of
+    each sequence in `seq_to_annotation_entries` instead of running inference.
+    """
     examples = []
-    for seq, entries in tqdm(
-        seq_to_annotation_entries.items(),
+    for (seq, entries), sae_acts in tqdm(
+        zip(seq_to_annotation_entries.items(), all_sae_acts),
+        total=len(seq_to_annotation_entries),
         desc="Running ESM -> SAE inference",
     ):
-        sae_acts = get_sae_acts(
-            seq=seq,
-            tokenizer=tokenizer,
-            plm_model=plm_model,
-            sae_model=sae_model,
-            plm_layer=plm_layer,
-        )
-
-        if pool_over_annotation:
-            for e in entries:
-                start = e["start"] - 1
-                end = e["end"]
-                annotation_length = end - start
-                examples.append(
-                    Example(
-                        sae_acts=np.mean(sae_acts[start:end], axis=0),
-                        target=True,
-                    )
-                )
-
-                # Sample 1-2 random annotations with the same length as the positive annotation
-                # that don't overlap with the positive annotation as negative examples.
-                if start >= annotation_length:
-                    random_start_on_left = random.randint(0, start - annotation_length)
-                    random_end_on_left = random_start_on_left + annotation_length
-                    examples.append(
-                        Example(
-                            sae_acts=np.mean(
-                                sae_acts[random_start_on_left:random_end_on_left], axis=0
-                            ),
-                            target=False,
-                        )
-                    )
-                if end < len(seq) - annotation_length:
-                    random_start_on_right = random.randint(end, len(seq) - annotation_length)
-                    random_end_on_right = random_start_on_right + annotation_length
-                    examples.append(
-                        Example(
-                            sae_acts=np.mean(
-                                sae_acts[random_start_on_right:random_end_on_right], axis=0
-                            ),
-                            target=False,
-                        )
-                    )
-        else:
-            positive_positions = set()
-            for e in entries:
-                for i in range(e["start"] - 1, e["end"]):  # Swissprot is 1-indexed
-                    positive_positions.add(i)
-
-            for i, pos_sae_acts in enumerate(sae_acts):
-                examples.append(
-                    Example(
-                        sae_acts=pos_sae_acts,
-                        target=i in positive_positions,
-                    )
-                )
+        windows = get_example_windows(seq, entries, pool_over_annotation)
+        examples.extend(make_examples_from_windows(sae_acts, windows, pool_over_annotation))
 
     num_positive_examples = sum(e.target for e in examples)
     logger.info(f"Made {len(examples)} examples ({num_positive_examples} positive)")
     return examples
 
 
+def get_example_windows(
+    seq: str, entries: list[dict], pool_over_annotation: bool = False
+) -> list[tuple[int, int, bool]]:
+    """
+    Returns the (start, end, target) residue window of each example in a sequence.
+    Without pooling, each residue is its own window.
+    """
+    windows = []
+    if pool_over_annotation:
+        for e in entries:
+            start = e["start"] - 1
+            end = e["end"]
+            annotation_length = end - start
+            windows.append((start, end, True))
+
+            # Sample 1-2 random annotations with the same length as the positive annotation
+            # that don't overlap with the positive annotation as negative examples.
+            if start >= annotation_length:
+                random_start_on_left = random.randint(0, start - annotation_length)
+                windows.append(
+                    (random_start_on_left, random_start_on_left + annotation_length, False)
+                )
+            if end < len(seq) - annotation_length:
+                random_start_on_right = random.randint(end, len(seq) - annotation_length)
+                windows.append(
+                    (random_start_on_right, random_start_on_right + annotation_length, False)
+                )
+    else:
+        positive_positions = set()
+        for e in entries:
+            for i in range(e["start"] - 1, e["end"]):  # Swissprot is 1-indexed
+                positive_positions.add(i)
+        windows = [(i, i + 1, i in positive_positions) for i in range(len(seq))]
+    return windows
+
+
+def make_examples_from_windows(
+    sae_acts: np.ndarray[np.float32, np.float32],
+    windows: list[tuple[int, int, bool]],
+    pool_over_annotation: bool = False,
+) -> list[Example]:
+    """
+    Make an example from the SAE activations of each window from `get_example_windows`.
+    """
+    if pool_over_annotation:
+        return [
+            Example(sae_acts=np.mean(sae_acts[start:end], axis=0), target=target)
+            for start, end, target in windows
+        ]
+    return [Example(sae_acts=sae_acts[start], target=target) for start, _, target in windows]
+
+
+def split_annotation_entries_by_homology(
+    df: pd.DataFrame,
+    annotation: ResidueAnnotation,
+    class_name: str,
+    max_seqs_per_task: int,
+) -> tuple[dict[str, list[dict]], dict[str, list[dict]]]:
+    """
+    Get the annotation entries of all sequences with the given annotation and class
+    (see `get_annotation_entries_for_class`), downsampled to max_seqs_per_task
+    dissimilar sequences and split into train and test sets by homology.
+    """
+    # First, get all sequences with the target annotations
+    seq_to_annotation_entries = get_annotation_entries_for_class(df, annotation, class_name)
+
+    # Then, split into train and test
+    train_seqs, test_seqs = train_test_split_by_homology(
+        list(seq_to_annotation_entries.keys()), max_seqs=max_seqs_per_task
+    )
+    train_seq_to_annotation_entries = {
+        seq: entries for seq, entries in seq_to_annotation_entries.items() if seq in train_seqs
+    }
+    test_seq_to_annotation_entries = {
+        seq: entries for seq, entries in seq_to_annotation_entries.items() if seq in test_seqs
+    }
+    return train_seq_to_annotation_entries, test_seq_to_annotation_entries
+
+
 def prepare_arrays_for_logistic_regression(
     df: pd.DataFrame,
     annotation: ResidueAnnotation,
@@ -291,6 +397,7 @@ def prepare_arrays_for_logistic_regression(
     sae_model: SparseAutoencoder,
     plm_layer: int,
     pool_over_annotation: bool,
+    activation_cache: Optional[ActivationCache] = None,
 ) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
     """
     Given the swissprot dataframe and the desired annotation and class, creates examples that
@@ -301,19 +408,9 @@ def prepare_arrays_for_logistic_regression(
     3. ESM inference -> SAE inference -> get SAE activations for each residue in each sequence
     4. Create examples from the SAE activations and the binary target
     """
-    # First, get all sequences with the target annotations
-    seq_to_annotation_entries = get_annotation_entries_for_class(df, annotation, class_name)
-
-    # Then, split into train and test
-    train_seqs, test_seqs = train_test_split_by_homology(
-        list(seq_to_annotation_entries.keys()), max_seqs=max_seqs_per_task
+    train_seq_to_annotation_entries, test_seq_to_annotation_entries = (
+        split_annotation_entries_by_homology(df, annotation, class_name, max_seqs_per_task)
     )
-    train_seq_to_annotation_entries = {
-        seq: entries for seq, entries in seq_to_annotation_entries.items() if seq in train_seqs
-    }
-    test_seq_to_annotation_entries = {
-        seq: entries for seq, entries in seq_to_annotation_entries.items() if seq in test_seqs
-    }
 
     # Make examples for each split
     train_examples = make_examples_from_annotation_entries(
@@ -323,6 +420,7 @@ def prepare_arrays_for_logistic_regression(
         sae_model=sae_model,
         plm_layer=plm_layer,
         pool_over_annotation=pool_over_annotation,
+        activation_cache=activation_cache,
     )
     test_examples = make_examples_from_annotation_entries(
         seq_to_annotation_entries=test_seq_to_annotation_entries,
@@ -331,6 +429,7 @@ def prepare_arrays_for_logistic_regression(
         sae_model=sae_model,
         plm_layer=plm_layer,
         pool_over_annotation=pool_over_annotation,
+        activation_cache=activation_cache,
     )
 
     X_train = np.array([e.sae_acts for e in train_examples], dtype="float32")
@@ -338,7 +437,75 @@ def prepare_arrays_for_logistic_regression(
     X_test = np.array([e.sae_acts for e in test_examples], dtype="float32")
     y_test = np.array([e.target for e in test_examples], dtype="bool")
 
-    del train_seqs, test_seqs, train_seq_to_annotation_entries, test_seq_to_annotation_entries
+    del train_seq_to_annotation_entries, test_seq_to_annotation_entries
     del train_examples, test_examples
     gc.collect()
     return X_train, y_train, X_test, y_test
+
+
+def prepare_multi_sae_arrays_for_logistic_regression(
+    df: pd.DataFrame,
+    annotation: ResidueAnnotation,
+    class_name: str,
+    max_seqs_per_task: int,
+    tokenizer: AutoTokenizer,
+    plm_model: EsmModel,
+    sae_models: list[SparseAutoencoder],
+    plm_layers: list[int],
+    pool_over_annotation: bool,
+    activation_cache: Optional[ActivationCache] = None,
+) -> list[tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Multi-SAE version of `prepare_arrays_for_logistic_regression` where
+    `sae_models[i]` reads layer `plm_layers[i]`. The sequences are split once and run
+    through the pLM once for all SAEs, so every SAE is probed on the same examples.
+
+    Returns a list with the (X_train, y_train, X_test, y_test) arrays of each SAE.
+    """
+    splits = split_annotation_entries_by_homology(df, annotation, class_name, max_seqs_per_task)
+
+    arrays = []
+    for seq_to_annotation_entries in splits:
+        # Build each SAE's examples as the activations stream in, instead of holding the
+        # dense activations of every SAE for every sequence. The windows are sampled once
+        # per sequence so that every SAE is probed on the same examples.
+        examples = [[] for _ in sae_models]
+        for (seq, entries), all_sae_acts in tqdm(
+            zip(
+                seq_to_annotation_entries.items(),
+                iter_multi_sae_acts(
+                    seqs=list(seq_to_annotation_entries.keys()),
+                    tokenizer=tokenizer,
+                    plm_model=plm_model,
+                    sae_models=sae_models,
+                    plm_layers=plm_layers,
+                    activation_cache=activation_cache,
+                ),
+            ),
+            total=len(seq_to_annotation_entries),
+            desc="Running ESM -> SAE inference",
+        ):
+            windows = get_example_windows(seq, entries, pool_over_annotation)
+            for sae_examples, sae_acts in zip(examples, all_sae_acts):
+                sae_examples.extend(
+                    make_examples_from_windows(sae_acts, windows, pool_over_annotation)
+                )
+            del all_sae_acts
+
+        arrays.append(
+            [
+                (
+                    np.array([e.sae_acts for e in sae_examples], dtype="float32"),
+                    np.array([e.target for e in sae_examples], dtype="bool"),
+                )
+                for sae_examples in examples
+            ]
+        )
+        del examples
+        gc.collect()
+
+    train_arrays, test_arrays = arrays
+    return [
+        (X_train, y_train, X_test, y_test)
+        for (X_train, y_train), (X_test, y_test) in zip(train_arrays, test_arrays)
+    ]
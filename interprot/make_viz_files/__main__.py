@@ -1,8 +1,9 @@
-import heapq
 import json
 import os
 import re
-from typing import Any
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Optional
 
 import click
 import numpy as np
@@ -10,22 +11,27 @@ import polars as pl
 import torch
 from tqdm import tqdm
 from transformers import AutoTokenizer, EsmModel
-from scipy import sparse
 
-from interprot.sae_model import SparseAutoencoder
-from interprot.utils import get_layer_activations
+from interprot.activation_cache import ActivationCache
+from interprot.make_viz_files.run_state import (
+    RunState,
+    atomic_write,
+    load_merged_partial_stats,
+    save_partial_stats,
+)
+from interprot.make_viz_files.top_examples import (
+    ACT_RANGES,
+    SparseMaxActivations,
+    TopExamplesReducer,
+)
+from interprot.make_viz_files.viz_shards import write_viz_shards
+from interprot.sae_model import SparseAutoencoder, SparseAutoencoderGroup
+from interprot.utils import iter_multi_layer_activations, truncate_plm
 
 OUTPUT_ROOT_DIR = "viz_files"
 NUM_SEQS_PER_DIM = 12
-
-
-def get_esm_layer_acts(
-    seq: str, tokenizer: AutoTokenizer, plm_model: EsmModel, plm_layer: int
-) -> torch.Tensor:
-    acts = get_layer_activations(
-        tokenizer=tokenizer, plm=plm_model, seqs=[seq], layer=plm_layer
-    )[0]
-    return acts
+PFAM_ACT_GT = 0.75
+WRITE_BATCH_SIZE = 256
 
 
 @click.command()
@@ -42,125 +48,448 @@ def get_esm_layer_acts(
     required=True,
     help="Path to the sequences file containing AlphaFoldDB IDs",
 )
-def make_viz_files(checkpoint_files: list[str], sequences_file: str):
+@click.option(
+    "--activation-cache-dir",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Directory of a persistent pLM activation cache shared across runs",
+)
+@click.option(
+    "--activation-cache-max-gb",
+    type=float,
+    default=100.0,
+    help="Size cap of the activation cache in GB",
+)
+@click.option(
+    "--max-tokens-per-batch",
+    type=int,
+    default=8192,
+    help="Token budget of each length-bucketed pLM inference batch",
+)
+@click.option(
+    "--two-pass/--streaming",
+    default=True,
+    help="By default, only keep per-sequence max activations in a first pass, pick "
+    "the examples of each latent exactly from them and re-run inference on the "
+    "selected sequences in a second pass. --streaming runs a single pass that keeps "
+    "the best candidates so far instead; its top range is exact but the lower ranges "
+    "are approximate, since candidates dropped before a latent's max activation grows "
+    "can't come back",
+)
+@click.option(
+    "--num-write-workers",
+    type=int,
+    default=os.cpu_count(),
+    help="Number of processes writing the visualization files",
+)
+@click.option(
+    "--output-format",
+    type=click.Choice(["json", "shards", "both"]),
+    default="json",
+    help="Write one JSON file per latent, a compact bundle of binary shards with "
+    "uint8 activations and a shared protein table, or both",
+)
+@click.option(
+    "--state-dir",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Directory of the durable run state. Rerunning with the same directory "
+    "resumes where the previous run stopped",
+)
+@click.option(
+    "--checkpoint-every",
+    type=int,
+    default=10000,
+    help="Number of sequences between run state checkpoints",
+)
+@click.option(
+    "--num-shards",
+    type=int,
+    default=1,
+    help="Split the inference over the sequences across this many processes or nodes",
+)
+@click.option(
+    "--shard-index",
+    type=int,
+    default=0,
+    help="Index of the shard of sequences this process runs inference over",
+)
+@click.option(
+    "--partials-dir",
+    type=click.Path(file_okay=False),
+    default=os.path.join(OUTPUT_ROOT_DIR, "partials"),
+    help="Directory the shards write their partial statistics to",
+)
+@click.option(
+    "--merge-shards",
+    is_flag=True,
+    default=False,
+    help="Merge the per-sequence max activations of all --num-shards shards, pick the "
+    "examples over all sequences, run the second pass and write the visualization files",
+)
+def make_viz_files(
+    checkpoint_files: list[str],
+    sequences_file: str,
+    activation_cache_dir: Optional[str],
+    activation_cache_max_gb: float,
+    max_tokens_per_batch: int,
+    two_pass: bool,
+    num_write_workers: int,
+    output_format: str,
+    state_dir: Optional[str],
+    checkpoint_every: int,
+    num_shards: int,
+    shard_index: int,
+    partials_dir: str,
+    merge_shards: bool,
+):
     """
     Generate visualization files for SAE latents for multiple checkpoint files.
+
+    All checkpoints are fed from a single pass over the sequences: the pLM captures
+    every layer the checkpoints need at once, and the SAEs at the same layer are
+    evaluated together with fused encoders. Each SAE accumulates its own statistics.
+
+    The first pass only keeps a sparse float16 matrix of per-sequence max
+    activations, which is enough to pick the examples of each latent exactly, and a
+    second pass recomputes the per-residue activations of the selected sequences
+    only. With `--streaming`, a single pass keeps the per-residue activations of the
+    candidate examples instead, at the cost of approximate lower activation ranges.
+
+    With `--state-dir`, the statistics are checkpointed every `--checkpoint-every`
+    sequences and after each step. In two-pass mode, a checkpoint only appends the
+    statistics of the sequences since the previous one. A rerun resumes from the last
+    checkpoint and skips the latents whose JSON file already exists.
+
+    With `--num-shards`, each of the processes started with `--shard-index` 0 to
+    num_shards - 1 runs the first pass over every num_shards-th sequence and saves its
+    per-sequence max activations to `--partials-dir`. A final run with
+    `--merge-shards` merges them, picks the examples over all sequences, runs the
+    second pass and writes the visualization files, which are the same as those of a
+    single process. Sharding is not supported with `--streaming`, whose candidates
+    can't be merged exactly.
     """
+    if not 0 <= shard_index < num_shards:
+        raise click.BadParameter("must be in [0, num_shards)", param_hint="--shard-index")
+    if not two_pass and (num_shards > 1 or merge_shards):
+        raise click.BadParameter(
+            "can't be combined with --num-shards or --merge-shards", param_hint="--streaming"
+        )
     os.makedirs(OUTPUT_ROOT_DIR, exist_ok=True)
+    activation_cache = (
+        ActivationCache(activation_cache_dir, max_size_gb=activation_cache_max_gb)
+        if activation_cache_dir
+        else None
+    )
+    checkpoints = [parse_checkpoint_file_name(f) for f in checkpoint_files]
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    sae_models = [
+        load_sae_model(checkpoint_file, plm_dim, sae_dim, device)
+        for checkpoint_file, (plm_dim, _, sae_dim) in zip(checkpoint_files, checkpoints)
+    ]
+    # Group the SAEs by the pLM layer they read from
+    layer_to_sae_idxs = defaultdict(list)
+    for i, (_, plm_layer, _) in enumerate(checkpoints):
+        layer_to_sae_idxs[plm_layer].append(i)
+    sae_groups = {
+        plm_layer: SparseAutoencoderGroup([sae_models[i] for i in sae_idxs])
+        for plm_layer, sae_idxs in layer_to_sae_idxs.items()
+    }
+
+    tokenizer = AutoTokenizer.from_pretrained("facebook/esm2_t33_650M_UR50D")
+    plm_model = EsmModel.from_pretrained("facebook/esm2_t33_650M_UR50D").to(device).eval()
+    truncate_plm(plm_model, max(layer_to_sae_idxs))
+
+    df = pl.read_parquet(sequences_file)
+    strong_act_gt = PFAM_ACT_GT if "Pfam" in df.columns else None
+    run_state = None
+    if state_dir:
+        try:
+            run_state = RunState(
+                state_dir,
+                {
+                    "checkpoint_files": list(checkpoint_files),
+                    "sequences_file": sequences_file,
+                    "two_pass": two_pass,
+                    "num_shards": num_shards,
+                    "shard_index": shard_index,
+                    "merge_shards": merge_shards,
+                },
+            )
+        except ValueError as e:
+            raise click.UsageError(str(e))
+
+    if run_state is not None and run_state.exists:
+        click.echo(
+            f"Resuming from {state_dir} at stage {run_state.stage} after "
+            f"{run_state.num_seqs_done} sequences"
+        )
+        all_stats = run_state.load_stats()
+        stage, num_seqs_done = run_state.stage, run_state.num_seqs_done
+    elif two_pass:
+        # Keep only the per-sequence max activations and pick the examples from them
+        all_stats = [
+            SparseMaxActivations(sae_dim, NUM_SEQS_PER_DIM, ACT_RANGES, strong_act_gt)
+            for _, _, sae_dim in checkpoints
+        ]
+        stage, num_seqs_done = "pass1", 0
+    else:
+        # Keep only the top example candidates of each latent instead of all
+        # activations. The lower ranges are approximate.
+        all_stats = [
+            TopExamplesReducer(sae_dim, NUM_SEQS_PER_DIM, ACT_RANGES, strong_act_gt)
+            for _, _, sae_dim in checkpoints
+        ]
+        stage, num_seqs_done = "pass1", 0
+
+    def checkpoint(stage: str, num_seqs_done: int):
+        if run_state is not None:
+            run_state.save(stage, num_seqs_done, all_stats)
+
+    def iter_sae_acts(seq_idxs: list[int], desc: str):
+        esm_layer_acts_iter = iter_multi_layer_activations(
+            tokenizer,
+            plm_model,
+            df["Sequence"][seq_idxs].to_list(),
+            list(layer_to_sae_idxs),
+            device=device,
+            max_tokens_per_batch=max_tokens_per_batch,
+            cache=activation_cache,
+        )
+        for i, (seq_idx, esm_layer_acts) in tqdm(
+            enumerate(zip(seq_idxs, esm_layer_acts_iter)), total=len(seq_idxs), desc=desc
+        ):
+            all_sae_acts = [None] * len(all_stats)
+            for plm_layer, sae_idxs in layer_to_sae_idxs.items():
+                # BOS and EOS tokens are already trimmed. Only the (len(seq), k) values
+                # and latent indices are kept, never the dense (len(seq), sae_dim) acts.
+                group_acts = sae_groups[plm_layer].get_acts_sparse(esm_layer_acts[plm_layer])
+                for sae_idx, (values, indices) in zip(sae_idxs, group_acts):
+                    all_sae_acts[sae_idx] = (values.cpu().numpy(), indices.cpu().numpy())
+            yield seq_idx, all_sae_acts
+            # Clear CUDA cache periodically
+            if i % 100 == 0:
+                torch.cuda.empty_cache()
 
-    for checkpoint_file in checkpoint_files:
+    if stage == "pass1" and merge_shards:
+        all_stats = load_merged_partial_stats(partials_dir, num_shards)
+    elif stage == "pass1":
+        shard_seq_idxs = list(range(shard_index, len(df), num_shards))
+        for n, (seq_idx, all_sae_acts) in enumerate(
+            iter_sae_acts(
+                shard_seq_idxs[num_seqs_done:],
+                "Running inference over all seqs (Step 1/3)",
+            ),
+            start=num_seqs_done + 1,
+        ):
+            for stats, (values, indices) in zip(all_stats, all_sae_acts):
+                stats.add_sparse(seq_idx, values, indices)
+            if n % checkpoint_every == 0:
+                checkpoint(stage, n)
+        if num_shards > 1:
+            save_partial_stats(partials_dir, shard_index, num_shards, all_stats)
+            click.echo(f"Saved the partial statistics of shard {shard_index} to {partials_dir}")
+            return
+
+    if stage == "pass1":
+        for stats in all_stats:
+            stats.finalize()
+        stage, num_seqs_done = ("pass2" if two_pass else "write"), 0
+        checkpoint(stage, num_seqs_done)
+
+    if stage == "pass2":
+        selected_seq_idxs = sorted(set().union(*(stats.selected_seq_idxs() for stats in all_stats)))
+        for n, (seq_idx, all_sae_acts) in enumerate(
+            iter_sae_acts(
+                selected_seq_idxs[num_seqs_done:],
+                "Re-running inference over selected seqs",
+            ),
+            start=num_seqs_done + 1,
+        ):
+            for stats, (values, indices) in zip(all_stats, all_sae_acts):
+                stats.add_dim_acts_sparse(seq_idx, values, indices)
+            if n % checkpoint_every == 0:
+                checkpoint(stage, n)
+        stage, num_seqs_done = "write", 0
+        checkpoint(stage, num_seqs_done)
+
+    for i, checkpoint_file in enumerate(checkpoint_files):
         click.echo(f"Generating visualization files for {checkpoint_file}")
+        # Checkpoints get their own output directory so they don't overwrite each other
+        output_dir = (
+            OUTPUT_ROOT_DIR
+            if len(checkpoint_files) == 1
+            else os.path.join(
+                OUTPUT_ROOT_DIR, os.path.splitext(os.path.basename(checkpoint_file))[0]
+            )
+        )
+        write_viz_files(
+            output_dir,
+            df,
+            all_stats[i],
+            num_write_workers,
+            output_format,
+            skip_existing=run_state is not None,
+        )
 
-        pattern = r"plm(\d+).*?l(\d+).*?sae(\d+)"
-        matches = re.search(pattern, checkpoint_file)
 
-        if matches:
-            plm_dim, plm_layer, sae_dim = map(int, matches.groups())
-        else:
-            raise ValueError(
-                "Checkpoint file must be named in the format plm<n>_l<n>_sae<n>"
-            )
+def parse_checkpoint_file_name(checkpoint_file: str) -> tuple[int, int, int]:
+    """
+    Returns the (plm_dim, plm_layer, sae_dim) encoded in a checkpoint file name.
+    """
+    pattern = r"plm(\d+).*?l(\d+).*?sae(\d+)"
+    matches = re.search(pattern, checkpoint_file)
+
+    if matches:
+        plm_dim, plm_layer, sae_dim = map(int, matches.groups())
+    else:
+        raise ValueError("Checkpoint file must be named in the format plm<n>_l<n>_sae<n>")
+    return plm_dim, plm_layer, sae_dim
+
+
+def load_sae_model(
+    checkpoint_file: str, plm_dim: int, sae_dim: int, device: torch.device
+) -> SparseAutoencoder:
+    sae_model = SparseAutoencoder(plm_dim, sae_dim).to(device)
+
+    try:
+        sae_model.load_state_dict(torch.load(checkpoint_file, map_location=device))
+    except Exception:
+        sae_model.load_state_dict(
+            {
+                k.replace("sae_model.", ""): v
+                for k, v in torch.load(checkpoint_file, map_location=device)["state_dict"].items()
+            }
+        )
+    return sae_model
 
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        tokenizer = AutoTokenizer.from_pretrained("facebook/esm2_t33_650M_UR50D")
-        plm_model = (
-            EsmModel.from_pretrained("facebook/esm2_t33_650M_UR50D").to(device).eval()
+
+def write_viz_files(
+    output_dir,
+    df,
+    top_examples,
+    num_workers=1,
+    output_format="json",
+    skip_existing=False,
+):
+    """
+    Collect the statistics and example sequences of each SAE latent from a finalized
+    `TopExamplesReducer` or `SparseMaxActivations` and write one visualization file
+    per latent (Steps 2 and 3). The files are written in batches of
+    `WRITE_BATCH_SIZE` latents by `num_workers` processes. With `output_format`
+    "shards" or "both", the files are (also) written as a `write_viz_shards` bundle
+    under `<output_dir>/shards`. With `skip_existing`, latents whose JSON file
+    already exists, e.g. from an interrupted run, are not written again.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    sae_dim = top_examples.sae_dim
+    has_pfam = "Pfam" in df.columns
+
+    hidden_dim_to_seqs = {dim: {} for dim in range(sae_dim)}
+    range_names = [f"{start}-{end}" for start, end in top_examples.act_ranges]
+
+    # Get top Pfam families for sequences with activations greater than 0.75
+    if has_pfam:
+        strong_seq_idxs = [top_examples.strong_seq_idxs(dim) for dim in range(sae_dim)]
+        top_pfams = get_top_pfams(
+            make_pfam_index(df),
+            top_examples.n_seqs,
+            np.repeat(np.arange(sae_dim), [len(idxs) for idxs in strong_seq_idxs]),
+            np.concatenate(strong_seq_idxs),
+            n_classes=3,
+            frac_above_threshold=0.8,
         )
-        sae_model = SparseAutoencoder(plm_dim, sae_dim).to(device)
 
-        try:
-            sae_model.load_state_dict(torch.load(checkpoint_file, map_location=device))
-        except Exception:
-            sae_model.load_state_dict(
-                {
-                    k.replace("sae_model.", ""): v
-                    for k, v in torch.load(checkpoint_file, map_location=device)[
-                        "state_dict"
-                    ].items()
-                }
-            )
+    for dim in tqdm(range(sae_dim), desc="Finding highest activating seqs (Step 2/3)"):
+        n_seqs = int(top_examples.n_seqs[dim])
 
-        df = pl.read_parquet(sequences_file)
-        has_pfam = "Pfam" in df.columns
+        if n_seqs == 0:
+            print(f"Skipping dimension {dim} as it has no activations")
+            continue
 
-        # Pre-allocate numpy array for storing max activations
-        all_seqs_max_act = np.zeros((sae_dim, len(df)))
-        all_acts = [0 for _ in range(len(df))]
+        if has_pfam:
+            hidden_dim_to_seqs[dim]["top_pfam"] = top_pfams[dim]
+
+        hidden_dim_to_seqs[dim]["freq_active"] = n_seqs / top_examples.num_seqs_added
+        hidden_dim_to_seqs[dim]["n_seqs"] = n_seqs
+        hidden_dim_to_seqs[dim]["max_act"] = float(top_examples.max_act[dim])
+
+        for range_name, top_indices in top_examples.top_seq_idxs(dim).items():
+            hidden_dim_to_seqs[dim][range_name] = {}
+            hidden_dim_to_seqs[dim][range_name]["indices"] = top_indices
+
+    # Gather the metadata of every example sequence once instead of per file
+    example_seq_idxs = sorted(
+        {
+            seq_idx
+            for dim_info in hidden_dim_to_seqs.values()
+            for range_name in range_names
+            if range_name in dim_info
+            for seq_idx in dim_info[range_name]["indices"]
+        }
+    )
+    proteins = dict(
+        zip(
+            example_seq_idxs,
+            df[example_seq_idxs]
+            .select(["Sequence", "AlphaFoldDB", "Entry", "Protein names"])
+            .iter_rows(),
+        )
+    )
 
-        for seq_idx, row in tqdm(
-            enumerate(df.iter_rows(named=True)),
-            total=len(df),
-            desc="Running inference over all seqs (Step 1/3)",
-        ):
-            seq = row["Sequence"]
-            # Get ESM activations and immediately detach from computation graph
-            esm_layer_acts = get_esm_layer_acts(seq, tokenizer, plm_model, plm_layer)
-
-            # Process activations in chunks if sequence is too long
-            sae_acts = sae_model.get_acts(esm_layer_acts)[1:-1]
-
-            # Move to CPU and convert to numpy immediately
-            sae_acts_cpu = sae_acts.cpu().numpy()
-            all_seqs_max_act[:, seq_idx] = np.max(sae_acts_cpu, axis=0)
-            sae_acts_int = (sae_acts_cpu).astype(np.float16)
-            # Convert to sparse matrix. This significantly reduces memory usage
-            sparse_acts = sparse.csr_matrix(sae_acts_int)
-            all_acts[seq_idx] = sparse_acts
-            # Clear CUDA cache periodically
-            if seq_idx % 100 == 0:
-                torch.cuda.empty_cache()
+    viz_files = []
+    for dim in range(sae_dim):
+        if not hidden_dim_to_seqs[dim]:
+            print(f"Skipping dimension {dim} as it has no sequences")
+            continue
+        viz_files.append(
+            (
+                dim,
+                make_viz_file(hidden_dim_to_seqs[dim], dim, top_examples, proteins, range_names),
+            )
+        )
 
-        # Save intermediate results
-        with open(os.path.join(OUTPUT_ROOT_DIR, "all_seqs_max_act.npy"), "wb") as f:
-            np.save(f, all_seqs_max_act)
+    if output_format in ("shards", "both"):
+        write_viz_shards(os.path.join(output_dir, "shards"), viz_files)
+    if output_format == "shards":
+        return
+
+    if skip_existing:
+        viz_files = [
+            (dim, viz_file)
+            for dim, viz_file in viz_files
+            if not os.path.exists(os.path.join(output_dir, f"{dim}.json"))
+        ]
+    batches = [
+        viz_files[i : i + WRITE_BATCH_SIZE] for i in range(0, len(viz_files), WRITE_BATCH_SIZE)
+    ]
+    with tqdm(total=len(viz_files), desc="Writing visualization files (Step 3/3)") as pbar:
+        if num_workers <= 1:
+            for batch in batches:
+                pbar.update(write_viz_file_batch(output_dir, batch))
+        else:
+            with ProcessPoolExecutor(num_workers) as executor:
+                futures = [
+                    executor.submit(write_viz_file_batch, output_dir, batch) for batch in batches
+                ]
+                for future in as_completed(futures):
+                    pbar.update(future.result())
 
-        hidden_dim_to_seqs = {dim: {} for dim in range(sae_dim)}
 
-        act_ranges = [[0, 0.25], [0.25, 0.5], [0.5, 0.75], [0.75, 1]]
-        range_names = [f"{start}-{end}" for start, end in act_ranges]
+def make_viz_file(dim_info, dim, top_examples, proteins, range_names):
+    """
+    Build the visualization file of a latent. The per-residue activations are kept as
+    float16 arrays and only rounded to lists by `write_viz_file_batch`.
 
-        for dim in tqdm(
-            range(sae_dim), desc="Finding highest activating seqs (Step 2/3)"
-        ):
-            dim_maxes = all_seqs_max_act[dim]
-            non_zero_maxes = dim_maxes[dim_maxes > 0]
-
-            if len(non_zero_maxes) == 0:
-                print(f"Skipping dimension {dim} as it has no activations")
-                continue
-
-            # Get top Pfam families for sequences with activations greater than 0.75
-            if has_pfam:
-                top_families = get_top_pfam(
-                    df, dim_maxes, act_gt=0.75, n_classes=3, frac_above_threshold=0.8
-                )
-                hidden_dim_to_seqs[dim]["top_pfam"] = top_families
-
-            non_zero_maxes = dim_maxes[dim_maxes > 0]
-            hidden_dim_to_seqs[dim]["freq_active"] = len(non_zero_maxes) / len(
-                dim_maxes
-            )
-            hidden_dim_to_seqs[dim]["n_seqs"] = len(non_zero_maxes)
-            hidden_dim_to_seqs[dim]["max_act"] = float(dim_maxes.max())
-
-            normalized_acts = dim_maxes / dim_maxes.max()
-            for i, (start, end) in enumerate(act_ranges):
-                mask = (normalized_acts > start) & (normalized_acts <= end)
-                top_indices = heapq.nlargest(
-                    NUM_SEQS_PER_DIM, np.where(mask)[0], key=lambda i: dim_maxes[i]
-                )
-                range_name = range_names[i]
-                hidden_dim_to_seqs[dim][range_name] = {}
-                hidden_dim_to_seqs[dim][range_name]["indices"] = top_indices
-
-        for dim in tqdm(range(sae_dim), desc="Writing visualization files (Step 3/3)"):
-            if not hidden_dim_to_seqs[dim]:
-                print(f"Skipping dimension {dim} as it has no sequences")
-                continue
-            write_viz_file(hidden_dim_to_seqs[dim], dim, all_acts, df, range_names)
-            
-
-def write_viz_file(dim_info, dim, all_acts, df, range_names):
+    Args:
+        dim_info: Statistics and top sequence indices of the latent.
+        dim: The latent.
+        top_examples: Finalized `TopExamplesReducer` or `SparseMaxActivations`.
+        proteins: Dict mapping a sequence index to its (sequence, AlphaFoldDB,
+            UniProt ID, protein name) row.
+        range_names: Names of the activation ranges.
+    """
     viz_file = {"ranges": {}}
     # Write how common the dimension is
     if "freq_active" in dim_info:
@@ -182,17 +511,12 @@ def write_viz_file(dim_info, dim, all_acts, df, range_names):
 
         for seq_idx in top_indices:
             seq_idx = int(seq_idx)
-            sae_acts = all_acts[seq_idx].toarray()
-            dim_acts = sae_acts[:, dim]
-            uniprot_id = df[seq_idx]["Entry"].item()
-            alphafolddb_id = df[seq_idx]["AlphaFoldDB"].item().split(";")[0]
-            protein_name = df[seq_idx]["Protein names"].item()
-            sequence = df[seq_idx]["Sequence"].item()
+            sequence, alphafolddb_ids, uniprot_id, protein_name = proteins[seq_idx]
 
             examples = {
-                "sae_acts": [round(float(act), 1) for act in dim_acts],
+                "sae_acts": top_examples.get_dim_acts(dim, seq_idx),
                 "sequence": sequence,
-                "alphafold_id": alphafolddb_id,
+                "alphafold_id": alphafolddb_ids.split(";")[0],
                 "uniprot_id": uniprot_id,
                 "name": protein_name,
             }
@@ -200,65 +524,113 @@ def write_viz_file(dim_info, dim, all_acts, df, range_names):
 
         viz_file["ranges"][range_name] = range_examples
 
-    with open(os.path.join(OUTPUT_ROOT_DIR, f"{dim}.json"), "w") as f:
-        json.dump(viz_file, f)
+    return viz_file
 
 
+def write_viz_file_batch(output_dir, batch):
+    """
+    Write a batch of (dim, viz_file) pairs built by `make_viz_file` to
+    `<output_dir>/<dim>.json`. Runs in worker processes.
 
-def get_top_pfam(df, dim_maxes, act_gt=0.75, n_classes=3, frac_above_threshold=0.8):
+    Returns:
+        The number of files written.
     """
-    Gets the top Pfam families of sequences with activations greater than a threshold.
-    For all sequences with activations greater than the threshold, it will return the top
-    n_classes Pfam families if they account for at least frac_above_threshold of the sequences.
+    for dim, viz_file in batch:
+        # Written atomically so an interrupted run never leaves a partial file
+        atomic_write(
+            os.path.join(output_dir, f"{dim}.json"),
+            json.dumps(viz_file, default=round_acts),
+        )
+    return len(batch)
 
-    Args:
-        df: DataFrame containing the sequences
-        dim_maxes: Numpy array of max activations for each sequence
-        act_gt: Threshold for activations
-        n_classes: Number of top Pfam families to return
-        frac_above_threshold: Fraction of sequences that must be accounted for by the top n_classes Pfam families
 
-    Returns:
-        List of top Pfam families
+def round_acts(dim_acts: np.ndarray) -> list[float]:
+    return [round(act, 1) for act in dim_acts.astype(np.float64).tolist()]
+
 
+def make_pfam_index(df):
     """
-    normalized_acts = dim_maxes / dim_maxes.max()
-    df_dim = df.with_columns(pl.Series(normalized_acts).alias("act"))
-    non_zero = df_dim.filter(pl.col("act") > 0)
-    if len(non_zero) < 10:
-        return []
-
-    gt_50 = non_zero.filter(pl.col("act") > act_gt)
-    gt_50 = gt_50.with_columns(
-        pl.col("Pfam").str.strip_chars(";").str.split(";").alias("pfam_list")
-    )
-    exploded = gt_50.explode("pfam_list")
-    count_table = (
-        exploded["pfam_list"].value_counts().drop_nulls().sort("count", descending=True)
-    )
-    count_order = {value: i for i, value in enumerate(count_table["pfam_list"])}
-    exploded = (
-        exploded.with_columns(
-            pl.col("pfam_list").replace_strict(count_order).alias("pfam_ordered")
+    Explode the `Pfam` column of the sequences once into a (seq_idx, Entry, pfam,
+    complete) frame with one row per family of each sequence, for `get_top_pfams`.
+    `complete` marks sequences without missing values in any column.
+    """
+    return (
+        df.with_row_index("seq_idx")
+        .with_columns(
+            pl.col("Pfam").str.strip_chars(";").str.split(";").alias("pfam"),
+            pl.all_horizontal(pl.all().is_not_null()).alias("complete"),
         )
-        .sort("pfam_ordered")
-        .drop_nulls()
+        .explode("pfam")
+        .drop_nulls("pfam")
+        .select(pl.col("seq_idx").cast(pl.Int64), "Entry", "pfam", "complete")
     )
-    cleaned_df = exploded.unique(subset=["Entry"], maintain_order=True)
-    cleaned_df = cleaned_df.rename({"pfam_list": "pfam_common"})
+
+
+def get_top_pfams(
+    pfam_index, n_active, strong_dims, strong_seq_idxs, n_classes=3, frac_above_threshold=0.8
+):
+    """
+    Gets the top Pfam families of the sequences with strong activations of each latent.
+    Each protein counts towards its most common family among the latent's sequences,
+    and the top n_classes families are returned if they account for at least
+    frac_above_threshold of the sequences. Latents active in fewer than 10 sequences
+    get no families.
+
+    All latents are done at once with a few joins and group-bys over the (latent,
+    sequence) pairs of strong activations instead of filtering and exploding the
+    sequences of each latent separately.
+
+    Args:
+        pfam_index: Exploded Pfam families built by `make_pfam_index`.
+        n_active: (sae_dim,) number of sequences each latent is active in.
+        strong_dims: Latents of the (latent, sequence) pairs whose max activation is
+            above the threshold.
+        strong_seq_idxs: Sequences of the (latent, sequence) pairs.
+        n_classes: Number of top Pfam families to return.
+        frac_above_threshold: Fraction of sequences that must be accounted for by the
+            top n_classes Pfam families.
+
+    Returns:
+        A list with the top Pfam families of each latent.
+    """
+    strong = pl.DataFrame(
+        {
+            "dim": np.asarray(strong_dims, dtype=np.int64),
+            "seq_idx": np.asarray(strong_seq_idxs, dtype=np.int64),
+        }
+    ).filter(pl.col("dim").is_in(np.where(n_active >= 10)[0].tolist()))
+    n_strong = strong.group_by("dim").len("n_strong")
+
+    exploded = strong.join(pfam_index, on="seq_idx")
+    # Rank the families of each latent by how often they occur
+    ranks = (
+        exploded.group_by("dim", "pfam")
+        .len("count")
+        .sort(["dim", "count", "pfam"], descending=[False, True, False])
+        .with_columns(pl.int_range(pl.len()).over("dim").alias("rank"))
+    )
+    # Assign each protein to its highest ranked family
     keep = (
-        cleaned_df["pfam_common"]
-        .value_counts()
-        .drop_nulls()
-        .sort("count", descending=True)
+        exploded.filter("complete")
+        .join(ranks, on=["dim", "pfam"])
+        .group_by("dim", "Entry")
+        .agg(pl.col("rank").min())
+        .join(ranks, on=["dim", "rank"])
+        .group_by("dim", "pfam")
+        .len("count")
+        .sort(["dim", "count", "pfam"], descending=[False, True, False])
+        .group_by("dim", maintain_order=True)
+        .head(n_classes)
+        .group_by("dim")
+        .agg(pl.col("pfam"), pl.col("count").sum())
+        .join(n_strong, on="dim")
+        .filter(pl.col("count") > pl.col("n_strong") * frac_above_threshold)
     )
 
-    if len(keep) >= 1:
-        top_count = sum(keep["count"][:n_classes])
-        if top_count > (len(gt_50) * frac_above_threshold):
-            return keep["pfam_common"][:n_classes].to_list()
-
-    return []
+    top_pfams = [[] for _ in range(len(n_active))]
+    for dim, pfams in zip(keep["dim"], keep["pfam"]):
+        top_pfams[dim] = pfams.to_list()
+    return top_pfams
 
 
 if __name__ == "__main__":
@@ -0,0 +1,192 @@
+import json
+import os
+import pickle
+from typing import Any
+
+PROGRESS_FILE_NAME = "progress.json"
+
+
+class RunState:
+    def __init__(self, state_dir: str, config: dict[str, Any]):
+        """
+        Durable state of a `make_viz_files` run, so that a run killed at any step can
+        be resumed from its last checkpoint instead of redoing the pLM inference. The
+        state directory looks like this:
+
+        ```
+        state_dir/
+            progress.json      # run config, stage, number of sequences done and deltas
+            stats_3_0.pkl      # pickled statistics of each SAE at the start of stage 3
+            delta_3_0_0.pkl    # statistics of each SAE added by the checkpoints since
+            delta_3_1_0.pkl    #   then, for statistics with `pop_delta` and `merge`
+            ...
+        ```
+
+        The stage is "pass1" while running inference over all sequences, "pass2"
+        while re-running inference over the selected sequences in two-pass mode and
+        "write" once the examples of every latent are selected.
+
+        Args:
+            state_dir: Directory of the state.
+            config: Arguments that must match for a run to resume from the state,
+                e.g. the checkpoint and sequences files.
+        """
+        os.makedirs(state_dir, exist_ok=True)
+        self.state_dir = state_dir
+        self.config = config
+        self.stage = "pass1"
+        self.num_seqs_done = 0
+        self.num_stats = 0
+        self.generation = -1
+        self.num_deltas = 0
+
+        progress_path = os.path.join(state_dir, PROGRESS_FILE_NAME)
+        if os.path.exists(progress_path):
+            with open(progress_path) as f:
+                progress = json.load(f)
+            if progress["config"] != config:
+                raise ValueError(
+                    f"State in {state_dir} was written by a run with different "
+                    f"arguments: {progress['config']}"
+                )
+            self.stage = progress["stage"]
+            self.num_seqs_done = progress["num_seqs_done"]
+            self.num_stats = progress["num_stats"]
+            self.generation = progress["generation"]
+            self.num_deltas = progress.get("num_deltas", 0)
+
+    @property
+    def exists(self) -> bool:
+        return self.num_stats > 0
+
+    def _stats_path(self, generation: int, i: int) -> str:
+        return os.path.join(self.state_dir, f"stats_{generation}_{i}.pkl")
+
+    def _delta_path(self, generation: int, delta: int, i: int) -> str:
+        return os.path.join(self.state_dir, f"delta_{generation}_{delta}_{i}.pkl")
+
+    def load_stats(self) -> list:
+        """
+        Returns the statistics of each SAE saved by the last checkpoint.
+        """
+        stats = []
+        for i in range(self.num_stats):
+            with open(self._stats_path(self.generation, i), "rb") as f:
+                sae_stats = pickle.load(f)
+            for delta in range(self.num_deltas):
+                with open(self._delta_path(self.generation, delta, i), "rb") as f:
+                    sae_stats.merge(pickle.load(f))
+            if hasattr(sae_stats, "pop_delta"):
+                # Everything loaded is already checkpointed
+                sae_stats.pop_delta()
+            stats.append(sae_stats)
+        return stats
+
+    def save(self, stage: str, num_seqs_done: int, all_stats: list) -> None:
+        """
+        Checkpoint the statistics of each SAE and the progress of the run. Within a
+        stage, statistics with `pop_delta` only have what was added since the
+        previous checkpoint appended as a delta, so a checkpoint costs the same no
+        matter how many sequences were processed. Otherwise, and at the start of a
+        stage, all statistics are written to a new generation.
+
+        The statistics are synced to disk before the progress, which points to them,
+        is replaced atomically, so a run killed mid-checkpoint resumes from the
+        previous checkpoint.
+        """
+        incremental = (
+            self.exists
+            and stage == self.stage
+            and len(all_stats) == self.num_stats
+            and all(hasattr(stats, "pop_delta") for stats in all_stats)
+        )
+        generation = self.generation if incremental else self.generation + 1
+        num_deltas = self.num_deltas + 1 if incremental else 0
+        for i, stats in enumerate(all_stats):
+            if incremental:
+                save_pickle(self._delta_path(generation, num_deltas - 1, i), stats.pop_delta())
+            else:
+                if hasattr(stats, "pop_delta"):
+                    stats.pop_delta()
+                save_pickle(self._stats_path(generation, i), stats)
+        progress = {
+            "config": self.config,
+            "stage": stage,
+            "num_seqs_done": num_seqs_done,
+            "num_stats": len(all_stats),
+            "generation": generation,
+            "num_deltas": num_deltas,
+        }
+        atomic_write(
+            os.path.join(self.state_dir, PROGRESS_FILE_NAME), json.dumps(progress), fsync=True
+        )
+        if not incremental:
+            for i in range(self.num_stats):
+                os.remove(self._stats_path(self.generation, i))
+                for delta in range(self.num_deltas):
+                    os.remove(self._delta_path(self.generation, delta, i))
+        self.generation = generation
+        self.num_deltas = num_deltas
+        self.stage = stage
+        self.num_seqs_done = num_seqs_done
+        self.num_stats = len(all_stats)
+
+
+def atomic_write(path: str, data: str, fsync: bool = False) -> None:
+    """
+    Write a file such that readers see either its old or its new content. With
+    `fsync`, the new content is on disk before it replaces the old one.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(data)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def save_pickle(path: str, obj: Any) -> None:
+    """
+    Atomically pickle an object to a file, synced to disk.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def partial_stats_path(partials_dir: str, shard_index: int, num_shards: int) -> str:
+    return os.path.join(partials_dir, f"shard_{shard_index:05d}_of_{num_shards:05d}.pkl")
+
+
+def save_partial_stats(
+    partials_dir: str, shard_index: int, num_shards: int, all_stats: list
+) -> None:
+    """
+    Save the first pass statistics of each SAE over one shard of the sequences, to be
+    combined by `load_merged_partial_stats`.
+    """
+    os.makedirs(partials_dir, exist_ok=True)
+    save_pickle(partial_stats_path(partials_dir, shard_index, num_shards), all_stats)
+
+
+def load_merged_partial_stats(partials_dir: str, num_shards: int) -> list:
+    """
+    Load the partial statistics of all shards and merge them into the statistics of
+    each SAE over all sequences.
+    """
+    paths = [partial_stats_path(partials_dir, i, num_shards) for i in range(num_shards)]
+    missing = [path for path in paths if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError(f"Missing partial statistics of shards: {missing}")
+
+    with open(paths[0], "rb") as f:
+        all_stats = pickle.load(f)
+    for path in paths[1:]:
+        with open(path, "rb") as f:
+            for stats, shard_stats in zip(all_stats, pickle.load(f), strict=True):
+                stats.merge(shard_stats)
+    return all_stats
@@ -0,0 +1,415 @@
+import itertools
+from typing import Callable, Optional
+
+import numpy as np
+from scipy import sparse
+
+ACT_RANGES = [[0, 0.25], [0.25, 0.5], [0.5, 0.75], [0.75, 1]]
+
+
+def sparse_seq_maxes(values: np.ndarray, indices: np.ndarray, sae_dim: int) -> np.ndarray:
+    """
+    Returns the (sae_dim,) max activation of each latent over a sequence, given its
+    (len(seq), k) sparse SAE activations, e.g. from `get_acts_sparse`. This is a
+    scatter-max over the indices, so the dense activations are never built.
+    """
+    seq_maxes = np.zeros(sae_dim, dtype=np.float32)
+    np.maximum.at(seq_maxes, indices.ravel(), values.ravel())
+    return seq_maxes
+
+
+class TopExamplesReducer:
+    def __init__(
+        self,
+        sae_dim: int,
+        num_examples: int,
+        act_ranges: list[list[float]] = ACT_RANGES,
+        strong_act_gt: Optional[float] = None,
+        chunk_size: int = 256,
+    ):
+        """
+        Streaming reducer that keeps, for each SAE latent and each range of max
+        activations relative to the latent's overall max activation, the
+        `num_examples` highest activating sequences. Only the per-residue activations
+        of those sequences are kept, so memory is O(sae_dim * num_examples) instead of
+        O(num_seqs * sae_dim).
+
+        Sequences are buffered and merged into the per-latent candidates in vectorized
+        chunks of `chunk_size` sequences. The ranges are relative to the running max
+        activation, and candidates are re-bucketed whenever it grows. The top range is
+        always exact; the lower ranges are picked from the candidates kept so far, so
+        they can differ from an exact selection if a latent's max activation grows late
+        in the stream. Use `SparseMaxActivations` for an exact selection.
+
+        Args:
+            sae_dim: Number of SAE latents.
+            num_examples: Number of sequences to keep per latent and range.
+            act_ranges: (start, end] ranges of max activations relative to the
+                latent's max activation.
+            strong_act_gt: If set, also track all sequences whose max activation is
+                above this fraction of the latent's max activation, e.g. for
+                `get_top_pfams`.
+            chunk_size: Number of sequences merged at a time.
+        """
+        self.sae_dim = sae_dim
+        self.num_examples = num_examples
+        self.act_ranges = act_ranges
+        self.strong_act_gt = strong_act_gt
+        self.chunk_size = chunk_size
+
+        num_candidates = len(act_ranges) * num_examples
+        # A value of 0 marks an empty candidate slot
+        self.candidate_acts = np.zeros((sae_dim, num_candidates), dtype=np.float32)
+        self.candidate_seqs = np.full((sae_dim, num_candidates), -1, dtype=np.int64)
+        self.max_act = np.zeros(sae_dim, dtype=np.float32)
+        self.n_seqs = np.zeros(sae_dim, dtype=np.int64)
+        self.num_seqs_added = 0
+
+        # Per-residue activations of the current candidates, keyed by
+        # `seq_idx * sae_dim + dim`
+        self.dim_acts: dict[int, np.ndarray] = {}
+
+        self._strong_dims = np.zeros(0, dtype=np.int64)
+        self._strong_seqs = np.zeros(0, dtype=np.int64)
+        self._strong_acts = np.zeros(0, dtype=np.float32)
+
+        self._chunk_seqs: list[int] = []
+        self._chunk_maxes: list[np.ndarray] = []
+        self._chunk_acts: list[sparse.csc_matrix] = []
+
+    def add(self, seq_idx: int, sae_acts: np.ndarray) -> None:
+        """
+        Add the (len(seq), sae_dim) SAE activations of a sequence.
+        """
+        self._add(seq_idx, sae_acts.max(axis=0), sparse.csc_matrix(sae_acts.astype(np.float32)))
+
+    def add_sparse(self, seq_idx: int, values: np.ndarray, indices: np.ndarray) -> None:
+        """
+        Same as `add`, given the (len(seq), k) values and latent indices of the SAE
+        activations of a sequence, e.g. from `get_acts_sparse`.
+        """
+        seq_len, k = indices.shape
+        sae_acts = sparse.csr_matrix(
+            (values.ravel().astype(np.float32), indices.ravel(), np.arange(0, seq_len * k + 1, k)),
+            shape=(seq_len, self.sae_dim),
+        )
+        self._add(seq_idx, sparse_seq_maxes(values, indices, self.sae_dim), sae_acts.tocsc())
+
+    def _add(self, seq_idx: int, seq_maxes: np.ndarray, sae_acts: sparse.csc_matrix) -> None:
+        self.n_seqs += seq_maxes > 0
+        self.num_seqs_added += 1
+        self._chunk_seqs.append(seq_idx)
+        self._chunk_maxes.append(seq_maxes)
+        self._chunk_acts.append(sae_acts)
+        if len(self._chunk_seqs) >= self.chunk_size:
+            self._merge_chunk()
+
+    def _merge_chunk(self) -> None:
+        if not self._chunk_seqs:
+            return
+        chunk_seqs = np.array(self._chunk_seqs, dtype=np.int64)
+        chunk_maxes = np.stack(self._chunk_maxes, axis=1)  # (sae_dim, chunk_size)
+        chunk_pos = {seq_idx: pos for pos, seq_idx in enumerate(self._chunk_seqs)}
+
+        def get_dim_acts(seq_idx: int, dims: np.ndarray) -> np.ndarray:
+            return self._chunk_acts[chunk_pos[seq_idx]][:, dims].toarray().T
+
+        self._merge_candidates(
+            chunk_maxes, np.broadcast_to(chunk_seqs, chunk_maxes.shape), get_dim_acts
+        )
+        if self.strong_act_gt is not None:
+            chunk_dims, chunk_pos_idxs = np.nonzero(chunk_maxes)
+            self._merge_strong(
+                chunk_dims,
+                chunk_seqs[chunk_pos_idxs],
+                chunk_maxes[chunk_dims, chunk_pos_idxs],
+            )
+
+        self._chunk_seqs, self._chunk_maxes, self._chunk_acts = [], [], []
+
+    def _merge_candidates(
+        self,
+        other_acts: np.ndarray,
+        other_seqs: np.ndarray,
+        get_dim_acts: Callable[[int, np.ndarray], np.ndarray],
+    ) -> None:
+        """
+        Merge (sae_dim, m) max activations and sequence indices of other candidates
+        into the current ones. `get_dim_acts(seq_idx, dims)` returns the per-residue
+        activations of a sequence for the given latents as (len(dims), len(seq)).
+        """
+        self.max_act = np.maximum(self.max_act, other_acts.max(axis=1))
+
+        acts = np.concatenate([self.candidate_acts, other_acts], axis=1)
+        seqs = np.concatenate([self.candidate_seqs, other_seqs], axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            normalized_acts = acts / self.max_act[:, None].astype(np.float64)
+
+        new_acts = np.zeros_like(self.candidate_acts)
+        new_seqs = np.full_like(self.candidate_seqs, -1)
+        n = self.num_examples
+        for i, (start, end) in enumerate(self.act_ranges):
+            in_range = (normalized_acts > start) & (normalized_acts <= end)
+            range_acts = np.where(in_range, acts, 0)
+            top = np.argpartition(-range_acts, n - 1, axis=1)[:, :n]
+            top_acts = np.take_along_axis(range_acts, top, axis=1)
+            new_acts[:, i * n : (i + 1) * n] = top_acts
+            new_seqs[:, i * n : (i + 1) * n] = np.where(
+                top_acts > 0, np.take_along_axis(seqs, top, axis=1), -1
+            )
+
+        # Keep the per-residue activations of new candidates and drop evicted ones.
+        # Re-bucketed candidates keep their key, so all new keys are from the other
+        # candidates.
+        dims = np.broadcast_to(np.arange(self.sae_dim)[:, None], new_seqs.shape)
+        old_keys = self._keys(self.candidate_seqs, dims)
+        new_keys = self._keys(new_seqs, dims)
+        for key in np.setdiff1d(old_keys, new_keys):
+            del self.dim_acts[key]
+        added_keys = np.setdiff1d(new_keys, old_keys)
+        added_seqs, added_dims = np.divmod(added_keys, self.sae_dim)
+        for seq_idx in np.unique(added_seqs):
+            seq_dims = added_dims[added_seqs == seq_idx]
+            seq_acts = get_dim_acts(seq_idx, seq_dims)
+            for dim, dim_acts in zip(seq_dims, seq_acts.astype(np.float16)):
+                self.dim_acts[int(seq_idx * self.sae_dim + dim)] = dim_acts
+
+        self.candidate_acts = new_acts
+        self.candidate_seqs = new_seqs
+
+    def _merge_strong(self, dims: np.ndarray, seqs: np.ndarray, acts: np.ndarray) -> None:
+        dims = np.concatenate([self._strong_dims, dims])
+        seqs = np.concatenate([self._strong_seqs, seqs])
+        acts = np.concatenate([self._strong_acts, acts])
+        is_strong = acts / self.max_act[dims].astype(np.float64) > self.strong_act_gt
+        self._strong_dims = dims[is_strong]
+        self._strong_seqs = seqs[is_strong]
+        self._strong_acts = acts[is_strong]
+
+    def _keys(self, seqs: np.ndarray, dims: np.ndarray) -> np.ndarray:
+        is_set = seqs >= 0
+        return np.unique(seqs[is_set] * self.sae_dim + dims[is_set])
+
+    def finalize(self) -> None:
+        """
+        Merge the sequences that are still buffered. Call this after the last `add`.
+        """
+        self._merge_chunk()
+        order = np.lexsort((self._strong_seqs, self._strong_dims))
+        self._strong_dims = self._strong_dims[order]
+        self._strong_seqs = self._strong_seqs[order]
+        self._strong_acts = self._strong_acts[order]
+
+    def top_seq_idxs(self, dim: int) -> dict[str, list[int]]:
+        """
+        Returns the indices of the highest activating sequences of a latent for each
+        activation range, ordered by decreasing max activation.
+        """
+        n = self.num_examples
+        res = {}
+        for i, (start, end) in enumerate(self.act_ranges):
+            acts = self.candidate_acts[dim, i * n : (i + 1) * n]
+            seqs = self.candidate_seqs[dim, i * n : (i + 1) * n]
+            order = np.lexsort((seqs, -acts))
+            res[f"{start}-{end}"] = [int(seqs[j]) for j in order if seqs[j] >= 0]
+        return res
+
+    def strong_seq_idxs(self, dim: int) -> np.ndarray:
+        """
+        Returns the sorted indices of the sequences whose max activation is above
+        `strong_act_gt` of the latent's max activation.
+        """
+        start, end = np.searchsorted(self._strong_dims, [dim, dim + 1])
+        return self._strong_seqs[start:end]
+
+    def get_dim_acts(self, dim: int, seq_idx: int) -> np.ndarray:
+        """
+        Returns the (len(seq),) per-residue activations of a latent for one of its
+        top sequences.
+        """
+        return self.dim_acts[seq_idx * self.sae_dim + dim]
+
+
+class SparseMaxActivations:
+    def __init__(
+        self,
+        sae_dim: int,
+        num_examples: int,
+        act_ranges: list[list[float]] = ACT_RANGES,
+        strong_act_gt: Optional[float] = None,
+    ):
+        """
+        Exact two-pass selection of the examples of each SAE latent, used by default
+        instead of `TopExamplesReducer`. The first pass only keeps the non-zero
+        per-sequence max activation of each latent, as float16, and the examples are
+        picked exactly from those. The second pass re-runs inference on
+        the selected sequences only and keeps their per-residue activations of the
+        latents that selected them (see `add_dim_acts`).
+
+        Args:
+            sae_dim: Number of SAE latents.
+            num_examples: Number of sequences to pick per latent and range.
+            act_ranges: (start, end] ranges of max activations relative to the
+                latent's max activation.
+            strong_act_gt: If set, also find all sequences whose max activation is
+                above this fraction of the latent's max activation, e.g. for
+                `get_top_pfams`.
+        """
+        self.sae_dim = sae_dim
+        self.num_examples = num_examples
+        self.act_ranges = act_ranges
+        self.strong_act_gt = strong_act_gt
+
+        self.max_act = np.zeros(sae_dim, dtype=np.float32)
+        self.n_seqs = np.zeros(sae_dim, dtype=np.int64)
+        self.num_seqs_added = 0
+        self.dim_acts: dict[int, np.ndarray] = {}
+
+        self._dims: list[np.ndarray] = []
+        self._seqs: list[np.ndarray] = []
+        self._acts: list[np.ndarray] = []
+        self._top_seq_idxs: list[dict[str, list[int]]] = []
+        self._strong_seq_idxs: list[np.ndarray] = []
+        self._seq_to_dims: dict[int, list[int]] = {}
+
+        # How much of the statistics was already returned by `pop_delta`
+        self._delta_n_seqs = np.zeros(sae_dim, dtype=np.int64)
+        self._delta_num_seqs_added = 0
+        self._delta_num_chunks = 0
+        self._delta_num_dim_acts = 0
+
+    def add(self, seq_idx: int, sae_acts: np.ndarray) -> None:
+        """
+        Add the (len(seq), sae_dim) SAE activations of a sequence (first pass).
+        """
+        self._add(seq_idx, sae_acts.max(axis=0))
+
+    def add_sparse(self, seq_idx: int, values: np.ndarray, indices: np.ndarray) -> None:
+        """
+        Same as `add`, given the (len(seq), k) values and latent indices of the SAE
+        activations of a sequence, e.g. from `get_acts_sparse`.
+        """
+        self._add(seq_idx, sparse_seq_maxes(values, indices, self.sae_dim))
+
+    def _add(self, seq_idx: int, seq_maxes: np.ndarray) -> None:
+        (dims,) = np.nonzero(seq_maxes > 0)
+        self.max_act = np.maximum(self.max_act, seq_maxes)
+        self.n_seqs[dims] += 1
+        self.num_seqs_added += 1
+        self._dims.append(dims.astype(np.int32))
+        self._seqs.append(np.full(len(dims), seq_idx, dtype=np.int32))
+        self._acts.append(seq_maxes[dims].astype(np.float16))
+
+    def merge(self, other: "SparseMaxActivations") -> None:
+        """
+        Merge the statistics of another shard of the corpus, or a delta from
+        `pop_delta`, into this one. First pass statistics can only be merged before
+        `finalize`.
+        """
+        self.max_act = np.maximum(self.max_act, other.max_act)
+        self.n_seqs += other.n_seqs
+        self.num_seqs_added += other.num_seqs_added
+        self._dims.extend(other._dims)
+        self._seqs.extend(other._seqs)
+        self._acts.extend(other._acts)
+        self.dim_acts.update(other.dim_acts)
+
+    def pop_delta(self) -> "SparseMaxActivations":
+        """
+        Returns the statistics added since the last call as a new instance, which
+        `merge` adds back. Checkpoints save only these instead of all statistics.
+        """
+        delta = SparseMaxActivations(
+            self.sae_dim, self.num_examples, self.act_ranges, self.strong_act_gt
+        )
+        delta.max_act = self.max_act.copy()
+        delta.n_seqs = self.n_seqs - self._delta_n_seqs
+        delta.num_seqs_added = self.num_seqs_added - self._delta_num_seqs_added
+        delta._dims = self._dims[self._delta_num_chunks :]
+        delta._seqs = self._seqs[self._delta_num_chunks :]
+        delta._acts = self._acts[self._delta_num_chunks :]
+        delta.dim_acts = dict(
+            itertools.islice(self.dim_acts.items(), self._delta_num_dim_acts, None)
+        )
+
+        self._delta_n_seqs = self.n_seqs.copy()
+        self._delta_num_seqs_added = self.num_seqs_added
+        self._delta_num_chunks = len(self._dims)
+        self._delta_num_dim_acts = len(self.dim_acts)
+        return delta
+
+    def finalize(self) -> None:
+        """
+        Pick the examples of every latent. Call this after the last `add`.
+        """
+        dims = np.concatenate(self._dims) if self._dims else np.zeros(0, dtype=np.int32)
+        seqs = np.concatenate(self._seqs) if self._seqs else dims
+        acts = np.concatenate(self._acts) if self._acts else dims
+        order = np.lexsort((seqs, dims))
+        dims, seqs, acts = dims[order], seqs[order], acts[order]
+        self._dims, self._seqs, self._acts = [], [], []
+        self._delta_num_chunks = 0
+
+        bounds = np.searchsorted(dims, np.arange(self.sae_dim + 1))
+        for dim in range(self.sae_dim):
+            dim_seqs = seqs[bounds[dim] : bounds[dim + 1]].astype(np.int64)
+            dim_acts = acts[bounds[dim] : bounds[dim + 1]].astype(np.float64)
+            normalized_acts = dim_acts / dim_acts.max() if len(dim_acts) else dim_acts
+
+            top_seq_idxs = {}
+            for start, end in self.act_ranges:
+                mask = (normalized_acts > start) & (normalized_acts <= end)
+                top = np.lexsort((dim_seqs[mask], -dim_acts[mask]))[: self.num_examples]
+                top_seq_idxs[f"{start}-{end}"] = dim_seqs[mask][top].tolist()
+                for seq_idx in top_seq_idxs[f"{start}-{end}"]:
+                    self._seq_to_dims.setdefault(seq_idx, []).append(dim)
+            self._top_seq_idxs.append(top_seq_idxs)
+
+            if self.strong_act_gt is not None:
+                self._strong_seq_idxs.append(dim_seqs[normalized_acts > self.strong_act_gt])
+
+    def selected_seq_idxs(self) -> list[int]:
+        """
+        Returns the sorted indices of the sequences picked by any latent. Only these
+        need to be passed to `add_dim_acts` in the second pass.
+        """
+        return sorted(self._seq_to_dims)
+
+    def add_dim_acts(self, seq_idx: int, sae_acts: np.ndarray) -> None:
+        """
+        Keep the per-residue activations of the latents that picked a sequence,
+        given its (len(seq), sae_dim) SAE activations (second pass).
+        """
+        for dim in self._seq_to_dims.get(seq_idx, []):
+            self.dim_acts[seq_idx * self.sae_dim + dim] = sae_acts[:, dim].astype(np.float16)
+
+    def add_dim_acts_sparse(self, seq_idx: int, values: np.ndarray, indices: np.ndarray) -> None:
+        """
+        Same as `add_dim_acts`, given the (len(seq), k) values and latent indices of
+        the SAE activations of a sequence.
+        """
+        for dim in self._seq_to_dims.get(seq_idx, []):
+            # Top-k indices are distinct within a residue, so this picks at most one value
+            dim_acts = np.where(indices == dim, values, 0).sum(axis=1)
+            self.dim_acts[seq_idx * self.sae_dim + dim] = dim_acts.astype(np.float16)
+
+    def top_seq_idxs(self, dim: int) -> dict[str, list[int]]:
+        """
+        Returns the indices of the highest activating sequences of a latent for each
+        activation range, ordered by decreasing max activation.
+        """
+        return self._top_seq_idxs[dim]
+
+    def strong_seq_idxs(self, dim: int) -> np.ndarray:
+        """
+        Returns the sorted indices of the sequences whose max activation is above
+        `strong_act_gt` of the latent's max activation.
+        """
+        return self._strong_seq_idxs[dim]
+
+    def get_dim_acts(self, dim: int, seq_idx: int) -> np.ndarray:
+        """
+        Returns the (len(seq),) per-residue activations of a latent for one of its
+        top sequences.
+        """
+        return self.dim_acts[seq_idx * self.sae_dim + dim]
@@ -0,0 +1,131 @@
+import json
+import os
+import struct
+
+import numpy as np
+
+INDEX_FILE_NAME = "index.json"
+PROTEINS_FILE_NAME = "proteins.json"
+PROTEIN_FIELDS = ["sequence", "alphafold_id", "uniprot_id", "name"]
+QUANT_LEVELS = 255
+HEADER_LEN = struct.Struct("<I")
+
+
+def write_viz_shards(output_dir, viz_files, shard_size_mb=64.0):
+    """
+    Write the visualization files built by `make_viz_file` in a compact binary format.
+    Instead of repeating the protein metadata in every latent's file and storing the
+    activations as JSON floats, the bundle looks like this:
+
+    ```
+    output_dir/
+        proteins.json     # deduplicated [{sequence, alphafold_id, uniprot_id, name}]
+        index.json        # {"shards": [...], "latents": {dim: [shard, offset, nbytes]}}
+        shard_00000.bin   # concatenated latent records
+        ...
+    ```
+
+    Each latent record is a little-endian uint32 header length, a JSON header holding
+    the latent's statistics and, per example, its index in the protein table, followed
+    by the uint8 activations of all examples in header order. The activations are
+    quantized linearly between 0 and the record's `act_scale`, so one latent can be
+    fetched with a single range read of `nbytes` bytes at `offset`.
+
+    Args:
+        output_dir: Directory to write the bundle to.
+        viz_files: List of (dim, viz_file) pairs built by `make_viz_file`.
+        shard_size_mb: Size at which a new shard file is started.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    shard_size_bytes = int(shard_size_mb * 1024**2)
+    proteins: list[dict] = []
+    protein_idxs: dict[tuple, int] = {}
+    shards: list[str] = []
+    latents: dict[str, list[int]] = {}
+
+    f = None
+    try:
+        for dim, viz_file in viz_files:
+            header = {k: v for k, v in viz_file.items() if k != "ranges"}
+            header["ranges"] = {}
+            all_acts = []
+            for range_name, range_examples in viz_file["ranges"].items():
+                header["ranges"][range_name] = []
+                for example in range_examples["examples"]:
+                    protein = tuple(example[field] for field in PROTEIN_FIELDS)
+                    if protein not in protein_idxs:
+                        protein_idxs[protein] = len(proteins)
+                        proteins.append(dict(zip(PROTEIN_FIELDS, protein)))
+                    header["ranges"][range_name].append(protein_idxs[protein])
+                    all_acts.append(example["sae_acts"])
+
+            acts = np.concatenate(all_acts).astype(np.float32) if all_acts else np.zeros(0)
+            act_scale = float(acts.max()) if len(acts) else 0.0
+            header["act_scale"] = act_scale
+            quantized = (
+                np.round(acts / act_scale * QUANT_LEVELS) if act_scale > 0 else acts
+            ).astype(np.uint8)
+
+            header_bytes = json.dumps(header).encode()
+            record = HEADER_LEN.pack(len(header_bytes)) + header_bytes + quantized.tobytes()
+            if f is None or f.tell() >= shard_size_bytes:
+                if f is not None:
+                    f.close()
+                shards.append(f"shard_{len(shards):05d}.bin")
+                f = open(os.path.join(output_dir, shards[-1]), "wb")
+            latents[str(dim)] = [len(shards) - 1, f.tell(), len(record)]
+            f.write(record)
+    finally:
+        if f is not None:
+            f.close()
+
+    with open(os.path.join(output_dir, PROTEINS_FILE_NAME), "w") as f:
+        json.dump(proteins, f)
+    with open(os.path.join(output_dir, INDEX_FILE_NAME), "w") as f:
+        json.dump({"shards": shards, "latents": latents}, f)
+
+
+class VizShards:
+    def __init__(self, output_dir: str):
+        """
+        Reader of a bundle written by `write_viz_shards`.
+        """
+        self.output_dir = output_dir
+        with open(os.path.join(output_dir, INDEX_FILE_NAME)) as f:
+            index = json.load(f)
+        self.shards = index["shards"]
+        self.latents = {int(dim): record for dim, record in index["latents"].items()}
+        with open(os.path.join(output_dir, PROTEINS_FILE_NAME)) as f:
+            self.proteins = json.load(f)
+
+    def __contains__(self, dim: int) -> bool:
+        return dim in self.latents
+
+    def read(self, dim: int) -> dict:
+        """
+        Read the record of a latent and expand it into the same structure as its
+        per-latent JSON file, with dequantized activations rounded to 1 decimal.
+        """
+        shard_idx, offset, nbytes = self.latents[dim]
+        with open(os.path.join(self.output_dir, self.shards[shard_idx]), "rb") as f:
+            f.seek(offset)
+            record = f.read(nbytes)
+        (header_len,) = HEADER_LEN.unpack_from(record)
+        header = json.loads(record[HEADER_LEN.size : HEADER_LEN.size + header_len])
+        quantized = np.frombuffer(record, dtype=np.uint8, offset=HEADER_LEN.size + header_len)
+        acts = quantized.astype(np.float64) * header.pop("act_scale") / QUANT_LEVELS
+
+        viz_file = {k: v for k, v in header.items() if k != "ranges"}
+        viz_file["ranges"] = {}
+        start = 0
+        for range_name, protein_idxs in header["ranges"].items():
+            examples = []
+            for protein_idx in protein_idxs:
+                protein = self.proteins[protein_idx]
+                end = start + len(protein["sequence"])
+                examples.append(
+                    {"sae_acts": [round(act, 1) for act in acts[start:end].tolist()], **protein}
+                )
+                start = end
+            viz_file["ranges"][range_name] = {"examples": examples}
+        return viz_file
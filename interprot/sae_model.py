@@ -8,6 +8,7 @@ import torch.nn as nn
 from torch.nn import functional as F
 from transformers import PreTrainedModel, PreTrainedTokenizer
 
+
 class SparseAutoencoder(nn.Module):
     def __init__(
         self,
@@ -75,12 +76,51 @@ class SparseAutoencoder(nn.Module):
         3. Create a new tensor of zeros with the same shape as the input.
         4. Scatter the activated top k values back into their original positions.
         """
-        topk = torch.topk(x, k=k, dim=-1, sorted=False)
-        values = F.relu(topk.values)
+        values, indices = self.topK_sparse(x, k)
         result = torch.zeros_like(x)
-        result.scatter_(-1, topk.indices, values)
+        result.scatter_(-1, indices, values)
         return result
 
+    def topK_sparse(self, x: torch.Tensor, k: int) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Sparse counterpart of `topK_activation` that never materializes the dense
+        (..., D_HIDDEN) latent tensor.
+
+        Args:
+            x: (..., D_HIDDEN) input tensor to apply top-k activation on.
+            k: Number of top activations to keep.
+
+        Returns:
+            tuple[torch.Tensor, torch.Tensor]: A tuple containing:
+                - (..., k) ReLU-activated top k values.
+                - (..., k) hidden dim indices of those values.
+        """
+        topk = torch.topk(x, k=k, dim=-1, sorted=False)
+        return F.relu(topk.values), topk.indices
+
+    def decode_sparse_latents(self, values: torch.Tensor, indices: torch.Tensor) -> torch.Tensor:
+        """
+        Compute `latents @ self.w_dec` from the sparse (values, indices) representation
+        of the latents. This is an embedding-bag style weighted sum over the k selected
+        rows of `w_dec`, so it costs O(k * D_MODEL) per token instead of
+        O(D_HIDDEN * D_MODEL).
+
+        Args:
+            values: (..., k) activation values.
+            indices: (..., k) hidden dim indices of the activations.
+
+        Returns:
+            torch.Tensor: (..., D_MODEL) tensor equal to `latents @ self.w_dec`.
+        """
+        k = indices.shape[-1]
+        out = F.embedding_bag(
+            indices.reshape(-1, k),
+            self.w_dec,
+            per_sample_weights=values.reshape(-1, k).to(self.w_dec.dtype),
+            mode="sum",
+        )
+        return out.reshape(*indices.shape[:-1], self.d_model)
+
     def LN(
         self, x: torch.Tensor, eps: float = 1e-5
     ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
@@ -136,36 +176,38 @@ class SparseAutoencoder(nn.Module):
 
         pre_acts = x @ self.w_enc + self.b_enc
 
-        # latents: (BATCH_SIZE, D_EMBED, D_HIDDEN)
-        latents = self.topK_activation(pre_acts, k=self.k)
+        # values, indices: (BATCH_SIZE, D_EMBED, K)
+        values, indices = self.topK_sparse(pre_acts, k=self.k)
 
-        # `(latents == 0)` creates a boolean tensor element-wise from `latents`.
-        # `.all(dim=(0, 1))` preserves D_HIDDEN and does the boolean `all`
-        # operation across BATCH_SIZE and D_EMBED. Finally, `.long()` turns
-        # it into a vector of 0s and 1s of length D_HIDDEN.
+        # `fired` is a boolean vector of length D_HIDDEN that is True for every
+        # hidden dim with a non-zero activation anywhere in the batch. Hidden dims
+        # outside the top k are zero by construction, so only the selected indices
+        # with a positive (post-ReLU) value need to be checked.
         #
         # self.stats_last_nonzero is a vector of length D_HIDDEN. Doing
-        # `*=` with `M = (latents == 0).all(dim=(0, 1)).long()` has the effect
-        # of: if M[i] = 0, self.stats_last_nonzero[i] is cleared to 0, and then
-        # immediately incremented; if M[i] = 1, self.stats_last_nonzero[i] is
-        # unchanged. self.stats_last_nonzero[i] means "for how many consecutive
+        # `*=` with `(~fired).long()` has the effect of: if hidden dim i fired,
+        # self.stats_last_nonzero[i] is cleared to 0, and then immediately
+        # incremented; otherwise, self.stats_last_nonzero[i] is unchanged.
+        # self.stats_last_nonzero[i] means "for how many consecutive
         # iterations has hidden dim i been zero".
-        self.stats_last_nonzero *= (latents == 0).all(dim=(0, 1)).long()
+        fired = torch.zeros(self.d_hidden, dtype=torch.bool, device=indices.device)
+        fired[indices[values > 0]] = True
+        self.stats_last_nonzero *= (~fired).long()
         self.stats_last_nonzero += 1
 
         dead_mask = self.auxk_mask_fn()
         num_dead = dead_mask.sum().item()
 
-        recons = latents @ self.w_dec + self.b_pre
+        recons = self.decode_sparse_latents(values, indices) + self.b_pre
         recons = recons * std + mu
 
         if num_dead > 0:
             k_aux = min(x.shape[-1] // 2, num_dead)
 
             auxk_latents = torch.where(dead_mask[None], pre_acts, -torch.inf)
-            auxk_acts = self.topK_activation(auxk_latents, k=k_aux)
+            auxk_values, auxk_indices = self.topK_sparse(auxk_latents, k=k_aux)
 
-            auxk = auxk_acts @ self.w_dec + self.b_pre
+            auxk = self.decode_sparse_latents(auxk_values, auxk_indices) + self.b_pre
             auxk = auxk * std + mu
         else:
             auxk = None
@@ -186,9 +228,9 @@ class SparseAutoencoder(nn.Module):
         x, mu, std = self.LN(x)
         x = x - self.b_pre
         pre_acts = x @ self.w_enc + self.b_enc
-        latents = self.topK_activation(pre_acts, self.k)
+        values, indices = self.topK_sparse(pre_acts, self.k)
 
-        recons = latents @ self.w_dec + self.b_pre
+        recons = self.decode_sparse_latents(values, indices) + self.b_pre
         recons = recons * std + mu
         return recons
 
@@ -224,6 +266,23 @@ class SparseAutoencoder(nn.Module):
         latents = self.topK_activation(pre_acts, self.k)
         return latents
 
+    @torch.no_grad()
+    def get_acts_sparse(self, x: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Get the activations of the Sparse Autoencoder as (values, indices) pairs
+        without materializing the dense (..., D_HIDDEN) latent tensor.
+
+        Args:
+            x: (BATCH_SIZE, D_EMBED, D_MODEL) input tensor to the SAE.
+
+        Returns:
+            tuple[torch.Tensor, torch.Tensor]: A tuple containing:
+                - (BATCH_SIZE, D_EMBED, K) activation values.
+                - (BATCH_SIZE, D_EMBED, K) hidden dim indices of the activations.
+        """
+        values, indices, _, _ = self.encode_sparse(x)
+        return values, indices
+
     @torch.no_grad()
     def encode(self, x: torch.Tensor) -> torch.Tensor:
         x, mu, std = self.LN(x)
@@ -231,15 +290,113 @@ class SparseAutoencoder(nn.Module):
         acts = x @ self.w_enc + self.b_enc
         return acts, mu, std
 
+    @torch.no_grad()
+    def encode_sparse(
+        self, x: torch.Tensor
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Encode the input into sparse top-k latents. The output can be passed
+        directly to `decode_sparse`.
+
+        Args:
+            x: (BATCH_SIZE, D_EMBED, D_MODEL) input tensor to the SAE.
+
+        Returns:
+            tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]: A tuple
+            containing the (..., K) activation values, the (..., K) hidden dim
+            indices, and the mean and standard deviation from the input LayerNorm.
+        """
+        acts, mu, std = self.encode(x)
+        values, indices = self.topK_sparse(acts, self.k)
+        return values, indices, mu, std
+
     @torch.no_grad()
     def decode(self, acts: torch.Tensor, mu: torch.Tensor, std: torch.Tensor) -> torch.Tensor:
-        latents = self.topK_activation(acts, self.k)
+        values, indices = self.topK_sparse(acts, self.k)
+        return self.decode_sparse(values, indices, mu, std)
 
-        recons = latents @ self.w_dec + self.b_pre
+    @torch.no_grad()
+    def decode_sparse(
+        self,
+        values: torch.Tensor,
+        indices: torch.Tensor,
+        mu: torch.Tensor,
+        std: torch.Tensor,
+    ) -> torch.Tensor:
+        """
+        Decode sparse (values, indices) latents, e.g. from `encode_sparse`, back into
+        the pLM activation space.
+
+        Args:
+            values: (..., K) activation values.
+            indices: (..., K) hidden dim indices of the activations.
+            mu: Mean from the input LayerNorm.
+            std: Standard deviation from the input LayerNorm.
+
+        Returns:
+            torch.Tensor: (..., D_MODEL) reconstructed activations.
+        """
+        recons = self.decode_sparse_latents(values, indices) + self.b_pre
         recons = recons * std + mu
         return recons
 
 
+class SparseAutoencoderGroup:
+    def __init__(self, sae_models: list[SparseAutoencoder]):
+        """
+        Several SAEs trained on the same pLM layer, evaluated together. The input
+        LayerNorm is shared, and the encoders are fused into a single matmul by
+        folding each SAE's pre-encoder bias into its encoder bias:
+        `(x - b_pre) @ w_enc + b_enc = x @ w_enc + (b_enc - b_pre @ w_enc)`.
+
+        Args:
+            sae_models: The SAEs to group. They must have the same d_model.
+        """
+        self.sae_models = sae_models
+        with torch.no_grad():
+            self.w_enc = torch.cat([sae.w_enc for sae in sae_models], dim=1)
+            self.b_enc = torch.cat([sae.b_enc - sae.b_pre @ sae.w_enc for sae in sae_models])
+
+    @torch.no_grad()
+    def get_acts(self, x: torch.Tensor) -> list[torch.Tensor]:
+        """
+        Get the activations of each SAE in the group.
+
+        Args:
+            x: (BATCH_SIZE, D_EMBED, D_MODEL) input tensor to the SAEs.
+
+        Returns:
+            list[torch.Tensor]: `sae.get_acts(x)` of each SAE, in order.
+        """
+        return [
+            sae.topK_activation(sae_pre_acts, sae.k)
+            for sae, sae_pre_acts in zip(self.sae_models, self._split_pre_acts(x))
+        ]
+
+    @torch.no_grad()
+    def get_acts_sparse(self, x: torch.Tensor) -> list[tuple[torch.Tensor, torch.Tensor]]:
+        """
+        Sparse counterpart of `get_acts` that never materializes the dense
+        (..., D_HIDDEN) latent tensor of any SAE.
+
+        Args:
+            x: (BATCH_SIZE, D_EMBED, D_MODEL) input tensor to the SAEs.
+
+        Returns:
+            list[tuple[torch.Tensor, torch.Tensor]]: `sae.get_acts_sparse(x)` of each
+            SAE, in order.
+        """
+        return [
+            sae.topK_sparse(sae_pre_acts, sae.k)
+            for sae, sae_pre_acts in zip(self.sae_models, self._split_pre_acts(x))
+        ]
+
+    def _split_pre_acts(self, x: torch.Tensor) -> tuple[torch.Tensor, ...]:
+        x, _, _ = self.sae_models[0].LN(x)
+        pre_acts = x @ self.w_enc + self.b_enc
+        return pre_acts.split([sae.d_hidden for sae in self.sae_models], dim=-1)
+
+
 def loss_fn(
     x: torch.Tensor, recons: torch.Tensor, auxk: Optional[torch.Tensor] = None
 ) -> tuple[torch.Tensor, torch.Tensor]:
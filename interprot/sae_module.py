@@ -3,30 +3,47 @@ import pytorch_lightning as pl
 import torch
 import torch.nn.functional as F
 from functools import cache
+from activation_cache import ActivationCache
 from esm_wrapper import ESM2Model
 from sae_model import SparseAutoencoder, loss_fn
-from validation_metrics import diff_cross_entropy
+from validation_metrics import evaluate_sae
 
 
 @cache
 def get_esm_model(d_model, alphabet, esm2_weight):
     esm2_model = ESM2Model(
-            num_layers=33,
-            embed_dim=d_model,
-            attention_heads=20,
-            alphabet=alphabet,
-            token_dropout=False,
-        )
+        num_layers=33,
+        embed_dim=d_model,
+        attention_heads=20,
+        alphabet=alphabet,
+        token_dropout=False,
+    )
     esm2_model.load_esm_ckpt(esm2_weight)
     esm2_model.eval()
     for param in esm2_model.parameters():
         param.requires_grad = False
     esm2_model.cuda()
-    
+
     return esm2_model
 
+
+@cache
+def get_activation_cache(cache_dir, max_size_gb):
+    if cache_dir is None:
+        return None
+    return ActivationCache(cache_dir, max_size_gb=max_size_gb)
+
+
 class SAELightningModule(pl.LightningModule):
-    def __init__(self, args):
+    def __init__(self, args, examples_per_step=None):
+        """
+        Args:
+            args: Training arguments.
+            examples_per_step: Number of sequences each training step sees, which
+                `dead_steps_threshold` is counted in. Defaults to the sequence batch
+                size; pass the average number of sequences per batch when training on
+                token batches.
+        """
         super().__init__()
         self.save_hyperparameters()
         self.args = args
@@ -36,7 +53,7 @@ class SAELightningModule(pl.LightningModule):
             d_hidden=args.d_hidden,
             k=args.k,
             auxk=args.auxk,
-            batch_size=args.batch_size,
+            batch_size=examples_per_step or args.batch_size,
             dead_steps_threshold=args.dead_steps_threshold,
         )
         self.alphabet = esm.data.Alphabet.from_architecture("ESM-1b")
@@ -45,12 +62,42 @@ class SAELightningModule(pl.LightningModule):
     def forward(self, x):
         return self.sae_model(x)
 
+    def activation_cache(self):
+        return get_activation_cache(
+            self.args.activation_cache_dir, self.args.activation_cache_max_gb
+        )
+
+    @torch.no_grad()
+    def get_token_activations(self, seqs):
+        """
+        Returns the (len(seq), D_MODEL) layer activations of each sequence's residues,
+        i.e. without padding, BOS and EOS tokens. Used to fill the token shuffle buffer
+        of a BufferedSequenceDataModule.
+        """
+        esm2_model = get_esm_model(self.args.d_model, self.alphabet, self.args.esm2_weight)
+        _, esm_layer_acts = esm2_model.get_layer_activations(
+            seqs, self.layer_to_use, cache=self.activation_cache()
+        )
+        return [acts[1 : len(seq) + 1] for acts, seq in zip(esm_layer_acts, seqs)]
+
     def training_step(self, batch, batch_idx):
-        seqs = batch["Sequence"]
-        batch_size = len(seqs)
-        with torch.no_grad():
-            esm2_model = get_esm_model(self.args.d_model, self.alphabet, self.args.esm2_weight)
-            tokens, esm_layer_acts = esm2_model.get_layer_activations(seqs, self.layer_to_use)
+        if isinstance(batch, torch.Tensor):
+            # (N_TOKENS, D_MODEL) token-level shuffled activations from an
+            # ActivationDataModule or a BufferedSequenceDataModule
+            esm_layer_acts = batch
+            batch_size = len(batch)
+        else:
+            seqs = batch["Sequence"]
+            batch_size = len(seqs)
+            with torch.no_grad():
+                esm2_model = get_esm_model(self.args.d_model, self.alphabet, self.args.esm2_weight)
+                tokens, esm_layer_acts = esm2_model.get_layer_activations(
+                    seqs, self.layer_to_use, cache=self.activation_cache()
+                )
+                # Pack the real residue tokens into a (N_TOKENS, D_MODEL) matrix so
+                # that padding, BOS and EOS tokens don't count towards the loss or
+                # the dead neuron statistics.
+                esm_layer_acts = esm_layer_acts[esm2_model.get_residue_mask(tokens)]
         recons, auxk, num_dead = self(esm_layer_acts)
         mse_loss, auxk_loss = loss_fn(esm_layer_acts, recons, auxk)
         loss = mse_loss + auxk_loss
@@ -91,51 +138,33 @@ class SAELightningModule(pl.LightningModule):
 
     def validation_step(self, batch, batch_idx):
         val_seqs = batch["Sequence"]
-        batch_size = len(val_seqs)
-        with torch.no_grad():
-            esm2_model = get_esm_model(
-                self.args.d_model, self.alphabet, self.args.esm2_weight
-            )
-
-        diff_CE_all = torch.zeros(batch_size, device=self.device)
-        mse_loss_all = torch.zeros(batch_size, device=self.device)
-
-        # Running inference one sequence at a time
-        for i, seq in enumerate(val_seqs):
-            tokens, esm_layer_acts = esm2_model.get_layer_activations(
-                seq, self.layer_to_use
-            )
-
-            # Calculate MSE
-            recons = self.sae_model.forward_val(esm_layer_acts)
-            mse_loss, auxk_loss = loss_fn(esm_layer_acts, recons, None)
-            mse_loss_all[i] = mse_loss
-
-            # Calculate difference in cross-entropy
-            orig_logits = esm2_model.get_sequence(esm_layer_acts, self.layer_to_use)
-            spliced_logits = esm2_model.get_sequence(recons, self.layer_to_use)
-            diff_CE = diff_cross_entropy(orig_logits, spliced_logits, tokens)
-            diff_CE_all[i] = diff_CE
-
-        val_metrics = {
-            "mse_loss": mse_loss_all.mean(),
-            "diff_cross_entropy": diff_CE_all.mean(),
-        }
-        # Return batch-level metrics for aggregation
-        self.validation_step_outputs.append(val_metrics)
+        esm2_model = get_esm_model(self.args.d_model, self.alphabet, self.args.esm2_weight)
+
+        metrics = evaluate_sae(
+            val_seqs,
+            self.layer_to_use,
+            esm2_model,
+            self.sae_model,
+            compute_loss_recovered=False,
+            cache=self.activation_cache(),
+        )
+        mse_loss, diff_CE = metrics["mse"], metrics["diff_cross_entropy"]
+
+        # Keep the per-sequence metrics so the epoch average is over sequences
+        self.validation_step_outputs.append({"mse_loss": mse_loss, "diff_cross_entropy": diff_CE})
+        val_metrics = {"mse_loss": mse_loss.mean(), "diff_cross_entropy": diff_CE.mean()}
         return val_metrics
 
     def on_validation_epoch_end(self):
-        # Aggregate metrics across batches
-        avg_diff_cross_entropy = torch.stack(
+        # Aggregate per-sequence metrics across batches
+        avg_diff_cross_entropy = torch.cat(
             [x["diff_cross_entropy"] for x in self.validation_step_outputs]
         ).mean()
-        avg_mse_loss = torch.stack([x["mse_loss"] for x in self.validation_step_outputs]).mean()
+        avg_mse_loss = torch.cat([x["mse_loss"] for x in self.validation_step_outputs]).mean()
+        self.validation_step_outputs.clear()
 
         # Log aggregated metrics
-        self.log(
-            "avg_mse_loss", avg_mse_loss, on_epoch=True, prog_bar=True, logger=True
-        )
+        self.log("avg_mse_loss", avg_mse_loss, on_epoch=True, prog_bar=True, logger=True)
         self.log(
             "avg_diff_cross_entropy",
             avg_diff_cross_entropy,
@@ -152,4 +181,4 @@ class SAELightningModule(pl.LightningModule):
 
     def on_after_backward(self):
         self.sae_model.norm_weights()
-        self.sae_model.norm_grad()
\ No newline at end of file
+        self.sae_model.norm_grad()
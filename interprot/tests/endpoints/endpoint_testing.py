@@ -0,0 +1,105 @@
+import importlib.util
+import os
+import sys
+import tempfile
+import types
+import unittest
+
+import esm
+import torch
+
+ENDPOINTS_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "endpoints")
+SAE_NAME_TO_CHECKPOINT = {
+    "SAE256-L1": "esm2_plm16_l1_sae256.pt",
+    "SAE256-L1-ab": "esm2_plm16_l1_sae256_ab.ckpt",
+}
+
+
+def load_endpoint_module(path: str, name: str):
+    """
+    Import a script of the endpoints directory, e.g. "convert_weights.py".
+    """
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ENDPOINTS_DIR, path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_handler(endpoint: str):
+    # The RunPod worker only starts when the handler runs as a script, so importing it
+    # does not need runpod to be installed
+    sys.modules.setdefault("runpod", types.ModuleType("runpod"))
+    return load_endpoint_module(os.path.join(endpoint, "handler.py"), f"{endpoint}_handler")
+
+
+def load_convert_weights():
+    return load_endpoint_module("convert_weights.py", "convert_weights")
+
+
+def write_weights(handler, weights_dir: str) -> None:
+    """
+    Write tiny random ESM2 and SAE checkpoints in the formats of the released ones: an
+    ESM checkpoint, a plain SAE state dict and a Lightning SAE checkpoint.
+    """
+    torch.manual_seed(0)
+    esm2_model = handler.ESM2Model(
+        num_layers=2,
+        embed_dim=16,
+        attention_heads=2,
+        alphabet=esm.data.Alphabet.from_architecture("ESM-1b"),
+        token_dropout=False,
+    )
+    model_data = {
+        (f"encoder.{k}" if "lm_head" in k else f"encoder.sentence_encoder.{k}"): v
+        for k, v in esm2_model.state_dict().items()
+    }
+    torch.save({"model": model_data}, os.path.join(weights_dir, "esm2_tiny.pt"))
+
+    for checkpoint in SAE_NAME_TO_CHECKPOINT.values():
+        sae_model = handler.SparseAutoencoder(16, 256)
+        with torch.no_grad():
+            sae_model.b_enc.normal_()
+            sae_model.b_pre.normal_()
+        state_dict = sae_model.state_dict()
+        if checkpoint.endswith(".ckpt"):
+            state_dict = {"state_dict": {f"sae_model.{k}": v for k, v in state_dict.items()}}
+        torch.save(state_dict, os.path.join(weights_dir, checkpoint))
+
+
+class HandlerTestCase(unittest.TestCase):
+    """
+    Runs the handler of `endpoint` on tiny random weights. Subclasses set the endpoint,
+    the names of its result caches and the input every request starts from.
+    """
+
+    endpoint: str
+    cache_names: tuple[str, ...]
+    default_input: dict = {"sae_name": "SAE256-L1"}
+
+    def setUp(self):
+        self.handler = load_handler(self.endpoint)
+        self.weights_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.weights_dir.cleanup)
+        write_weights(self.handler, self.weights_dir.name)
+
+        self.handler.WEIGHTS_DIR = self.weights_dir.name
+        self.handler.PLM_DIM_TO_ESM2 = {
+            16: {"num_layers": 2, "attention_heads": 2, "weights": "esm2_tiny.pt"}
+        }
+        self.handler.SAE_NAME_TO_CHECKPOINT = SAE_NAME_TO_CHECKPOINT
+        self.reset()
+
+    def reset(self, **registry_kwargs) -> None:
+        """
+        Start over with empty result caches and no models loaded.
+        """
+        self.handler.model_registry = self.handler.ModelRegistry(
+            SAE_NAME_TO_CHECKPOINT, torch.device("cpu"), **registry_kwargs
+        )
+        for cache_name in self.cache_names:
+            setattr(self.handler, cache_name, self.handler.LRUCache(1024**2))
+
+    def run_handler(self, **input_data) -> dict:
+        response = self.handler.handler({"input": {**self.default_input, **input_data}})
+        self.assertEqual(response["status"], "success", response.get("error"))
+        return response["data"]
@@ -0,0 +1,69 @@
+import unittest
+
+from interprot.tests.endpoints.endpoint_testing import load_handler
+
+
+class TestLRUCache(unittest.TestCase):
+    """
+    Each endpoint has its own copy of `LRUCache`, so every test runs on both.
+    """
+
+    def setUp(self):
+        self.handlers = [load_handler("sae_inference"), load_handler("steer_feature")]
+
+    def test_evicts_least_recently_used(self):
+        for handler in self.handlers:
+            with self.subTest(handler=handler.__name__):
+                cache = handler.LRUCache(max_bytes=10)
+                cache.put("a", 1, nbytes=4)
+                cache.put("b", 2, nbytes=4)
+                cache.get("a")
+                # "b" is the least recently used, so it makes room for "c"
+                cache.put("c", 3, nbytes=4)
+                self.assertIsNone(cache.get("b"))
+                self.assertEqual(cache.get("a"), 1)
+                self.assertEqual(cache.get("c"), 3)
+
+                # Evicts as many entries as needed
+                cache.put("d", 4, nbytes=9)
+                self.assertIsNone(cache.get("a"))
+                self.assertIsNone(cache.get("c"))
+                self.assertEqual(cache.get("d"), 4)
+
+    def test_size_accounting(self):
+        for handler in self.handlers:
+            with self.subTest(handler=handler.__name__):
+                cache = handler.LRUCache(max_bytes=10)
+                cache.put("a", 1, nbytes=3)
+                cache.put("b", 2, nbytes=4)
+                self.assertEqual(cache.size_bytes, 7)
+
+                # Replacing an entry only counts its new size
+                cache.put("a", 5, nbytes=2)
+                self.assertEqual(cache.size_bytes, 6)
+                self.assertEqual(cache.get("a"), 5)
+
+                # An entry larger than the cache is not stored and evicts nothing
+                cache.put("c", 3, nbytes=11)
+                self.assertEqual(cache.size_bytes, 6)
+                self.assertIsNone(cache.get("c"))
+                self.assertEqual(cache.get("b"), 2)
+
+                cache.put("d", 4, nbytes=5)
+                self.assertEqual(cache.size_bytes, 9)
+                self.assertIsNone(cache.get("a"))
+
+    def test_counts_hits_and_misses(self):
+        for handler in self.handlers:
+            with self.subTest(handler=handler.__name__):
+                cache = handler.LRUCache(max_bytes=10)
+                self.assertIsNone(cache.get("a"))
+                cache.put("a", 0, nbytes=1)
+                # Falsy values are hits too
+                self.assertEqual(cache.get("a"), 0)
+                self.assertEqual(cache.get("a"), 0)
+                self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
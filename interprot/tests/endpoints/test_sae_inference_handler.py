@@ -0,0 +1,226 @@
+import os
+import unittest
+from unittest import mock
+
+import torch
+
+from interprot.tests.endpoints.endpoint_testing import (
+    SAE_NAME_TO_CHECKPOINT,
+    HandlerTestCase,
+    load_convert_weights,
+    load_endpoint_module,
+)
+
+SEQS = ["MKTAYIAKQR", "MK", "MKTAYIAKQRQISFVKSHFSRQ", "GAVLI", "MKTAYIAKQRQISF"]
+
+
+class SaeInferenceTestCase(HandlerTestCase):
+    endpoint = "sae_inference"
+    cache_names = ("sae_acts_cache",)
+
+    def reset(self, cpu_profile: str = "fp32") -> None:
+        super().reset(cpu_profile=cpu_profile)
+
+
+class TestHandler(SaeInferenceTestCase):
+    def assert_same_data(self, data: dict, expected: dict) -> None:
+        # Activations are rounded to 0.1, so batching noise can flip the last digit
+        self.assertEqual(data.keys(), expected.keys())
+        if "tokens_acts_list" in expected:
+            torch.testing.assert_close(
+                torch.tensor(data["tokens_acts_list"]),
+                torch.tensor(expected["tokens_acts_list"]),
+                rtol=0,
+                atol=0.11,
+            )
+        else:
+            dims = [entry["dim"] for entry in data["token_acts_list_by_active_dim"]]
+            expected_dims = [entry["dim"] for entry in expected["token_acts_list_by_active_dim"]]
+            self.assertEqual(sorted(dims), sorted(expected_dims))
+
+    def test_batched_request_matches_single_requests(self):
+        dims = [3, None, 7, 3, None]
+        self.handler.MAX_TOKENS_PER_BATCH = 40
+        # The sequences span several length buckets
+        lengths = [len(seq) for seq in SEQS]
+        self.assertGreater(len(self.handler.make_length_batches(lengths, 40)), 2)
+
+        expected_acts = []
+        expected_data = []
+        for seq, dim in zip(SEQS, dims):
+            self.reset()
+            (sae_acts,) = self.handler.get_sae_acts([seq], "SAE256-L1")
+            expected_acts.append(sae_acts)
+            self.reset()
+            expected_data.append(self.run_handler(sequence=seq, dim=dim))
+
+        self.reset()
+        all_sae_acts = self.handler.get_sae_acts(SEQS, "SAE256-L1")
+        for seq, sae_acts, expected in zip(SEQS, all_sae_acts, expected_acts):
+            self.assertEqual(sae_acts.shape, (len(seq), 256))
+            torch.testing.assert_close(sae_acts, expected, rtol=1e-4, atol=1e-4)
+
+        self.reset()
+        results = self.run_handler(sequences=SEQS, dims=dims)["results"]
+        self.assertEqual(len(results), len(SEQS))
+        for data, expected in zip(results, expected_data):
+            self.assert_same_data(data, expected)
+
+    def test_single_sequence_response(self):
+        seq = SEQS[0]
+        data = self.run_handler(sequence=seq, dim=3)
+        self.assertEqual(list(data), ["tokens_acts_list"])
+        self.assertEqual(len(data["tokens_acts_list"]), len(seq))
+
+        data = self.run_handler(sequence=seq)
+        by_active_dim = data["token_acts_list_by_active_dim"]
+        max_acts = [max(entry["sae_acts"]) for entry in by_active_dim]
+        self.assertEqual(max_acts, sorted(max_acts, reverse=True))
+        self.assertTrue(all(len(entry["sae_acts"]) == len(seq) for entry in by_active_dim))
+
+    def test_dims_must_match_sequences(self):
+        response = self.handler.handler(
+            {"input": {"sae_name": "SAE256-L1", "sequences": SEQS, "dims": [1]}}
+        )
+        self.assertEqual(response["status"], "error")
+
+
+class TestResultCache(SaeInferenceTestCase):
+    def test_repeated_sequences_are_hits(self):
+        data = self.run_handler(sequence=SEQS[0], dim=3)
+        cache = self.handler.sae_acts_cache
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+        # Hits don't need the models; the cache is keyed by sequence, not by dim
+        loaded_registry = self.handler.model_registry
+        self.handler.model_registry = None
+        self.assertEqual(self.run_handler(sequence=SEQS[0], dim=3), data)
+        self.run_handler(sequence=SEQS[0], dim=5)
+        self.run_handler(sequence=SEQS[0])
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+        # Other SAEs and sequences are misses
+        self.handler.model_registry = loaded_registry
+        self.run_handler(sae_name="SAE256-L1-ab", sequence=SEQS[0], dim=3)
+        self.run_handler(sequences=SEQS[:2])
+        self.assertEqual((cache.hits, cache.misses), (4, 3))
+
+        # Entries are sized by their sparse float32 values and int64 (row, dim) indices
+        expected_nbytes = 0
+        for sae_name, seq in [
+            ("SAE256-L1", SEQS[0]),
+            ("SAE256-L1-ab", SEQS[0]),
+            ("SAE256-L1", SEQS[1]),
+        ]:
+            (sae_acts,) = self.handler.get_sae_acts([seq], sae_name)
+            expected_nbytes += (sae_acts != 0).sum().item() * (4 + 2 * 8)
+        self.assertEqual(cache.size_bytes, expected_nbytes)
+
+
+class TestModelRegistry(SaeInferenceTestCase):
+    def test_shares_backbones_and_loads_saes_lazily(self):
+        registry = self.handler.model_registry
+        loaded_files = []
+        torch_load = torch.load
+
+        def load(path, *args, **kwargs):
+            loaded_files.append(os.path.basename(path))
+            return torch_load(path, *args, **kwargs)
+
+        with mock.patch.object(torch, "load", load):
+            self.assertEqual(loaded_files, [])
+            esm2_model, sae_model, plm_layer = registry.get("SAE256-L1")
+            # The backbone and the requested SAE, but not the other SAE
+            self.assertEqual(set(loaded_files), {"esm2_tiny.pt", "esm2_plm16_l1_sae256.pt"})
+            self.assertEqual(plm_layer, 1)
+            self.assertEqual(len(esm2_model.layers), 1)
+
+            loaded_files.clear()
+            other_esm2_model, other_sae_model, _ = registry.get("SAE256-L1-ab")
+            self.assertEqual(set(loaded_files), {"esm2_plm16_l1_sae256_ab.ckpt"})
+            self.assertIs(other_esm2_model, esm2_model)
+            self.assertIsNot(other_sae_model, sae_model)
+
+            loaded_files.clear()
+            self.assertEqual(registry.get("SAE256-L1"), (esm2_model, sae_model, plm_layer))
+            self.assertEqual(loaded_files, [])
+
+        # Backbones are truncated after the SAE's layer, so other layers get their own
+        deeper_esm2_model = registry.get_backbone(16, 2)
+        self.assertIsNot(deeper_esm2_model, esm2_model)
+        self.assertEqual(len(deeper_esm2_model.layers), 2)
+
+
+class TestConvertedWeights(SaeInferenceTestCase):
+    def test_converted_weights_match_checkpoints(self):
+        checkpoints = ["esm2_tiny.pt", *SAE_NAME_TO_CHECKPOINT.values()]
+        expected = {
+            sae_name: self.handler.get_sae_acts(SEQS, sae_name)
+            for sae_name in SAE_NAME_TO_CHECKPOINT
+        }
+
+        convert_weights = load_convert_weights()
+        for checkpoint in checkpoints:
+            convert_weights.convert(os.path.join(self.weights_dir.name, checkpoint))
+        self.reset()
+        loads = []
+        torch_load = torch.load
+
+        def load(path, *args, **kwargs):
+            loads.append((os.path.basename(path), kwargs.get("mmap", False)))
+            return torch_load(path, *args, **kwargs)
+
+        with mock.patch.object(torch, "load", load):
+            for sae_name in SAE_NAME_TO_CHECKPOINT:
+                for sae_acts, expected_sae_acts in zip(
+                    self.handler.get_sae_acts(SEQS, sae_name), expected[sae_name]
+                ):
+                    torch.testing.assert_close(sae_acts, expected_sae_acts, rtol=0, atol=0)
+
+        # Every weights file was memory-mapped instead of loaded from the checkpoint
+        self.assertEqual(
+            sorted(loads),
+            sorted((checkpoint.rsplit(".", 1)[0] + ".mmap.pt", True) for checkpoint in checkpoints),
+        )
+        esm2_model, sae_model, _ = self.handler.model_registry.get("SAE256-L1")
+        for module in [esm2_model, sae_model]:
+            for name, tensor in [*module.named_parameters(), *module.named_buffers()]:
+                self.assertFalse(tensor.is_meta, name)
+
+
+class TestCpuProfiles(SaeInferenceTestCase):
+    def test_sae_acts_stay_close_to_fp32(self):
+        drift_report = load_endpoint_module("cpu_drift_report.py", "cpu_drift_report").drift_report
+        for sae_name in SAE_NAME_TO_CHECKPOINT:
+            self.reset()
+            ref_sae_acts = self.handler.get_sae_acts(SEQS, sae_name)
+            ref_max_act = max(sae_acts.max().item() for sae_acts in ref_sae_acts)
+            for cpu_profile in ["int8", "bf16"]:
+                with self.subTest(sae_name=sae_name, cpu_profile=cpu_profile):
+                    self.reset(cpu_profile)
+                    report = drift_report(ref_sae_acts, self.handler.get_sae_acts(SEQS, sae_name))
+                    # The profile is in effect, and within 1% relative L2 error of fp32,
+                    # with almost the same active latents and max activations within 5%
+                    self.assertGreater(report["max_abs_diff"], 0)
+                    self.assertLess(report["rel_l2_error"], 0.01)
+                    self.assertGreater(report["active_jaccard"], 0.99)
+                    self.assertLess(report["max_act_abs_diff"], 0.05 * ref_max_act)
+
+    def test_int8_quantizes_backbone_and_sae_encoder(self):
+        self.reset("int8")
+        esm2_model, sae_model, _ = self.handler.model_registry.get("SAE256-L1")
+        quantized_linear = torch.ao.nn.quantized.dynamic.Linear
+        self.assertIsInstance(esm2_model.layers[0].fc1, quantized_linear)
+        self.assertIsInstance(sae_model.enc, quantized_linear)
+
+    def test_profiles_are_ignored_on_gpu(self):
+        registry = self.handler.ModelRegistry(
+            SAE_NAME_TO_CHECKPOINT, torch.device("cuda"), cpu_profile="int8"
+        )
+        self.assertEqual(registry.cpu_profile, "fp32")
+        with self.assertRaises(ValueError):
+            self.handler.ModelRegistry(SAE_NAME_TO_CHECKPOINT, torch.device("cpu"), "fp16")
+
+
+if __name__ == "__main__":
+    unittest.main()
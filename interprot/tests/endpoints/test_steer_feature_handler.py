@@ -0,0 +1,175 @@
+import os
+import unittest
+from unittest import mock
+
+import torch
+
+from interprot.tests.endpoints.endpoint_testing import (
+    SAE_NAME_TO_CHECKPOINT,
+    HandlerTestCase,
+    load_convert_weights,
+    load_handler,
+)
+
+SEQ = "MKTAYIAKQRQISFVKSHFSRQ"
+
+
+class SteerFeatureTestCase(HandlerTestCase):
+    endpoint = "steer_feature"
+    cache_names = ("steer_cache", "steering_inputs_cache")
+    default_input = {"sae_name": "SAE256-L1", "sequence": SEQ}
+
+
+class TestSteer(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        handler = load_handler("steer_feature")
+        self.sae = handler.SparseAutoencoder(d_model=16, d_hidden=64, k=4).double()
+        with torch.no_grad():
+            self.sae.b_enc.normal_()
+            self.sae.b_pre.normal_()
+        self.x = torch.randn(20, 16, dtype=torch.float64) * 3
+
+    def test_matches_decode_of_steered_pre_acts(self):
+        acts, mu, std = self.sae.encode(self.x)
+        recons = self.sae.decode(acts, mu, std)
+        steering_topk = self.sae.get_steering_topk(acts)
+        in_topk = self.sae.topK_activation(acts, self.sae.k) > 0
+
+        num_entered, num_left = 0, 0
+        for dim in range(self.sae.d_hidden):
+            for multiplier in [-2, -0.5, 0, 0.1, 0.5, 1, 4]:
+                # Same steered activation as the handler
+                act = (acts.max() if multiplier > 0 else acts.min()) * multiplier
+                steered_acts = acts.clone()
+                steered_acts[:, dim] = act
+
+                torch.testing.assert_close(
+                    self.sae.steer(recons, acts, steering_topk, std, dim, act),
+                    self.sae.decode(steered_acts, mu, std),
+                )
+                steered_in_topk = self.sae.topK_activation(steered_acts, self.sae.k) > 0
+                num_entered += (steered_in_topk[:, dim] & ~in_topk[:, dim]).sum().item()
+                num_left += (~steered_in_topk[:, dim] & in_topk[:, dim]).sum().item()
+
+        # The sweep covers tokens where the steered latent enters and leaves the top k
+        self.assertGreater(num_entered, 0)
+        self.assertGreater(num_left, 0)
+
+
+class TestResultCache(SteerFeatureTestCase):
+    def test_repeated_request_is_a_hit(self):
+        data = self.run_handler(dim=3, multiplier=2.0)
+        self.assertEqual(len(data["steered_sequence"]), len(SEQ))
+        cache = self.handler.steer_cache
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+        # Hits don't need the models
+        loaded_registry = self.handler.model_registry
+        self.handler.model_registry = None
+        self.assertEqual(self.run_handler(dim=3, multiplier=2.0), data)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # The cache is keyed by (sae_name, sequence, dim, multiplier)
+        self.handler.model_registry = loaded_registry
+        self.run_handler(dim=3, multiplier=0.5)
+        self.run_handler(dim=4, multiplier=2.0)
+        self.run_handler(sae_name="SAE256-L1-ab", dim=3, multiplier=2.0)
+        self.run_handler(sequence=SEQ[:-1], dim=3, multiplier=2.0)
+        self.assertEqual((cache.hits, cache.misses), (1, 5))
+        # Steered sequences are sized by their length
+        self.assertEqual(cache.size_bytes, 4 * len(SEQ) + len(SEQ) - 1)
+
+        # A sweep over one sequence reuses its steering inputs
+        inputs_cache = self.handler.steering_inputs_cache
+        self.assertEqual((inputs_cache.hits, inputs_cache.misses), (2, 3))
+
+    def test_batched_dims_use_the_cache_per_dim(self):
+        self.run_handler(dim=3, multiplier=2.0)
+        data = self.run_handler(dims=[3, 5, 3], multipliers=[2.0, 2.0, -1.0])
+        self.assertEqual(len(data["results"]), 3)
+        self.assertEqual(data["results"][0], self.run_handler(dim=3, multiplier=2.0))
+        # The first dim of the batch and the repeated request are hits
+        self.assertEqual((self.handler.steer_cache.hits, self.handler.steer_cache.misses), (2, 3))
+
+
+class TestModelRegistry(SteerFeatureTestCase):
+    def test_shares_the_backbone_and_loads_saes_lazily(self):
+        registry = self.handler.model_registry
+        loaded_files = []
+        torch_load = torch.load
+
+        def load(path, *args, **kwargs):
+            loaded_files.append(os.path.basename(path))
+            return torch_load(path, *args, **kwargs)
+
+        with mock.patch.object(torch, "load", load):
+            self.assertEqual(loaded_files, [])
+            esm2_model, sae_model, _ = registry.get("SAE256-L1")
+            self.assertEqual(set(loaded_files), {"esm2_tiny.pt", "esm2_plm16_l1_sae256.pt"})
+            # Steering decodes through the final layers, so the backbone is complete
+            self.assertEqual(len(esm2_model.layers), 2)
+
+            loaded_files.clear()
+            other_esm2_model, other_sae_model, _ = registry.get("SAE256-L1-ab")
+            self.assertEqual(set(loaded_files), {"esm2_plm16_l1_sae256_ab.ckpt"})
+            self.assertIs(other_esm2_model, esm2_model)
+            self.assertIsNot(other_sae_model, sae_model)
+
+            loaded_files.clear()
+            registry.get("SAE256-L1")
+            self.assertEqual(loaded_files, [])
+
+
+class TestConvertedWeights(SteerFeatureTestCase):
+    def test_converted_weights_match_checkpoints(self):
+        checkpoints = ["esm2_tiny.pt", *SAE_NAME_TO_CHECKPOINT.values()]
+        dims, multipliers = [3, 5, 3], [2.0, 0.5, -1.0]
+        expected_esm2_model, _, _ = self.handler.model_registry.get("SAE256-L1")
+        expected = {
+            sae_name: self.handler.steer(SEQ, sae_name, dims, multipliers)
+            for sae_name in SAE_NAME_TO_CHECKPOINT
+        }
+
+        convert_weights = load_convert_weights()
+        for checkpoint in checkpoints:
+            convert_weights.convert(os.path.join(self.weights_dir.name, checkpoint))
+        self.reset()
+        loads = []
+        torch_load = torch.load
+
+        def load(path, *args, **kwargs):
+            loads.append((os.path.basename(path), kwargs.get("mmap", False)))
+            return torch_load(path, *args, **kwargs)
+
+        with mock.patch.object(torch, "load", load):
+            for sae_name in SAE_NAME_TO_CHECKPOINT:
+                self.assertEqual(
+                    self.handler.steer(SEQ, sae_name, dims, multipliers), expected[sae_name]
+                )
+
+        # Every weights file was memory-mapped instead of loaded from the checkpoint
+        self.assertEqual(
+            sorted(loads),
+            sorted((checkpoint.rsplit(".", 1)[0] + ".mmap.pt", True) for checkpoint in checkpoints),
+        )
+        esm2_model, sae_model, plm_layer = self.handler.model_registry.get("SAE256-L1")
+        for module in [esm2_model, sae_model]:
+            for name, tensor in [*module.named_parameters(), *module.named_buffers()]:
+                self.assertFalse(tensor.is_meta, name)
+        # Loading by assignment must keep the LM head tied to the token embeddings
+        self.assertIs(esm2_model.lm_head.weight, esm2_model.embed_tokens.weight)
+
+        _, esm_layer_acts = esm2_model.get_layer_activations(SEQ, plm_layer)
+        _, expected_esm_layer_acts = expected_esm2_model.get_layer_activations(SEQ, plm_layer)
+        torch.testing.assert_close(esm_layer_acts, expected_esm_layer_acts, rtol=0, atol=0)
+        torch.testing.assert_close(
+            esm2_model.get_sequence(esm_layer_acts, plm_layer),
+            expected_esm2_model.get_sequence(esm_layer_acts, plm_layer),
+            rtol=0,
+            atol=0,
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+from unittest.mock import Mock, patch
+
+import numpy as np
+import pandas as pd
+from click.testing import CliRunner
+
+from interprot.logistic_regression_probe.all_latents import all_latents
+
+
+def make_arrays(sae_dim: int) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    rng = np.random.default_rng(sae_dim)
+    X = rng.random((40, sae_dim)).astype(np.float32)
+    y = np.arange(40) % 2 == 0
+    return X[:30], y[:30], X[30:], y[30:]
+
+
+class TestAllLatentsProbe(unittest.TestCase):
+    @patch(
+        "interprot.logistic_regression_probe.all_latents."
+        "prepare_multi_sae_arrays_for_logistic_regression"
+    )
+    @patch("interprot.logistic_regression_probe.all_latents.truncate_plm")
+    @patch("interprot.logistic_regression_probe.all_latents.torch.load")
+    @patch("interprot.logistic_regression_probe.all_latents.AutoTokenizer.from_pretrained")
+    @patch("interprot.logistic_regression_probe.all_latents.EsmModel.from_pretrained")
+    @patch("interprot.logistic_regression_probe.all_latents.SparseAutoencoder")
+    def test_probes_saes_of_different_widths(
+        self,
+        mock_sae,
+        mock_esm,
+        mock_tokenizer,
+        mock_torch_load,
+        mock_truncate_plm,
+        mock_prepare_multi_sae_arrays,
+    ):
+        mock_torch_load.return_value = {}
+        mock_esm.return_value = Mock(to=Mock())
+        mock_sae.return_value = Mock(to=Mock())
+        mock_prepare_multi_sae_arrays.return_value = [make_arrays(4), make_arrays(6)]
+
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            for name in ["a.pt", "b.pt", "dummy.tsv"]:
+                open(name, "w").close()
+            args = ["--sae-checkpoint", "a.pt", "--sae-dim", "4", "--plm-layer", "24"]
+            args += ["--output-file", "a.csv", "--sae-checkpoint", "b.pt", "--sae-dim", "6"]
+            args += ["--plm-layer", "33", "--output-file", "b.csv", "--plm-dim", "8"]
+            args += ["--swissprot-tsv", "dummy.tsv", "--annotation-names", "DNA binding"]
+
+            with patch("pandas.read_csv", return_value=pd.DataFrame()):
+                result = runner.invoke(all_latents, args)
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertEqual([c.args for c in mock_sae.call_args_list], [(8, 4), (8, 6)])
+            for output_file, sae_dim in [("a.csv", 4), ("b.csv", 6)]:
+                res_df = pd.read_csv(output_file)
+                self.assertEqual(list(res_df.columns[5:]), [f"weight_{d}" for d in range(sae_dim)])
+
+            # Every checkpoint needs its own SAE dim
+            sae_dim_idx = args.index("6") - 1
+            result = runner.invoke(all_latents, args[:sae_dim_idx] + args[sae_dim_idx + 2 :])
+            self.assertIsInstance(result.exception, ValueError)
+            self.assertIn("--sae-dim", str(result.exception))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -13,6 +13,7 @@ class TestSingleLatentProbe(unittest.TestCase):
     @patch(
         "interprot.logistic_regression_probe.single_latent.prepare_arrays_for_logistic_regression"
     )
+    @patch("interprot.logistic_regression_probe.single_latent.truncate_plm")
     @patch("interprot.logistic_regression_probe.single_latent.torch.load")
     @patch("interprot.logistic_regression_probe.single_latent.AutoTokenizer.from_pretrained")
     @patch("interprot.logistic_regression_probe.single_latent.EsmModel.from_pretrained")
@@ -23,6 +24,7 @@ class TestSingleLatentProbe(unittest.TestCase):
         mock_esm,
         mock_tokenizer,
         mock_torch_load,
+        mock_truncate_plm,
         mock_prepare_arrays_for_logistic_regression,
     ):
         mock_torch_load.return_value = {}
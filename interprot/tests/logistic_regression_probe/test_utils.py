@@ -14,8 +14,8 @@ from interprot.logistic_regression_probe.utils import (
 
 
 class TestUtils(unittest.TestCase):
-    @patch("interprot.logistic_regression_probe.utils.get_sae_acts")
-    def test_make_examples_from_annotation_entries(self, mock_get_sae_acts):
+    @patch("interprot.logistic_regression_probe.utils.iter_sae_acts")
+    def test_make_examples_from_annotation_entries(self, mock_iter_sae_acts):
         # Mock the necessary objects
         mock_tokenizer = Mock()
         mock_plm_model = Mock()
@@ -32,7 +32,7 @@ class TestUtils(unittest.TestCase):
             ],
         }
 
-        mock_get_sae_acts.side_effect = [
+        mock_iter_sae_acts.return_value = [
             [
                 [0.1, 0.2],
                 [0.3, 0.4],
@@ -71,23 +71,17 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(examples[9], Example(sae_acts=np.array([1.9, 2.0]), target=False))
         self.assertEqual(examples[10], Example(sae_acts=np.array([2.1, 2.2]), target=True))
 
-        mock_get_sae_acts.assert_any_call(
-            seq="ABCDEF",
-            tokenizer=mock_tokenizer,
-            plm_model=mock_plm_model,
-            sae_model=mock_sae_model,
-            plm_layer=24,
-        )
-        mock_get_sae_acts.assert_any_call(
-            seq="GHIJKL",
+        mock_iter_sae_acts.assert_called_once_with(
+            seqs=["ABCDEF", "GHIJKL"],
             tokenizer=mock_tokenizer,
             plm_model=mock_plm_model,
             sae_model=mock_sae_model,
             plm_layer=24,
+            activation_cache=None,
         )
 
-    @patch("interprot.logistic_regression_probe.utils.get_sae_acts")
-    def test_make_examples_from_annotation_entries_pool_over_annotation(self, mock_get_sae_acts):
+    @patch("interprot.logistic_regression_probe.utils.iter_sae_acts")
+    def test_make_examples_from_annotation_entries_pool_over_annotation(self, mock_iter_sae_acts):
         seq_to_annotation_entries = {
             "AAAAAAAAAA": [{"start": 4, "end": 6}],
             "CCCCCCCCCC": [{"start": 1, "end": 3}, {"start": 5, "end": 6}],
@@ -97,7 +91,7 @@ class TestUtils(unittest.TestCase):
         mock_plm_model = Mock()
         mock_sae_model = Mock()
 
-        mock_get_sae_acts.side_effect = [
+        mock_iter_sae_acts.return_value = [
             [
                 [0.1, 0.2],
                 [0.3, 0.4],
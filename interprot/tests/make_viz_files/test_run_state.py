@@ -0,0 +1,162 @@
+import json
+import os
+import pickle
+import tempfile
+import unittest
+
+import numpy as np
+import polars as pl
+
+from interprot.make_viz_files.__main__ import write_viz_files
+from interprot.make_viz_files.run_state import (
+    RunState,
+    load_merged_partial_stats,
+    save_partial_stats,
+)
+from interprot.make_viz_files.top_examples import SparseMaxActivations, TopExamplesReducer
+
+
+class TestRunState(unittest.TestCase):
+    def setUp(self):
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.config = {"checkpoint_files": ["plm320_l4_sae1280.pt"], "two_pass": False}
+
+    def tearDown(self):
+        self.state_dir.cleanup()
+
+    def test_resume_from_last_checkpoint(self):
+        run_state = RunState(self.state_dir.name, self.config)
+        self.assertFalse(run_state.exists)
+
+        reducer = TopExamplesReducer(sae_dim=4, num_examples=2)
+        reducer.add(0, np.array([[0, 1, 0, 2]], dtype=np.float32))
+        run_state.save("pass1", 1, [reducer])
+        reducer.add(1, np.array([[3, 0, 0, 1]], dtype=np.float32))
+        run_state.save("pass1", 2, [reducer])
+        # Only the files of the last checkpoint are kept
+        self.assertEqual(
+            sorted(os.listdir(self.state_dir.name)), ["progress.json", "stats_1_0.pkl"]
+        )
+
+        resumed = RunState(self.state_dir.name, self.config)
+        self.assertTrue(resumed.exists)
+        self.assertEqual((resumed.stage, resumed.num_seqs_done), ("pass1", 2))
+        (resumed_reducer,) = resumed.load_stats()
+        resumed_reducer.finalize()
+        self.assertEqual(resumed_reducer.num_seqs_added, 2)
+        np.testing.assert_array_equal(resumed_reducer.max_act, [3, 1, 0, 2])
+
+    def test_checkpoints_append_deltas(self):
+        rng = np.random.default_rng(0)
+        all_sae_acts = [rng.exponential(size=(5, 8)).astype(np.float32) for _ in range(40)]
+        for sae_acts in all_sae_acts:
+            sae_acts[rng.random(sae_acts.shape) < 0.5] = 0
+
+        def add(stats, seq_idxs):
+            for seq_idx in seq_idxs:
+                stats.add(seq_idx, all_sae_acts[seq_idx])
+
+        expected = SparseMaxActivations(sae_dim=8, num_examples=2)
+        add(expected, range(40))
+        expected.finalize()
+
+        run_state = RunState(self.state_dir.name, self.config)
+        stats = SparseMaxActivations(sae_dim=8, num_examples=2)
+        add(stats, range(10))
+        run_state.save("pass1", 10, [stats])
+        add(stats, range(10, 20))
+        run_state.save("pass1", 20, [stats])
+        # Each checkpoint only holds the sequences since the previous one
+        (loaded,) = RunState(self.state_dir.name, self.config).load_stats()
+        self.assertEqual(loaded.num_seqs_added, 20)
+        with open(os.path.join(self.state_dir.name, "delta_0_0_0.pkl"), "rb") as f:
+            self.assertEqual(pickle.load(f).num_seqs_added, 10)
+
+        # Resume and keep checkpointing on top of the loaded statistics
+        run_state = RunState(self.state_dir.name, self.config)
+        (stats,) = run_state.load_stats()
+        add(stats, range(20, 40))
+        run_state.save("pass1", 40, [stats])
+        (stats,) = RunState(self.state_dir.name, self.config).load_stats()
+        self.assertEqual(stats.num_seqs_added, 40)
+        stats.finalize()
+        for dim in range(8):
+            self.assertEqual(stats.top_seq_idxs(dim), expected.top_seq_idxs(dim))
+        np.testing.assert_array_equal(stats.n_seqs, expected.n_seqs)
+
+        # A new stage starts a new generation, and the second pass appends deltas too
+        run_state.save("pass2", 0, [stats])
+        selected_seq_idxs = stats.selected_seq_idxs()
+        for n, seq_idx in enumerate(selected_seq_idxs, start=1):
+            stats.add_dim_acts(seq_idx, all_sae_acts[seq_idx])
+            if n % 3 == 0:
+                run_state.save("pass2", n, [stats])
+        run_state.save("pass2", len(selected_seq_idxs), [stats])
+        self.assertFalse(
+            any(name.startswith(("stats_0", "delta_0")) for name in os.listdir(self.state_dir.name))
+        )
+        (resumed,) = RunState(self.state_dir.name, self.config).load_stats()
+        self.assertEqual(resumed.dim_acts.keys(), stats.dim_acts.keys())
+        for key, dim_acts in stats.dim_acts.items():
+            np.testing.assert_array_equal(resumed.dim_acts[key], dim_acts)
+
+    def test_rejects_state_of_different_run(self):
+        RunState(self.state_dir.name, self.config).save("write", 0, [])
+        with self.assertRaises(ValueError):
+            RunState(self.state_dir.name, {**self.config, "two_pass": True})
+
+    def test_sharded_run_matches_single_process(self):
+        rng = np.random.default_rng(0)
+        seqs = ["".join(rng.choice(list("ACDEFGHIK"), size=rng.integers(3, 8))) for _ in range(60)]
+        df = pl.DataFrame(
+            {
+                "Sequence": seqs,
+                "AlphaFoldDB": [f"AF{i};" for i in range(60)],
+                "Entry": [f"P{i}" for i in range(60)],
+                "Protein names": [f"prot{i}" for i in range(60)],
+            }
+        )
+        all_sae_acts = []
+        for seq in seqs:
+            sae_acts = rng.exponential(size=(len(seq), 16)).astype(np.float16)
+            sae_acts[rng.random(sae_acts.shape) < 0.5] = 0
+            all_sae_acts.append(sae_acts.astype(np.float32))
+        # The max activations grow late, in the last sequences of every shard
+        for sae_acts in all_sae_acts[-6:]:
+            sae_acts *= 4
+
+        def run(all_stats: list[SparseMaxActivations], output_dir: str) -> dict[str, dict]:
+            (stats,) = all_stats
+            stats.finalize()
+            for seq_idx in stats.selected_seq_idxs():
+                stats.add_dim_acts(seq_idx, all_sae_acts[seq_idx])
+            write_viz_files(output_dir, df, stats)
+            return {
+                name: json.load(open(os.path.join(output_dir, name)))
+                for name in os.listdir(output_dir)
+            }
+
+        stats = SparseMaxActivations(sae_dim=16, num_examples=5)
+        for seq_idx, sae_acts in enumerate(all_sae_acts):
+            stats.add(seq_idx, sae_acts)
+        single_process_viz_files = run([stats], os.path.join(self.state_dir.name, "single"))
+
+        partials_dir = os.path.join(self.state_dir.name, "partials")
+        for shard_index in range(3):
+            with self.assertRaises(FileNotFoundError):
+                load_merged_partial_stats(partials_dir, num_shards=3)
+            shard_stats = SparseMaxActivations(sae_dim=16, num_examples=5)
+            for seq_idx in range(shard_index, len(seqs), 3):
+                shard_stats.add(seq_idx, all_sae_acts[seq_idx])
+            save_partial_stats(partials_dir, shard_index, 3, [shard_stats])
+        merged_stats = load_merged_partial_stats(partials_dir, num_shards=3)
+        self.assertEqual(merged_stats[0].num_seqs_added, len(seqs))
+        sharded_viz_files = run(merged_stats, os.path.join(self.state_dir.name, "sharded"))
+
+        self.assertEqual(len(sharded_viz_files), 16)
+        # Every range, including the lower ones, has the same examples
+        self.assertEqual(sharded_viz_files, single_process_viz_files)
+
+
+if __name__ == "__main__":
+    unittest.main()
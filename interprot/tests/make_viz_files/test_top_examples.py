@@ -0,0 +1,202 @@
+import heapq
+import unittest
+
+import numpy as np
+
+from interprot.make_viz_files.top_examples import (
+    ACT_RANGES,
+    SparseMaxActivations,
+    TopExamplesReducer,
+)
+
+
+def make_sae_acts(num_seqs: int, sae_dim: int, seed: int = 0) -> list[np.ndarray]:
+    rng = np.random.default_rng(seed)
+    all_sae_acts = []
+    for _ in range(num_seqs):
+        sae_acts = rng.exponential(size=(rng.integers(3, 10), sae_dim)).astype(np.float32)
+        sae_acts[rng.random(sae_acts.shape) < 0.7] = 0
+        all_sae_acts.append(sae_acts)
+    return all_sae_acts
+
+
+def to_top_k(sae_acts: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns the dense top k activations and their (values, indices), as from
+    `get_acts` and `get_acts_sparse`.
+    """
+    indices = np.argpartition(-sae_acts, k - 1, axis=1)[:, :k]
+    values = np.take_along_axis(sae_acts, indices, axis=1)
+    dense = np.zeros_like(sae_acts)
+    np.put_along_axis(dense, indices, values, axis=1)
+    return dense, values, indices
+
+
+def exact_top_seq_idxs(dim_maxes: np.ndarray, num_examples: int) -> dict[str, list[int]]:
+    normalized_acts = dim_maxes / dim_maxes.max()
+    res = {}
+    for start, end in ACT_RANGES:
+        mask = (normalized_acts > start) & (normalized_acts <= end)
+        res[f"{start}-{end}"] = heapq.nlargest(
+            num_examples, np.where(mask)[0].tolist(), key=lambda i: dim_maxes[i]
+        )
+    return res
+
+
+class TestTopExamplesReducer(unittest.TestCase):
+    def setUp(self):
+        self.sae_dim = 8
+        self.all_sae_acts = make_sae_acts(num_seqs=200, sae_dim=self.sae_dim)
+        self.all_seqs_max_act = np.stack([acts.max(axis=0) for acts in self.all_sae_acts], 1)
+
+    def reduce(self, chunk_size: int) -> TopExamplesReducer:
+        reducer = TopExamplesReducer(
+            self.sae_dim, num_examples=5, strong_act_gt=0.75, chunk_size=chunk_size
+        )
+        for seq_idx, sae_acts in enumerate(self.all_sae_acts):
+            reducer.add(seq_idx, sae_acts)
+        reducer.finalize()
+        return reducer
+
+    def test_matches_exact_selection_in_a_single_chunk(self):
+        reducer = self.reduce(chunk_size=1000)
+        for dim in range(self.sae_dim):
+            dim_maxes = self.all_seqs_max_act[dim]
+            self.assertEqual(reducer.top_seq_idxs(dim), exact_top_seq_idxs(dim_maxes, 5))
+
+    def test_streaming_statistics(self):
+        reducer = self.reduce(chunk_size=16)
+        for dim in range(self.sae_dim):
+            dim_maxes = self.all_seqs_max_act[dim]
+            normalized_acts = dim_maxes / dim_maxes.max()
+
+            self.assertEqual(reducer.n_seqs[dim], (dim_maxes > 0).sum())
+            self.assertEqual(reducer.max_act[dim], dim_maxes.max())
+            np.testing.assert_array_equal(
+                reducer.strong_seq_idxs(dim), np.where(normalized_acts > 0.75)[0]
+            )
+            # The top range is exact no matter how the max activation grows
+            self.assertEqual(
+                reducer.top_seq_idxs(dim)["0.75-1"], exact_top_seq_idxs(dim_maxes, 5)["0.75-1"]
+            )
+
+            # Only the per-residue activations of the kept examples are stored
+            for seq_idxs in reducer.top_seq_idxs(dim).values():
+                for seq_idx in seq_idxs:
+                    np.testing.assert_array_equal(
+                        reducer.get_dim_acts(dim, seq_idx),
+                        self.all_sae_acts[seq_idx][:, dim].astype(np.float16),
+                    )
+        self.assertLessEqual(len(reducer.dim_acts), self.sae_dim * len(ACT_RANGES) * 5)
+
+
+class TestSparseMaxActivations(unittest.TestCase):
+    def test_two_passes_match_exact_selection(self):
+        sae_dim = 8
+        # Round to float16 so that the float16 max activations don't reorder ties
+        all_sae_acts = [
+            acts.astype(np.float16).astype(np.float32)
+            for acts in make_sae_acts(num_seqs=200, sae_dim=sae_dim)
+        ]
+        all_seqs_max_act = np.stack([acts.max(axis=0) for acts in all_sae_acts], 1)
+
+        # Feed the sequences as two shards to also cover merging
+        stats = SparseMaxActivations(sae_dim, num_examples=5, strong_act_gt=0.75)
+        shard_stats = SparseMaxActivations(sae_dim, num_examples=5, strong_act_gt=0.75)
+        for seq_idx, sae_acts in enumerate(all_sae_acts):
+            (shard_stats if seq_idx % 2 else stats).add(seq_idx, sae_acts)
+        stats.merge(shard_stats)
+        stats.finalize()
+        selected_seq_idxs = stats.selected_seq_idxs()
+        self.assertLess(len(selected_seq_idxs), len(all_sae_acts))
+        for seq_idx in selected_seq_idxs:
+            stats.add_dim_acts(seq_idx, all_sae_acts[seq_idx])
+
+        for dim in range(sae_dim):
+            dim_maxes = all_seqs_max_act[dim]
+            normalized_acts = dim_maxes / dim_maxes.max()
+
+            self.assertEqual(stats.top_seq_idxs(dim), exact_top_seq_idxs(dim_maxes, 5))
+            self.assertEqual(stats.n_seqs[dim], (dim_maxes > 0).sum())
+            self.assertEqual(stats.max_act[dim], dim_maxes.max())
+            np.testing.assert_array_equal(
+                stats.strong_seq_idxs(dim), np.where(normalized_acts > 0.75)[0]
+            )
+            for seq_idxs in stats.top_seq_idxs(dim).values():
+                for seq_idx in seq_idxs:
+                    np.testing.assert_array_equal(
+                        stats.get_dim_acts(dim, seq_idx),
+                        all_sae_acts[seq_idx][:, dim].astype(np.float16),
+                    )
+
+    def test_matches_exact_selection_when_max_grows_late(self):
+        sae_dim = 64
+        all_sae_acts = make_sae_acts(num_seqs=3000, sae_dim=sae_dim, seed=1)
+        # The max activation of every latent grows in the last sequences, after the
+        # lower ranges of a streaming selection were filled relative to a smaller max
+        for sae_acts in all_sae_acts[-30:]:
+            sae_acts *= 4
+        all_sae_acts = [acts.astype(np.float16).astype(np.float32) for acts in all_sae_acts]
+        all_seqs_max_act = np.stack([acts.max(axis=0) for acts in all_sae_acts], 1)
+
+        stats = SparseMaxActivations(sae_dim, num_examples=5)
+        reducer = TopExamplesReducer(sae_dim, num_examples=5, chunk_size=256)
+        for seq_idx, sae_acts in enumerate(all_sae_acts):
+            stats.add(seq_idx, sae_acts)
+            reducer.add(seq_idx, sae_acts)
+        stats.finalize()
+        reducer.finalize()
+        for seq_idx in stats.selected_seq_idxs():
+            stats.add_dim_acts(seq_idx, all_sae_acts[seq_idx])
+
+        num_streaming_mismatches = 0
+        for dim in range(sae_dim):
+            exact = exact_top_seq_idxs(all_seqs_max_act[dim], 5)
+            self.assertEqual(stats.top_seq_idxs(dim), exact)
+            num_streaming_mismatches += sum(
+                reducer.top_seq_idxs(dim)[range_name] != seq_idxs
+                for range_name, seq_idxs in exact.items()
+            )
+        # The stream does trip up the approximate streaming selection
+        self.assertGreater(num_streaming_mismatches, 0)
+
+
+class TestSparseInputs(unittest.TestCase):
+    def test_sparse_inputs_match_dense_inputs(self):
+        sae_dim = 16
+        top_k = [to_top_k(acts, k=4) for acts in make_sae_acts(num_seqs=200, sae_dim=sae_dim)]
+
+        reducer = TopExamplesReducer(sae_dim, num_examples=5, strong_act_gt=0.75)
+        reducer_from_sparse = TopExamplesReducer(sae_dim, num_examples=5, strong_act_gt=0.75)
+        stats = SparseMaxActivations(sae_dim, num_examples=5, strong_act_gt=0.75)
+        stats_from_sparse = SparseMaxActivations(sae_dim, num_examples=5, strong_act_gt=0.75)
+        for seq_idx, (dense, values, indices) in enumerate(top_k):
+            reducer.add(seq_idx, dense)
+            reducer_from_sparse.add_sparse(seq_idx, values, indices)
+            stats.add(seq_idx, dense)
+            stats_from_sparse.add_sparse(seq_idx, values, indices)
+        for top_examples in [reducer, reducer_from_sparse, stats, stats_from_sparse]:
+            top_examples.finalize()
+        for seq_idx in stats.selected_seq_idxs():
+            dense, values, indices = top_k[seq_idx]
+            stats.add_dim_acts(seq_idx, dense)
+            stats_from_sparse.add_dim_acts_sparse(seq_idx, values, indices)
+
+        for expected, actual in [(reducer, reducer_from_sparse), (stats, stats_from_sparse)]:
+            np.testing.assert_array_equal(actual.max_act, expected.max_act)
+            np.testing.assert_array_equal(actual.n_seqs, expected.n_seqs)
+            for dim in range(sae_dim):
+                self.assertEqual(actual.top_seq_idxs(dim), expected.top_seq_idxs(dim))
+                np.testing.assert_array_equal(
+                    actual.strong_seq_idxs(dim), expected.strong_seq_idxs(dim)
+                )
+                for seq_idxs in expected.top_seq_idxs(dim).values():
+                    for seq_idx in seq_idxs:
+                        np.testing.assert_array_equal(
+                            actual.get_dim_acts(dim, seq_idx),
+                            expected.get_dim_acts(dim, seq_idx),
+                        )
+
+
+if __name__ == "__main__":
+    unittest.main()
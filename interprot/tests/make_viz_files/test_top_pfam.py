@@ -0,0 +1,107 @@
+import unittest
+
+import numpy as np
+import polars as pl
+
+from interprot.make_viz_files.__main__ import get_top_pfams, make_pfam_index
+
+
+def get_top_pfam_of_seqs(df, n_active, strong_seq_idxs, n_classes=3, frac_above_threshold=0.8):
+    """
+    Per-latent reference implementation of `get_top_pfams`: filters and explodes the
+    strong sequences of a single latent.
+    """
+    if n_active < 10:
+        return []
+
+    gt_50 = df[strong_seq_idxs.tolist()]
+    gt_50 = gt_50.with_columns(
+        pl.col("Pfam").str.strip_chars(";").str.split(";").alias("pfam_list")
+    )
+    exploded = gt_50.explode("pfam_list")
+    # Ties are broken by family name so the order is deterministic
+    count_table = (
+        exploded["pfam_list"]
+        .value_counts()
+        .drop_nulls()
+        .sort(["count", "pfam_list"], descending=[True, False])
+    )
+    count_order = {value: i for i, value in enumerate(count_table["pfam_list"])}
+    exploded = (
+        exploded.with_columns(pl.col("pfam_list").replace_strict(count_order).alias("pfam_ordered"))
+        .sort("pfam_ordered")
+        .drop_nulls()
+    )
+    cleaned_df = exploded.unique(subset=["Entry"], maintain_order=True)
+    cleaned_df = cleaned_df.rename({"pfam_list": "pfam_common"})
+    keep = (
+        cleaned_df["pfam_common"]
+        .value_counts()
+        .drop_nulls()
+        .sort(["count", "pfam_common"], descending=[True, False])
+    )
+
+    if len(keep) >= 1:
+        top_count = sum(keep["count"][:n_classes])
+        if top_count > (len(gt_50) * frac_above_threshold):
+            return keep["pfam_common"][:n_classes].to_list()
+
+    return []
+
+
+class TestTopPfam(unittest.TestCase):
+    def test_batched_matches_per_latent(self):
+        rng = np.random.default_rng(0)
+        num_seqs, sae_dim = 200, 40
+        families = ["PF00001", "PF00002", "PF00003", "PF00004", "PF00005"]
+        pfams = []
+        for _ in range(num_seqs):
+            if rng.random() < 0.1:
+                pfams.append(None)
+            else:
+                size = rng.integers(1, 4)
+                pfams.append(";".join(rng.choice(families, size=size)) + ";")
+        df = pl.DataFrame(
+            {
+                # Some sequences share an entry
+                "Entry": [f"P{i // 2 if i < 20 else i}" for i in range(num_seqs)],
+                "Pfam": pfams,
+                "Protein names": [None if i % 17 == 0 else f"prot{i}" for i in range(num_seqs)],
+            }
+        )
+
+        # Latents are concentrated on a few families, so some pass the threshold
+        n_active = rng.integers(0, 30, size=sae_dim)
+        strong_seq_idxs = []
+        for dim in range(sae_dim):
+            family_seqs = np.where(
+                df["Pfam"].str.contains(families[dim % len(families)]).fill_null(False)
+            )[0]
+            strong_seq_idxs.append(
+                np.sort(
+                    np.unique(
+                        np.concatenate(
+                            [
+                                rng.choice(family_seqs, size=rng.integers(0, 20)),
+                                rng.choice(num_seqs, size=rng.integers(0, 4 + dim % 8)),
+                            ]
+                        )
+                    )
+                )
+            )
+
+        top_pfams = get_top_pfams(
+            make_pfam_index(df),
+            n_active,
+            np.repeat(np.arange(sae_dim), [len(idxs) for idxs in strong_seq_idxs]),
+            np.concatenate(strong_seq_idxs),
+        )
+        expected = [
+            get_top_pfam_of_seqs(df, n_active[dim], strong_seq_idxs[dim]) for dim in range(sae_dim)
+        ]
+        self.assertEqual(top_pfams, expected)
+        self.assertTrue(any(expected))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import polars as pl
+
+from interprot.make_viz_files.__main__ import write_viz_files
+from interprot.make_viz_files.top_examples import TopExamplesReducer
+from interprot.make_viz_files.viz_shards import VizShards
+
+
+class TestWriteVizFiles(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.seqs = [
+            "".join(rng.choice(list("ACDEFGHIK"), size=rng.integers(3, 8))) for _ in range(30)
+        ]
+        self.df = pl.DataFrame(
+            {
+                "Sequence": self.seqs,
+                "AlphaFoldDB": [f"AF{i};" for i in range(30)],
+                "Entry": [f"P{i}" for i in range(30)],
+                "Protein names": [f"prot{i}" for i in range(30)],
+            }
+        )
+        self.all_sae_acts = []
+        self.top_examples = TopExamplesReducer(sae_dim=6, num_examples=3)
+        for seq_idx, seq in enumerate(self.seqs):
+            sae_acts = rng.exponential(size=(len(seq), 6)).astype(np.float32)
+            sae_acts[rng.random(sae_acts.shape) < 0.6] = 0
+            sae_acts[:, 5] = 0
+            self.all_sae_acts.append(sae_acts)
+            self.top_examples.add(seq_idx, sae_acts)
+        self.top_examples.finalize()
+
+    def write(self, num_workers: int) -> dict[str, dict]:
+        with tempfile.TemporaryDirectory() as output_dir:
+            write_viz_files(output_dir, self.df, self.top_examples, num_workers)
+            return {
+                name: json.load(open(os.path.join(output_dir, name)))
+                for name in os.listdir(output_dir)
+            }
+
+    def test_write_viz_files(self):
+        viz_files = self.write(num_workers=1)
+        # Latent 5 is never active
+        self.assertEqual(sorted(viz_files), [f"{dim}.json" for dim in range(5)])
+        for dim in range(5):
+            viz_file = viz_files[f"{dim}.json"]
+            self.assertEqual(viz_file["n_seqs"], self.top_examples.n_seqs[dim])
+            for range_name, seq_idxs in self.top_examples.top_seq_idxs(dim).items():
+                examples = viz_file["ranges"][range_name]["examples"]
+                self.assertEqual([e["uniprot_id"] for e in examples], [f"P{i}" for i in seq_idxs])
+                for seq_idx, example in zip(seq_idxs, examples):
+                    self.assertEqual(example["sequence"], self.seqs[seq_idx])
+                    self.assertEqual(example["alphafold_id"], f"AF{seq_idx}")
+                    self.assertEqual(
+                        example["sae_acts"],
+                        [
+                            round(float(act), 1)
+                            for act in self.all_sae_acts[seq_idx][:, dim].astype(np.float16)
+                        ],
+                    )
+
+    def test_parallel_writes_match_sequential(self):
+        self.assertEqual(self.write(num_workers=2), self.write(num_workers=1))
+
+    def test_viz_shards_match_json(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            write_viz_files(output_dir, self.df, self.top_examples, output_format="both")
+            shards = VizShards(os.path.join(output_dir, "shards"))
+            # Each protein is stored once no matter how many latents use it
+            self.assertEqual(len(shards.proteins), len({p["uniprot_id"] for p in shards.proteins}))
+            self.assertNotIn(5, shards)
+            for dim in range(5):
+                viz_file = json.load(open(os.path.join(output_dir, f"{dim}.json")))
+                shard_viz_file = shards.read(dim)
+                self.assertEqual(viz_file.keys(), shard_viz_file.keys())
+                for range_name, range_examples in viz_file["ranges"].items():
+                    shard_examples = shard_viz_file["ranges"][range_name]["examples"]
+                    for example, shard_example in zip(
+                        range_examples["examples"], shard_examples, strict=True
+                    ):
+                        acts = example.pop("sae_acts")
+                        shard_acts = shard_example.pop("sae_acts")
+                        self.assertEqual(example, shard_example)
+                        # uint8 quantization error plus rounding to 1 decimal
+                        max_err = viz_file["max_act"] / 255 / 2 + 0.1
+                        np.testing.assert_allclose(shard_acts, acts, atol=max_err)
+
+
+if __name__ == "__main__":
+    unittest.main()
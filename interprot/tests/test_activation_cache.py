@@ -0,0 +1,187 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+import esm
+import numpy as np
+import torch
+
+from interprot.activation_cache import INDEX_FILE_NAME, ActivationCache, canonical_model_id
+from interprot.esm_wrapper import ESM2Model
+
+
+class TestActivationCache(unittest.TestCase):
+    def test_get_or_compute_only_computes_misses(self):
+        computed = []
+
+        def compute_fn(seqs):
+            computed.extend(seqs)
+            return [torch.full((len(seq) + 2, 4), float(len(seq))) for seq in seqs]
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ActivationCache(cache_dir)
+            acts = cache.get_or_compute("esm", 24, ["AAA", "CC"], compute_fn)
+            self.assertEqual(computed, ["AAA", "CC"])
+            self.assertEqual(acts[0].shape, (5, 4))
+
+            # A fresh instance reads the same on-disk store
+            cache = ActivationCache(cache_dir)
+            acts = cache.get_or_compute("esm", 24, ["CC", "DDDD"], compute_fn)
+            self.assertEqual(computed, ["AAA", "CC", "DDDD"])
+            torch.testing.assert_close(acts[0], torch.full((4, 4), 2.0))
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+            # Different layers don't share entries
+            self.assertIsNone(cache.get("esm", 12, "CC"))
+
+    def test_get_or_compute_layers_runs_once_per_missing_seq(self):
+        computed = []
+
+        def compute_fn(seqs):
+            computed.append(seqs)
+            return {
+                layer: [torch.full((len(seq) + 2, 4), float(layer)) for seq in seqs]
+                for layer in (12, 24)
+            }
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ActivationCache(cache_dir)
+            cache.put("esm", 24, "AAA", torch.full((5, 4), 24.0))
+            acts = cache.get_or_compute_layers("esm", [12, 24], ["AAA", "CC"], compute_fn)
+
+            # Missing from any layer means one pLM pass that fills every layer
+            self.assertEqual(computed, [["AAA", "CC"]])
+            torch.testing.assert_close(acts[12][1], torch.full((4, 4), 12.0))
+            self.assertIsNotNone(cache.get("esm", 12, "AAA"))
+
+    def test_released_checkpoint_names_share_canonical_id(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            weights_file = os.path.join(cache_dir, "esm2_t6_8M_UR50D.pt")
+            open(weights_file, "w").close()
+            cache = ActivationCache(cache_dir)
+            cache.put("facebook/esm2_t6_8M_UR50D", 6, "AAA", torch.ones(5, 4))
+            self.assertIsNotNone(cache.get(weights_file, 6, "AAA"))
+            self.assertIsNone(cache.get("facebook/esm2_t12_35M_UR50D", 6, "AAA"))
+
+    def test_same_named_local_checkpoints_dont_collide(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            model_dirs = [os.path.join(cache_dir, run, "esm2_t33_650M_UR50D") for run in ["a", "b"]]
+            for model_dir in model_dirs:
+                os.makedirs(model_dir)
+            cache = ActivationCache(cache_dir)
+            cache.put(model_dirs[0], 24, "AAA", torch.ones(5, 4))
+            self.assertIsNotNone(cache.get(model_dirs[0] + "/", 24, "AAA"))
+            self.assertIsNone(cache.get(model_dirs[1], 24, "AAA"))
+            self.assertIsNone(cache.get("facebook/esm2_t33_650M_UR50D", 24, "AAA"))
+
+    def test_esm_wrapper_uses_the_canonical_id(self):
+        alphabet = esm.data.Alphabet.from_architecture("ESM-1b")
+        esm2_model = ESM2Model(
+            num_layers=1, embed_dim=16, attention_heads=2, alphabet=alphabet, token_dropout=False
+        )
+        model_data = {
+            (f"encoder.{k}" if "lm_head" in k else f"encoder.sentence_encoder.{k}"): v
+            for k, v in esm2_model.state_dict().items()
+        }
+        with tempfile.TemporaryDirectory() as weights_dir:
+            for name, expected_id in [
+                ("esm2_t6_8M_UR50D.pt", canonical_model_id("facebook/esm2_t6_8M_UR50D")),
+                ("finetuned.pt", os.path.realpath(os.path.join(weights_dir, "finetuned.pt"))),
+            ]:
+                weights_file = os.path.join(weights_dir, name)
+                torch.save({"model": model_data}, weights_file)
+                esm2_model.load_esm_ckpt(weights_file)
+                self.assertEqual(esm2_model.name_or_path, expected_id)
+
+    def test_hits_dont_hold_the_write_lock(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ActivationCache(cache_dir)
+            cache.put("esm", 24, "AAA", torch.ones(5, 4))
+            cache.commit()
+            (last_access,) = cache._db.execute("SELECT last_access FROM entries").fetchone()
+
+            self.assertIsNotNone(cache.get("esm", 24, "AAA"))
+            # Another process can still write to the index
+            other = sqlite3.connect(os.path.join(cache_dir, INDEX_FILE_NAME), timeout=0)
+            other.execute("BEGIN IMMEDIATE")
+            other.rollback()
+            other.close()
+
+            cache.commit()
+            (new_last_access,) = cache._db.execute("SELECT last_access FROM entries").fetchone()
+            self.assertGreater(new_last_access, last_access)
+
+    def test_evicts_least_recently_used_shard(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            # Each entry is 1KB and gets its own shard; the cap fits 2 shards.
+            cache = ActivationCache(
+                cache_dir, max_size_gb=2048 / 1024**3, shard_size_mb=0, min_shard_idle_seconds=0
+            )
+            acts = torch.zeros(16, 16)
+            for seq in ["A", "C", "D"]:
+                cache.put("esm", 24, seq, acts)
+                cache.get("esm", 24, "A")
+            cache.put("esm", 24, "E", acts)
+
+            self.assertLessEqual(cache.size_bytes(), 3 * 1024)
+            self.assertIsNotNone(cache.get("esm", 24, "A"))
+            self.assertIsNone(cache.get("esm", 24, "C"))
+            np.testing.assert_array_equal(cache.get("esm", 24, "E"), acts.numpy())
+
+    def test_keeps_recently_written_shards(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            writer = ActivationCache(cache_dir)
+            writer.put("esm", 24, "A", torch.zeros(16, 16))
+            writer.commit()
+
+            # Another process over the cap can't evict a shard that is still being written
+            cache = ActivationCache(cache_dir, max_size_gb=0, shard_size_mb=0)
+            cache.put("esm", 24, "C", torch.zeros(16, 16))
+            self.assertIsNotNone(cache.get("esm", 24, "A"))
+
+    def test_evicts_shards_without_index_entries(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            # A writer that crashed before committing leaves a shard no entry points to
+            crashed = ActivationCache(cache_dir)
+            crashed.put("esm", 24, "A", torch.zeros(16, 16))
+            crashed._db.rollback()
+            orphan_path = os.path.join(cache_dir, crashed._write_shard)
+            old = os.path.getmtime(orphan_path) - 3600
+            os.utime(orphan_path, (old, old))
+            # A shard that was just written may still get its entries committed
+            live_path = os.path.join(cache_dir, "live.bin")
+            with open(live_path, "wb") as f:
+                f.write(np.zeros((16, 16), dtype=np.float32).tobytes())
+
+            # The cap fits two 1KB shards, so the orphan has to go
+            cache = ActivationCache(
+                cache_dir, max_size_gb=2048 / 1024**3, shard_size_mb=0, min_shard_idle_seconds=60
+            )
+            cache.put("esm", 24, "C", torch.zeros(16, 16))
+            cache.put("esm", 24, "D", torch.zeros(16, 16))
+
+            self.assertFalse(os.path.exists(orphan_path))
+            self.assertTrue(os.path.exists(live_path))
+            self.assertIsNotNone(cache.get("esm", 24, "C"))
+
+    def test_recreated_shard_is_a_miss(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ActivationCache(cache_dir)
+            cache.put("esm", 24, "A", torch.zeros(16, 16))
+            cache.put("esm", 24, "C", torch.ones(16, 16))
+            cache.commit()
+
+            # The shard is evicted and its name reused with other contents
+            shard_path = os.path.join(cache_dir, cache._write_shard)
+            os.remove(shard_path)
+            with open(shard_path, "wb") as f:
+                f.write(np.full((32, 16), 2, dtype=np.float32).tobytes())
+
+            cache = ActivationCache(cache_dir)
+            self.assertIsNone(cache.get("esm", 24, "A"))
+            self.assertIsNone(cache.get("esm", 24, "C"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,159 @@
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+from interprot.activation_store import (
+    ActivationStore,
+    ActivationStoreDataset,
+    ActivationStoreWriter,
+    TokenShuffleBuffer,
+)
+from interprot.utils import iter_shuffled_length_batches
+
+
+def write_store(store_dir: str, seq_lengths: list[int]) -> np.ndarray:
+    """
+    Write a store where each token vector is filled with its global token index.
+    """
+    writer = ActivationStoreWriter(store_dir, d_model=4, shard_tokens=10)
+    num_tokens = 0
+    for length in seq_lengths:
+        token_ids = torch.arange(num_tokens, num_tokens + length, dtype=torch.float32)
+        writer.add(token_ids[:, None].expand(length, 4))
+        num_tokens += length
+    writer.close()
+    return np.arange(num_tokens)
+
+
+class TestActivationStore(unittest.TestCase):
+    def test_write_and_read(self):
+        with tempfile.TemporaryDirectory() as store_dir:
+            write_store(store_dir, [3, 5, 4, 7, 2])
+            store = ActivationStore(store_dir)
+
+            # Sequences aren't split across shards
+            self.assertEqual(len(store), 2)
+            self.assertEqual(store.num_tokens, 21)
+            np.testing.assert_array_equal(store.offsets(0), [0, 3, 8, 12])
+            np.testing.assert_array_equal(store.offsets(1), [0, 7, 9])
+            np.testing.assert_array_equal(store.shard(1)[:, 0], np.arange(12, 21))
+
+    def test_token_shuffle_buffer(self):
+        buffer = TokenShuffleBuffer(
+            d_model=1, capacity_tokens=8, batch_tokens=3, rng=np.random.default_rng(0)
+        )
+        batches = list(buffer.add(np.arange(20, dtype=np.float16)[:, None]))
+        batches += list(buffer.flush(drop_last=False))
+
+        self.assertTrue(all(len(batch) == 3 for batch in batches[:-1]))
+        emitted = torch.cat(batches)[:, 0].tolist()
+        self.assertEqual(sorted(emitted), list(range(20)))
+        self.assertNotEqual(emitted, list(range(20)))
+
+    def test_dataset_yields_fixed_size_shuffled_batches(self):
+        with tempfile.TemporaryDirectory() as store_dir:
+            token_ids = write_store(store_dir, [3, 5, 4, 7, 2, 6, 6])
+            dataset = ActivationStoreDataset(
+                store_dir,
+                batch_tokens=4,
+                shuffle_buffer_tokens=8,
+                read_chunk_seqs=2,
+                exclude_special_tokens=False,
+                seed=0,
+            )
+            batches = list(dataset)
+
+            self.assertTrue(all(batch.shape == (4, 4) for batch in batches))
+            emitted = torch.cat(batches)[:, 0].long().tolist()
+            # Only the final partial batch is dropped, and no token is repeated
+            self.assertEqual(len(emitted), len(token_ids) // 4 * 4)
+            self.assertEqual(len(set(emitted)), len(emitted))
+
+    def test_dataset_excludes_special_tokens(self):
+        with tempfile.TemporaryDirectory() as store_dir:
+            seq_lengths = [3, 5, 4, 7, 2, 6, 6]
+            write_store(store_dir, seq_lengths)
+            dataset = ActivationStoreDataset(
+                store_dir, batch_tokens=1, shuffle_buffer_tokens=8, read_chunk_seqs=2, seed=0
+            )
+            emitted = torch.cat(list(dataset))[:, 0].long().tolist()
+
+            ends = np.cumsum(seq_lengths)
+            residue_ids = [
+                i for start, end in zip(ends - seq_lengths, ends) for i in range(start + 1, end - 1)
+            ]
+            self.assertEqual(sorted(emitted), residue_ids)
+
+    def test_workers_yield_the_same_number_of_batches(self):
+        with tempfile.TemporaryDirectory() as store_dir:
+            # Shards of 12, 11, 13 and 2 tokens, so worker 0 reads 25 and worker 1 13
+            write_store(store_dir, [3, 5, 4, 7, 4, 6, 7, 2])
+            dataset = ActivationStoreDataset(
+                store_dir,
+                batch_tokens=4,
+                shuffle_buffer_tokens=8,
+                exclude_special_tokens=False,
+                seed=0,
+            )
+            loader = torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=2)
+            batches = list(loader)
+
+            # Both workers stop after 13 // 4 batches, as DDP ranks would
+            self.assertEqual(len(batches), 2 * (13 // 4))
+            emitted = torch.cat(batches)[:, 0].long().tolist()
+            self.assertEqual(len(set(emitted)), len(emitted))
+
+    def test_workers_split_read_chunks_when_there_are_fewer_shards(self):
+        with tempfile.TemporaryDirectory() as store_dir:
+            # Two shards for three workers
+            token_ids = write_store(store_dir, [3, 5, 4, 7, 4])
+            dataset = ActivationStoreDataset(
+                store_dir,
+                batch_tokens=2,
+                shuffle_buffer_tokens=4,
+                read_chunk_seqs=1,
+                exclude_special_tokens=False,
+                seed=0,
+            )
+            loader = torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=3)
+            batches = list(loader)
+
+            # Workers read sequences 0 and 3, 1 and 4, and 2, so 10, 9 and 4 tokens
+            self.assertEqual(len(batches), 3 * (4 // 2))
+            emitted = torch.cat(batches)[:, 0].long().tolist()
+            self.assertEqual(len(set(emitted)), len(emitted))
+            self.assertTrue(set(emitted) <= set(token_ids.tolist()))
+
+            dataset.read_chunk_seqs = 2
+            loader = torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=4)
+            with self.assertRaisesRegex(ValueError, "fewer than the 4"):
+                list(loader)
+
+    def test_shards_cover_the_whole_length_distribution(self):
+        # Written in window order like `extract_activations.py` does
+        lengths = np.random.default_rng(0).integers(10, 500, size=2000)
+        windows = iter_shuffled_length_batches(lengths.tolist(), 2048, sort_window=512, seed=0)
+        with tempfile.TemporaryDirectory() as store_dir:
+            writer = ActivationStoreWriter(store_dir, d_model=1, shard_tokens=65536)
+            for window, batches in windows:
+                self.assertEqual(sorted(window), sorted(i for batch in batches for i in batch))
+                for i in window:
+                    writer.add(torch.zeros(lengths[i] + 2, 1))
+            writer.close()
+            store = ActivationStore(store_dir)
+
+            bins = np.quantile(lengths, [0.25, 0.5, 0.75])
+            corpus_hist = np.bincount(np.digitize(lengths, bins), minlength=4) / len(lengths)
+            self.assertGreater(len(store), 4)
+            for shard_idx in range(len(store)):
+                shard_lengths = np.diff(store.offsets(shard_idx)) - 2
+                if len(shard_lengths) < 100:
+                    continue  # The last shard can be small
+                shard_hist = np.bincount(np.digitize(shard_lengths, bins), minlength=4)
+                np.testing.assert_allclose(shard_hist / len(shard_lengths), corpus_hist, atol=0.1)
+
+
+if __name__ == "__main__":
+    unittest.main()
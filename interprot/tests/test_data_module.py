@@ -0,0 +1,87 @@
+import os
+import sys
+import tempfile
+import unittest
+
+import polars as pl
+import torch
+
+# The training modules import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from data_module import BufferedActivationDataset, BufferedSequenceDataModule  # noqa: E402
+
+SEQS = ["MKTAYIAKQR", "MK", "MKTAYIAKQRQISFVKSHFSRQ", "GAVLI", "MKTAYIAKQRQISF", "ACDEFGHIK"]
+
+
+def make_get_activations(seqs: list[str]):
+    """
+    Returns a stand-in for the pLM that gives each residue token random float32
+    activations, and the list of sequence batches it was called with.
+    """
+    torch.manual_seed(0)
+    seq_to_acts = {seq: torch.randn(len(seq), 4) for seq in seqs}
+    calls = []
+
+    def get_activations(batch_seqs: list[str]) -> list[torch.Tensor]:
+        calls.append(batch_seqs)
+        return [seq_to_acts[seq] for seq in batch_seqs]
+
+    all_acts = torch.cat(list(seq_to_acts.values()))
+    return get_activations, calls, all_acts
+
+
+def as_rows(acts: torch.Tensor) -> list[tuple[float, ...]]:
+    return [tuple(row) for row in acts.tolist()]
+
+
+class TestBufferedActivationDataset(unittest.TestCase):
+    def test_yields_full_precision_shuffled_batches(self):
+        get_activations, calls, all_acts = make_get_activations(SEQS)
+        dataset = BufferedActivationDataset(
+            pl.DataFrame({"sequence": SEQS}),
+            get_activations,
+            seq_batch_size=4,
+            batch_tokens=5,
+            shuffle_buffer_tokens=16,
+        )
+        batches = list(dataset)
+
+        self.assertEqual([len(batch_seqs) for batch_seqs in calls], [4, 2])
+        self.assertTrue(all(batch.shape == (5, 4) for batch in batches))
+        self.assertTrue(all(batch.dtype == torch.float32 for batch in batches))
+        # Every full batch is emitted, with the pLM's activations unrounded
+        emitted = as_rows(torch.cat(batches))
+        self.assertEqual(len(emitted), len(all_acts) // 5 * 5)
+        self.assertEqual(len(set(emitted)), len(emitted))
+        self.assertTrue(set(emitted) <= set(as_rows(all_acts)))
+
+
+class TestBufferedSequenceDataModule(unittest.TestCase):
+    def test_train_dataloader_yields_token_batches(self):
+        seqs = SEQS * 10
+        get_activations, calls, _ = make_get_activations(seqs)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            data_path = os.path.join(tmp_dir, "seqs.parquet")
+            pl.DataFrame(
+                {"id": [str(i) for i in range(len(seqs))], "sequence": seqs}
+            ).write_parquet(data_path)
+            data_module = BufferedSequenceDataModule(
+                data_path,
+                batch_size=8,
+                get_activations=get_activations,
+                token_batch_size=16,
+                shuffle_buffer_tokens=64,
+                num_workers=0,
+            )
+            data_module.setup()
+            batches = list(data_module.train_dataloader())
+
+        train_num_tokens = data_module.train_data["sequence"].str.len_chars().sum()
+        self.assertEqual(len(batches), train_num_tokens // 16)
+        self.assertTrue(all(batch.shape == (16, 4) for batch in batches))
+        self.assertTrue(all(len(batch_seqs) <= 8 for batch_seqs in calls))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+import os
+import tempfile
+import unittest
+
+import torch
+from transformers import EsmConfig, EsmModel, EsmTokenizer
+
+from interprot.utils import (
+    get_layer_activations,
+    iter_layer_activations,
+    iter_multi_layer_activations,
+    make_length_batches,
+    truncate_plm,
+)
+
+ESM_VOCAB = [
+    "<cls>", "<pad>", "<eos>", "<unk>", "L", "A", "G", "V", "S", "E", "R", "T", "I", "D", "P",
+    "K", "Q", "N", "F", "Y", "M", "H", "W", "C", "X", "B", "U", "Z", "O", ".", "-", "<null_1>",
+    "<mask>",
+]  # fmt: skip
+
+
+def make_tiny_esm() -> tuple[EsmTokenizer, EsmModel]:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        vocab_file = os.path.join(tmp_dir, "vocab.txt")
+        with open(vocab_file, "w") as f:
+            f.write("\n".join(ESM_VOCAB))
+        tokenizer = EsmTokenizer(vocab_file)
+    config = EsmConfig(
+        vocab_size=len(ESM_VOCAB),
+        hidden_size=16,
+        num_hidden_layers=3,
+        num_attention_heads=2,
+        intermediate_size=32,
+        pad_token_id=1,
+        mask_token_id=32,
+        position_embedding_type="rotary",
+        token_dropout=True,
+    )
+    torch.manual_seed(0)
+    return tokenizer, EsmModel(config).eval()
+
+
+class TestLayerActivations(unittest.TestCase):
+    def test_make_length_batches(self):
+        lengths = [10, 2, 6, 3, 30]
+        batches = make_length_batches(lengths, max_tokens_per_batch=20)
+        self.assertEqual(batches, [[1, 3], [2], [0], [4]])
+        for batch in batches:
+            if len(batch) > 1:
+                self.assertLessEqual(len(batch) * (max(lengths[i] for i in batch) + 2), 20)
+
+    def test_iter_layer_activations_matches_unbatched(self):
+        tokenizer, plm = make_tiny_esm()
+        seqs = ["MKTAYIAKQR", "MKV", "ACDEFGHIKLMNPQ", "WY", "MKVL"]
+        device = torch.device("cpu")
+
+        acts = list(
+            iter_layer_activations(
+                tokenizer, plm, seqs, layer=2, device=device, max_tokens_per_batch=40, sort_window=4
+            )
+        )
+
+        self.assertEqual(len(acts), len(seqs))
+        for seq, seq_acts in zip(seqs, acts):
+            expected = get_layer_activations(tokenizer, plm, [seq], layer=2, device=device)[0]
+            self.assertEqual(seq_acts.shape, (len(seq), 16))
+            torch.testing.assert_close(seq_acts, expected[1:-1], atol=1e-5, rtol=1e-4)
+
+    def test_get_layer_activations_matches_hidden_states(self):
+        tokenizer, plm = make_tiny_esm()
+        seqs = ["MKTAYIAKQR", "MKV"]
+        device = torch.device("cpu")
+        inputs = tokenizer(seqs, padding=True, return_tensors="pt")
+        with torch.no_grad():
+            hidden_states = plm(**inputs, output_hidden_states=True).hidden_states
+
+        for layer in range(len(hidden_states)):
+            acts = get_layer_activations(tokenizer, plm, seqs, layer, device=device)
+            torch.testing.assert_close(acts, hidden_states[layer])
+
+        truncate_plm(plm, 2)
+        self.assertEqual(len(plm.encoder.layer), 2)
+        acts = get_layer_activations(tokenizer, plm, seqs, 2, device=device)
+        torch.testing.assert_close(acts, hidden_states[2])
+        # The last layer is gone, so its hidden state can't be computed anymore
+        with self.assertRaises(ValueError):
+            get_layer_activations(tokenizer, plm, seqs, 3, device=device)
+
+    def test_iter_multi_layer_activations_matches_single_layer(self):
+        tokenizer, plm = make_tiny_esm()
+        seqs = ["MKTAYIAKQR", "MKV", "ACDEFGHIKLMNPQ"]
+        device = torch.device("cpu")
+
+        multi_acts = list(
+            iter_multi_layer_activations(
+                tokenizer, plm, seqs, layers=[1, 3], device=device, max_tokens_per_batch=40
+            )
+        )
+
+        for layer in [1, 3]:
+            single_acts = iter_layer_activations(
+                tokenizer, plm, seqs, layer=layer, device=device, max_tokens_per_batch=40
+            )
+            for seq_acts, expected in zip(multi_acts, single_acts):
+                self.assertEqual(set(seq_acts), {1, 3})
+                torch.testing.assert_close(seq_acts[layer], expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+
+import torch
+
+from interprot.sae_model import SparseAutoencoder, SparseAutoencoderGroup
+
+
+class TestSparseAutoencoder(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.sae = SparseAutoencoder(d_model=16, d_hidden=64, k=4, batch_size=1)
+        with torch.no_grad():
+            self.sae.b_enc.normal_()
+            self.sae.b_pre.normal_()
+        self.x = torch.randn(2, 5, 16)
+
+    def test_sparse_acts_match_dense_acts(self):
+        dense = self.sae.get_acts(self.x)
+        values, indices = self.sae.get_acts_sparse(self.x)
+
+        self.assertEqual(values.shape, (2, 5, 4))
+        scattered = torch.zeros_like(dense).scatter_(-1, indices, values)
+        torch.testing.assert_close(scattered, dense)
+
+    def test_decode_sparse_matches_dense_decode(self):
+        acts, mu, std = self.sae.encode(self.x)
+        latents = self.sae.topK_activation(acts, self.sae.k)
+        expected = (latents @ self.sae.w_dec + self.sae.b_pre) * std + mu
+
+        values, indices, mu, std = self.sae.encode_sparse(self.x)
+        torch.testing.assert_close(self.sae.decode_sparse(values, indices, mu, std), expected)
+        torch.testing.assert_close(self.sae.decode(acts, mu, std), expected)
+        torch.testing.assert_close(self.sae.forward_val(self.x), expected)
+
+    def test_forward_tracks_dead_neurons(self):
+        values, indices = self.sae.get_acts_sparse(self.x)
+        fired = set(indices[values > 0].tolist())
+
+        self.sae.stats_last_nonzero.fill_(5)
+        self.sae(self.x)
+        for dim in range(self.sae.d_hidden):
+            expected = 1 if dim in fired else 6
+            self.assertEqual(self.sae.stats_last_nonzero[dim].item(), expected)
+
+    def test_forward_gradients_match_dense(self):
+        recons, _, _ = self.sae(self.x)
+        recons.sum().backward()
+        sparse_grad = self.sae.w_dec.grad.clone()
+        self.sae.zero_grad()
+
+        x, mu, std = self.sae.LN(self.x)
+        latents = self.sae.topK_activation(
+            (x - self.sae.b_pre) @ self.sae.w_enc + self.sae.b_enc, 4
+        )
+        ((latents @ self.sae.w_dec + self.sae.b_pre) * std + mu).sum().backward()
+        torch.testing.assert_close(sparse_grad, self.sae.w_dec.grad)
+
+    def test_group_acts_match_individual_acts(self):
+        other = SparseAutoencoder(d_model=16, d_hidden=32, k=8, batch_size=1)
+        with torch.no_grad():
+            other.b_enc.normal_()
+            other.b_pre.normal_()
+
+        group_acts = SparseAutoencoderGroup([self.sae, other]).get_acts(self.x)
+        torch.testing.assert_close(group_acts[0], self.sae.get_acts(self.x))
+        torch.testing.assert_close(group_acts[1], other.get_acts(self.x))
+
+        group_sparse_acts = SparseAutoencoderGroup([self.sae, other]).get_acts_sparse(self.x)
+        for sae, dense, (values, indices) in zip([self.sae, other], group_acts, group_sparse_acts):
+            self.assertEqual(values.shape, (2, 5, sae.k))
+            scattered = torch.zeros_like(dense).scatter_(-1, indices, values)
+            torch.testing.assert_close(scattered, dense)
+
+
+if __name__ == "__main__":
+    unittest.main()
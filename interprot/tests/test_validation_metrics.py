@@ -0,0 +1,64 @@
+import unittest
+
+import esm
+import torch
+
+from interprot.esm_wrapper import ESM2Model
+from interprot.sae_model import SparseAutoencoder
+from interprot.validation_metrics import (
+    calc_diff_cross_entropy,
+    calc_loss_recovered,
+    diff_cross_entropy,
+    evaluate_sae,
+)
+
+
+class TestValidationMetrics(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        alphabet = esm.data.Alphabet.from_architecture("ESM-1b")
+        self.esm2_model = ESM2Model(
+            num_layers=3, embed_dim=16, attention_heads=2, alphabet=alphabet, token_dropout=False
+        ).eval()
+        self.sae_model = SparseAutoencoder(d_model=16, d_hidden=64, k=4, batch_size=1)
+        self.seqs = ["MKTAYIAKQR", "MKV", "ACDEFGHIKLMNPQ"]
+
+    @torch.no_grad()
+    def test_evaluate_sae_matches_unbatched(self):
+        metrics = evaluate_sae(self.seqs, 2, self.esm2_model, self.sae_model)
+
+        for i, seq in enumerate(self.seqs):
+            tokens, acts = self.esm2_model.get_layer_activations(seq, 2)
+            recons = self.sae_model.forward_val(acts)
+            logits_orig = self.esm2_model.get_sequence(acts, 2)
+            diff_CE = diff_cross_entropy(
+                logits_orig, self.esm2_model.get_sequence(recons, 2), tokens
+            )
+            diff_CE_zeros = diff_cross_entropy(
+                logits_orig, self.esm2_model.get_sequence(torch.zeros_like(acts), 2), tokens
+            )
+
+            expected_mse = (recons - acts)[0, 1:-1].pow(2).mean().item()
+            self.assertAlmostEqual(metrics["mse"][i].item(), expected_mse, places=5)
+            self.assertAlmostEqual(metrics["diff_cross_entropy"][i].item(), diff_CE, places=4)
+            self.assertAlmostEqual(
+                metrics["loss_recovered"][i].item(), 1 - diff_CE / diff_CE_zeros, places=3
+            )
+
+    def test_wrappers(self):
+        seq = self.seqs[0]
+        metrics = evaluate_sae(seq, 2, self.esm2_model, self.sae_model)
+        self.assertAlmostEqual(
+            calc_diff_cross_entropy(seq, 2, self.esm2_model, self.sae_model),
+            metrics["diff_cross_entropy"].item(),
+            places=5,
+        )
+        self.assertAlmostEqual(
+            calc_loss_recovered(seq, 2, self.esm2_model, self.sae_model),
+            metrics["loss_recovered"].item(),
+            places=5,
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,9 +2,11 @@ import argparse
 import glob
 import os
 
+import polars as pr
 import pytorch_lightning as pl
 import wandb
-from data_module import SequenceDataModule
+from activation_store import ActivationStore
+from data_module import ActivationDataModule, BufferedSequenceDataModule, SequenceDataModule
 from pytorch_lightning.callbacks import ModelCheckpoint
 from pytorch_lightning.loggers import WandbLogger
 from sae_module import SAELightningModule
@@ -26,6 +28,14 @@ parser.add_argument("-d", "--num-devices", type=int, default=1)
 parser.add_argument("--model-suffix", type=str, default="")
 parser.add_argument("--wandb-project", type=str, default="interprot")
 parser.add_argument("--num-workers", type=int, default=None)
+parser.add_argument("--activation-cache-dir", type=str, default=None)
+parser.add_argument("--activation-cache-max-gb", type=float, default=500.0)
+# Train on fixed-size batches of token-level shuffled activations, either computed on
+# the fly (--shuffle-tokens) or pre-extracted with extract_activations.py
+parser.add_argument("--shuffle-tokens", action="store_true")
+parser.add_argument("--activations-dir", type=str, default=None)
+parser.add_argument("--token-batch-size", type=int, default=8192)
+parser.add_argument("--shuffle-buffer-tokens", type=int, default=262144)
 
 args = parser.parse_args()
 args.output_dir = (
@@ -45,10 +55,41 @@ wandb_logger = WandbLogger(
     save_dir=os.path.join(args.output_dir, "wandb"),
 )
 
-model = SAELightningModule(args)
+# --dead-steps-threshold counts sequences, so on token batches a step counts as the
+# average number of sequences whose residues fill a batch
+if args.activations_dir is not None:
+    store = ActivationStore(args.activations_dir)
+    # The store keeps the BOS and EOS token of each sequence
+    mean_seq_len = store.num_tokens / store.num_seqs - 2
+    examples_per_step = args.token_batch_size / mean_seq_len
+elif args.shuffle_tokens:
+    mean_seq_len = pr.read_parquet(args.data_dir)["sequence"].str.len_chars().mean()
+    examples_per_step = args.token_batch_size / mean_seq_len
+else:
+    examples_per_step = args.batch_size
+
+model = SAELightningModule(args, examples_per_step)
 wandb_logger.watch(model, log="all")
 
-data_module = SequenceDataModule(args.data_dir, args.batch_size, args.num_workers)
+if args.activations_dir is not None:
+    data_module = ActivationDataModule(
+        args.activations_dir,
+        args.batch_size,
+        args.token_batch_size,
+        args.shuffle_buffer_tokens,
+        args.num_workers,
+    )
+elif args.shuffle_tokens:
+    data_module = BufferedSequenceDataModule(
+        args.data_dir,
+        args.batch_size,
+        model.get_token_activations,
+        args.token_batch_size,
+        args.shuffle_buffer_tokens,
+        args.num_workers,
+    )
+else:
+    data_module = SequenceDataModule(args.data_dir, args.batch_size, args.num_workers)
 checkpoint_callback = ModelCheckpoint(
     dirpath=os.path.join(args.output_dir, "checkpoints"),
     filename=sae_name + "-{step}-{avg_mse_loss:.2f}",
@@ -1,11 +1,15 @@
 import os
-from typing import Optional
+from typing import TYPE_CHECKING, Iterator, Optional
 
 import numpy as np
 import polars as pl
 import torch
+from torch.nn.utils.rnn import pad_sequence
 from transformers import PreTrainedModel, PreTrainedTokenizer
 
+if TYPE_CHECKING:
+    from interprot.activation_cache import ActivationCache
+
 
 def create_file(dir: str, file_name: str) -> None:
     if not os.path.isdir(dir):
@@ -24,6 +28,7 @@ def get_layer_activations(
     seqs: list[str],
     layer: int,
     device: Optional[torch.device] = None,
+    cache: Optional["ActivationCache"] = None,
 ) -> torch.Tensor:
     """
     Get the activations of a specific layer in a pLM model. Let:
@@ -43,45 +48,286 @@ def get_layer_activations(
         seqs: The sequences to get the activations for.
         layer: The layer to get the activations from.
         device: The device to use.
+        cache: If provided, activations are read from and written to this cache, and
+            only uncached sequences are run through the pLM. Padding positions are
+            zero-filled in this case.
 
     Returns:
         The (N, L, D_MODEL) activations of the specified layer.
     """
+    return get_multi_layer_activations(tokenizer, plm, seqs, [layer], device, cache)[layer]
+
+
+def get_multi_layer_activations(
+    tokenizer: PreTrainedTokenizer,
+    plm: PreTrainedModel,
+    seqs: list[str],
+    layers: list[int],
+    device: Optional[torch.device] = None,
+    cache: Optional["ActivationCache"] = None,
+) -> dict[int, torch.Tensor]:
+    """
+    Multi-layer version of `get_layer_activations`. All layers are captured in a
+    single forward pass that stops after the deepest requested layer.
+
+    Args:
+        tokenizer: The tokenizer to use.
+        plm: The pLM model to get the activations from.
+        seqs: The sequences to get the activations for.
+        layers: The layers to get the activations from.
+        device: The device to use.
+        cache: Optional activation cache, see `get_layer_activations`.
+
+    Returns:
+        A dict mapping each layer to its (N, L, D_MODEL) activations.
+    """
     if device is None:
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    layers = sorted(set(layers))
+
+    if cache is not None:
+
+        def compute_fn(missing_seqs: list[str]) -> dict[int, list[torch.Tensor]]:
+            layer_acts = get_multi_layer_activations(tokenizer, plm, missing_seqs, layers, device)
+            return {
+                layer: [acts[: len(seq) + 2] for acts, seq in zip(layer_acts[layer], missing_seqs)]
+                for layer in layers
+            }
+
+        per_seq_acts = cache.get_or_compute_layers(plm.name_or_path, layers, seqs, compute_fn)
+        return {
+            layer: pad_sequence(
+                [acts.to(device=device, dtype=plm.dtype) for acts in per_seq_acts[layer]],
+                batch_first=True,
+            )
+            for layer in layers
+        }
 
     inputs = tokenizer(seqs, padding=True, return_tensors="pt").to(device)
     with torch.no_grad():
-        outputs = plm(**inputs, output_hidden_states=True)
-    layer_acts = outputs.hidden_states[layer]
-    del outputs
+        return _forward_to_layers(plm, inputs, layers)
+
+
+class _StopForward(Exception):
+    pass
+
+
+def _forward_to_layers(
+    plm: PreTrainedModel, inputs: dict, layers: list[int]
+) -> dict[int, torch.Tensor]:
+    """
+    Run the pLM only up to the deepest of `layers` and return what would be
+    `hidden_states[layer]` of a full forward pass for each layer. Forward hooks
+    capture the requested layers and stop the forward pass after the deepest one, so
+    neither the later layers nor the other hidden states are computed.
+    """
+    # A truncated pLM would still return its last layer norm output as the last
+    # hidden state, so layers past its end have to be rejected up front.
+    too_deep = [layer for layer in layers if layer > len(plm.encoder.layer)]
+    if too_deep:
+        raise ValueError(
+            f"Layers {too_deep} are past the {len(plm.encoder.layer)} encoder layers of the "
+            "pLM, was it truncated before them?"
+        )
+
+    layer_acts = {}
+    handles = []
+
+    def capture(layer, stop):
+        def hook(module, args, output):
+            layer_acts[layer] = output[0] if isinstance(output, tuple) else output
+            if stop:
+                raise _StopForward()
+
+        return hook
+
+    # The last hidden state has the final layer norm applied, so it's read from the
+    # model output instead.
+    hooked_layers = [layer for layer in layers if layer < plm.config.num_hidden_layers]
+    for layer in hooked_layers:
+        module = plm.embeddings if layer == 0 else plm.encoder.layer[layer - 1]
+        stop = layer == max(layers)
+        handles.append(module.register_forward_hook(capture(layer, stop)))
+    try:
+        outputs = plm(**inputs)
+        if plm.config.num_hidden_layers in layers:
+            layer_acts[plm.config.num_hidden_layers] = outputs.last_hidden_state
+    except _StopForward:
+        pass
+    finally:
+        for handle in handles:
+            handle.remove()
     return layer_acts
 
 
+def truncate_plm(plm: PreTrainedModel, layer: int) -> PreTrainedModel:
+    """
+    Free the memory of the pLM weights that aren't needed to get the activations of
+    `layer`, i.e. the encoder layers after it and the pooler. The truncated pLM can
+    only be used to get activations of layers up to `layer`.
+
+    Args:
+        plm: The pLM model to truncate in place.
+        layer: The deepest layer activations will be taken from.
+
+    Returns:
+        The truncated pLM.
+    """
+    plm.encoder.layer = plm.encoder.layer[:layer]
+    plm.pooler = None
+    return plm
+
+
+def make_length_batches(lengths: list[int], max_tokens_per_batch: int) -> list[list[int]]:
+    """
+    Group sequence indices into batches of similar length. Indices are sorted by
+    length and greedily packed so that each padded batch, i.e.
+    `len(batch) * (max length in batch + 2)`, stays within `max_tokens_per_batch`.
+    A sequence that exceeds the budget on its own gets a batch of its own.
+
+    Args:
+        lengths: The length of each sequence.
+        max_tokens_per_batch: The token budget of each batch, including padding and
+            BOS/EOS tokens.
+
+    Returns:
+        A list of batches, each a list of indices into `lengths`.
+    """
+    batches = []
+    batch: list[int] = []
+    for idx in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        # Sorted ascending, so the current sequence is the longest in the batch
+        if batch and (len(batch) + 1) * (lengths[idx] + 2) > max_tokens_per_batch:
+            batches.append(batch)
+            batch = []
+        batch.append(idx)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def iter_shuffled_length_batches(
+    lengths: list[int], max_tokens_per_batch: int, sort_window: int, seed: int
+) -> Iterator[tuple[list[int], list[list[int]]]]:
+    """
+    Shuffle the sequence indices and split them into windows of `sort_window`
+    sequences, each grouped into batches with `make_length_batches`. Consumers that
+    write sequences out in window order get a random sample of all lengths in any run
+    of consecutive sequences, while the batches still keep padding low.
+
+    Args:
+        lengths: The length of each sequence.
+        max_tokens_per_batch: The token budget of each batch, see `make_length_batches`.
+        sort_window: How many sequences are sorted by length at a time.
+        seed: Seed of the shuffle.
+
+    Yields:
+        The indices into `lengths` of each window in shuffled order, and the batches of
+        the window, also as indices into `lengths`.
+    """
+    order = np.random.default_rng(seed).permutation(len(lengths)).tolist()
+    for window_start in range(0, len(order), sort_window):
+        window = order[window_start : window_start + sort_window]
+        batches = make_length_batches([lengths[i] for i in window], max_tokens_per_batch)
+        yield window, [[window[i] for i in batch] for batch in batches]
+
+
+def iter_layer_activations(
+    tokenizer: PreTrainedTokenizer,
+    plm: PreTrainedModel,
+    seqs: list[str],
+    layer: int,
+    device: Optional[torch.device] = None,
+    max_tokens_per_batch: int = 8192,
+    sort_window: int = 1024,
+    cache: Optional["ActivationCache"] = None,
+) -> Iterator[torch.Tensor]:
+    """
+    Streaming, batched version of `get_layer_activations`. Sequences are processed in
+    windows of `sort_window` sequences. Within a window, sequences are bucketed by
+    length into token-budgeted batches (see `make_length_batches`) so that little
+    compute is spent on padding, and the attention mask keeps padding from affecting
+    the real tokens.
+
+    Args:
+        tokenizer: The tokenizer to use.
+        plm: The pLM model to get the activations from.
+        seqs: The sequences to get the activations for.
+        layer: The layer to get the activations from.
+        device: The device to use.
+        max_tokens_per_batch: The token budget of each batch, including padding.
+        sort_window: How many sequences are sorted by length at a time. This bounds
+            how many activations are held in memory before they are yielded.
+        cache: Optional activation cache, see `get_layer_activations`.
+
+    Yields:
+        The (len(seq), D_MODEL) activations of each sequence with the BOS and EOS
+        tokens trimmed, in the same order as `seqs`.
+    """
+    for layer_acts in iter_multi_layer_activations(
+        tokenizer, plm, seqs, [layer], device, max_tokens_per_batch, sort_window, cache
+    ):
+        yield layer_acts[layer]
+
+
+def iter_multi_layer_activations(
+    tokenizer: PreTrainedTokenizer,
+    plm: PreTrainedModel,
+    seqs: list[str],
+    layers: list[int],
+    device: Optional[torch.device] = None,
+    max_tokens_per_batch: int = 8192,
+    sort_window: int = 1024,
+    cache: Optional["ActivationCache"] = None,
+) -> Iterator[dict[int, torch.Tensor]]:
+    """
+    Multi-layer version of `iter_layer_activations` that captures all layers in a
+    single pLM pass per batch.
+
+    Yields:
+        A dict mapping each layer to the (len(seq), D_MODEL) activations of each
+        sequence with the BOS and EOS tokens trimmed, in the same order as `seqs`.
+    """
+    for window_start in range(0, len(seqs), sort_window):
+        window = seqs[window_start : window_start + sort_window]
+        window_acts: list[Optional[dict[int, torch.Tensor]]] = [None] * len(window)
+        for batch in make_length_batches([len(seq) for seq in window], max_tokens_per_batch):
+            batch_seqs = [window[i] for i in batch]
+            layer_acts = get_multi_layer_activations(
+                tokenizer, plm, batch_seqs, layers, device=device, cache=cache
+            )
+            for j, (i, seq) in enumerate(zip(batch, batch_seqs)):
+                window_acts[i] = {
+                    layer: acts[j, 1 : len(seq) + 1] for layer, acts in layer_acts.items()
+                }
+            del layer_acts
+        yield from window_acts
+
+
 def train_val_test_split(
-    df: pl.DataFrame, train_frac: float = 0.9
+    df: pl.DataFrame, train_frac: float = 0.9, seed: Optional[int] = None
 ) -> tuple[pl.DataFrame, pl.DataFrame, pl.DataFrame]:
     """
     Split the sequences into training, validation, and test sets. train_frac specifies
     the fraction of examples to use for training; the rest is split evenly between
     validation and test.
 
-    Doing this by samples so it's stochastic.
+    Doing this by samples so it's stochastic, unless a seed is given.
 
     Args:
         seqs: The sequences to split.
         train_frac: The fraction of examples to use for training.
+        seed: Seed of the split. Defaults to numpy's global random state.
 
     Returns:
         A tuple containing the training, validation, and test sets.
     """
-    is_train = pl.Series(
-        np.random.choice([True, False], size=len(df), p=[train_frac, 1 - train_frac])
-    )
+    rng = np.random if seed is None else np.random.default_rng(seed)
+    is_train = pl.Series(rng.choice([True, False], size=len(df), p=[train_frac, 1 - train_frac]))
     seqs_train = df.filter(is_train)
     seqs_val_test = df.filter(~is_train)
 
-    is_val = pl.Series(np.random.choice([True, False], size=len(seqs_val_test), p=[0.1, 0.9]))
+    is_val = pl.Series(rng.choice([True, False], size=len(seqs_val_test), p=[0.1, 0.9]))
     seqs_val = seqs_val_test.filter(is_val)
     seqs_test = seqs_val_test.filter(~is_val)
     return seqs_train, seqs_val, seqs_test
@@ -1,6 +1,7 @@
 import torch
 import torch.nn.functional as F
 
+
 def diff_cross_entropy(orig_logits, recons_logits, tokens):
     """
     Calculates the difference in cross-entropy between two sets of logits.
@@ -15,53 +16,120 @@ def diff_cross_entropy(orig_logits, recons_logits, tokens):
     return recons_loss - orig_loss
 
 
+def per_sequence_cross_entropy(logits, tokens, mask):
+    """
+    Calculates the mean cross-entropy of each sequence in a padded batch.
+
+    Args:
+        logits: (B, T, V) logits.
+        tokens: (B, T) target tokens.
+        mask: (B, T) boolean tensor that is True at the positions to average over.
+
+    Returns:
+        torch.Tensor: (B,) cross-entropy of each sequence.
+    """
+    ce = F.cross_entropy(logits.transpose(1, 2), tokens, reduction="none")
+    return (ce * mask).sum(-1) / mask.sum(-1)
+
+
+def per_sequence_mse(x, recons, mask):
+    """
+    Calculates the mean squared reconstruction error of each sequence in a padded batch.
+
+    Args:
+        x: (B, T, D) original activations.
+        recons: (B, T, D) reconstructed activations.
+        mask: (B, T) boolean tensor that is True at the positions to average over.
+
+    Returns:
+        torch.Tensor: (B,) MSE of each sequence.
+    """
+    se = (recons - x).pow(2).mean(-1)
+    return (se * mask).sum(-1) / mask.sum(-1)
+
+
+@torch.no_grad()
+def evaluate_sae(seqs, layer, esm2_model, sae_model, compute_loss_recovered=True, cache=None):
+    """
+    Calculates the reconstruction MSE, the difference in cross-entropy and the loss
+    recovered of splicing the SAE into the ESM model for a batch of sequences.
+
+    The ESM prefix and the original suffix are run once, and the reconstructed and
+    zero-ablated activations are stacked into a single batched suffix call.
+
+    Args:
+        seqs: A sequence or a list of sequences.
+        layer: The layer of the ESM model to use.
+        esm2_model: The ESM model.
+        sae_model: The SAE model.
+        compute_loss_recovered: Whether to run the zero-ablated suffix for the loss
+            recovered.
+        cache: Optional `ActivationCache` for the prefix activations.
+
+    Returns:
+        dict: (B,) tensors of per-sequence "mse", "diff_cross_entropy" and, if
+            requested, "loss_recovered".
+    """
+    tokens, esm_layer_acts = esm2_model.get_layer_activations(seqs, layer, cache=cache)
+    padding_mask = esm2_model.get_padding_mask(tokens)
+    token_mask = tokens.ne(esm2_model.padding_idx)
+    residue_mask = esm2_model.get_residue_mask(tokens)
+
+    recons = sae_model.forward_val(esm_layer_acts)
+    metrics = {"mse": per_sequence_mse(esm_layer_acts, recons, residue_mask)}
+
+    logits_orig = esm2_model.get_sequence(esm_layer_acts, layer, padding_mask=padding_mask)
+    ce_orig = per_sequence_cross_entropy(logits_orig, tokens, token_mask)
+
+    spliced_acts = [recons]
+    if compute_loss_recovered:
+        spliced_acts.append(torch.zeros_like(esm_layer_acts))
+    n = len(spliced_acts)
+    logits_spliced = esm2_model.get_sequence(
+        torch.cat(spliced_acts),
+        layer,
+        padding_mask=None if padding_mask is None else padding_mask.repeat(n, 1),
+    )
+    ce_spliced = per_sequence_cross_entropy(
+        logits_spliced, tokens.repeat(n, 1), token_mask.repeat(n, 1)
+    ).view(n, -1)
+
+    metrics["diff_cross_entropy"] = ce_spliced[0] - ce_orig
+    if compute_loss_recovered:
+        metrics["loss_recovered"] = 1 - metrics["diff_cross_entropy"] / (ce_spliced[1] - ce_orig)
+    return metrics
+
+
 def calc_diff_cross_entropy(seq, layer, esm2_model, sae_model):
     """
     Calculates the difference in cross-entropy when splicing in the SAE model.
-    Wrapper around diff_cross_entropy.
+    Wrapper around evaluate_sae.
 
     Args:
         seq: A string representing the sequence.
         layer: The layer of the ESM model to use.
         esm2_model: The ESM model.
         sae_model: The SAE model.
-    
+
     Returns:
         float: The difference in cross-entropy.
     """
-    tokens, esm_layer_acts = esm2_model.get_layer_activations(seq, layer)
-    recons, auxk, num_dead = sae_model(esm_layer_acts)
-    logits_recon = esm2_model.get_sequence(recons, layer)
-    logits_orig = esm2_model.get_sequence(esm_layer_acts, layer)
-
-    return diff_cross_entropy(logits_orig, logits_recon, tokens)
+    metrics = evaluate_sae(seq, layer, esm2_model, sae_model, compute_loss_recovered=False)
+    return metrics["diff_cross_entropy"].item()
 
 
 def calc_loss_recovered(seq, layer, esm2_model, sae_model):
     """
     Calculates the "loss recovered": 1- \frac{CE(recons) - CE(orig)}{CE(zeros) - CE(orig)}.
-    Wrapper around diff_cross_entropy.
+    Wrapper around evaluate_sae.
 
     Args:
         seq: A string representing the sequence.
         layer: The layer of the ESM model to use.
         esm2_model: The ESM model.
         sae_model: The SAE model.
-    
+
     Returns:
         float: The loss recovered.
     """
-    tokens, esm_layer_acts = esm2_model.get_layer_activations(seq, layer)
-    recons, auxk, num_dead = sae_model(esm_layer_acts)
-    logits_recon = esm2_model.get_sequence(recons, layer)
-    logits_orig = esm2_model.get_sequence(esm_layer_acts, layer)
-    
-    zeros_act = torch.zeros_like(esm_layer_acts)
-    logits_zeros = esm2_model.get_sequence(zeros_act, layer)
-
-    diff_CE = diff_cross_entropy(logits_orig, logits_recon, tokens)
-    diff_CE_zeros = diff_cross_entropy(logits_orig, logits_zeros, tokens)
-
-    return 1 - (diff_CE / diff_CE_zeros)
-
-
+    return evaluate_sae(seq, layer, esm2_model, sae_model)["loss_recovered"].item()